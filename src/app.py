@@ -1,12 +1,22 @@
+import logging
+
 from flask import jsonify
 from flask_cors import CORS
 
 from config import Parser
 from flask import Flask
-from routes.api_v1 import bp as api_v1_bp
+import instrumentation
 
 config = Parser()
 
+# Has to run before routes.api_v1 creates the MongoClient
+if config.get("metrics", "enabled", True):
+    instrumentation.register_mongo_listener()
+
+from routes.api_v1 import bp as api_v1_bp, mongo_helper, redis_helper, ingest_workers
+from database.indexes import ensure_indexes
+from database.counters import CounterReconciler
+
 app = Flask(__name__)
 app.config['CORS_HEADERS'] = 'Content-Type'
 CORS(app, resources={r"*": {"origins": "*"}})
@@ -15,27 +25,37 @@ app.config.update({
 })
 
 
-# Create tables if they do not exist already
+# Background workers of each process. Indexes are created once per deploy by gunicorn.conf.py (on_starting)
 @app.before_first_request
 def create_tables():
-    # You can add here a script to init the database
-    pass
+    if ingest_workers is not None:
+        ingest_workers.start()
+    reconcile_interval = int(config.get("counters", "reconcile_interval", 3600))
+    if reconcile_interval > 0:
+        CounterReconciler(mongo_helper, redis_helper, reconcile_interval).start()
 
 
 app.register_blueprint(api_v1_bp, url_prefix='/api/v1')
 app.debug = config.get("api", "debug", False)
+if config.get("metrics", "enabled", True):
+    instrumentation.init_app(app, config.get("metrics", "path", "/metrics"))
 
 
 @app.errorhandler(Exception)
 def handle_invalid_usage(error):
     response = jsonify({"msg": str(error)})
-    print(str(error))
-    response.status_code = error.code
+    # HTTPExceptions carry their status, anything else is an unhandled error
+    response.status_code = getattr(error, "code", None) or 500
+    if response.status_code >= 500:
+        logging.getLogger(__name__).exception("Unhandled error on %s", error)
+        instrumentation.record_exception(error)
     return response
 
 
 if __name__ == "__main__":
     port = int(config.get("api", "port", 8000))
     debug = config.get("api", "debug", False)
+    if str(config.get("mongodb", "create_indexes", True)).lower() == "true":
+        ensure_indexes(mongo_helper)
     app.run(host='0.0.0.0', port=port, debug=debug)
 
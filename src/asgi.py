@@ -0,0 +1,158 @@
+# ASGI entry point: asyncio versions of POST /api/v1/event and GET /api/v1/event, with every other route served by the
+# Flask app mounted below them. Run with: uvicorn asgi:app (or gunicorn asgi:app -k uvicorn.workers.UvicornWorker)
+import json
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import redis.asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, config
+from database.async_mongo_helper import AsyncMongoHelper
+from database.classes import Event, Token, USER_ACCESS_LIMITED
+from database.ingest_queue import QueueFullException, INGEST_MODE_QUEUE
+from database.mongo_helper import DuplicatedEventReceived
+from ingest import invalid_event_fields, EVENT_DUPLICATE
+from routes.api_v1 import mongo_helper, ingest_mode, ingest_queue
+from routes.streaming import NDJSON_MIMETYPE
+
+async_mongo_helper = AsyncMongoHelper(mongo_helper, cache_ttl=float(config.get("cache", "ttl", 60)))
+redis_client = aioredis.Redis(host=config.get("redis", "host", "localhost"),
+                              port=int(config.get("redis", "port", 6379)),
+                              password=config.get("redis", "password", "") or None,
+                              decode_responses=True)
+
+
+async def get_access_level(token):
+    # Same lookup and sliding expiration as Token.get_access_level
+    key = "%s_%s" % (Token.key_prefix, token)
+    pipe = redis_client.pipeline()
+    pipe.hget(key, "access_level")
+    pipe.expire(key, Token.expiration_time)
+    access_level = (await pipe.execute())[0]
+    if access_level is None:
+        raise ValueError("Token %s not found or expired" % token)
+    return int(access_level)
+
+
+def secure_token(restrict_access=USER_ACCESS_LIMITED):
+    # Same answers as routes.api_v1.secure_token
+    def decorator(f):
+        @wraps(f)
+        async def check_authorization(request):
+            authorization = request.headers.get("Authorization")
+            if not authorization:
+                return JSONResponse({"Error": "No authorization token supplied"}, status_code=401)
+            if "bearer" not in authorization:
+                return JSONResponse({"Error": "Token in the wrong format supplied"}, status_code=401)
+            try:
+                access_level = await get_access_level(authorization[7:])
+            except ValueError as e:
+                return JSONResponse({"Error": "Token expired", "Reason": str(e), "Authorization": authorization},
+                                    status_code=498)
+            if access_level > restrict_access:
+                return JSONResponse({"Error": "User does not have access to this resource"}, status_code=403)
+            return await f(request)
+
+        return check_authorization
+
+    return decorator
+
+
+async def register_event(request):
+    body = await request.json()
+    error = invalid_event_fields(body)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    sensor_id = body.get('sensor_id')
+    tag_id = body.get('tag_id')
+    event_timestamp = body.get('event_timestamp')
+    event_details = body.get('event_details')
+
+    if ingest_mode == INGEST_MODE_QUEUE:
+        try:
+            message_id = (await run_in_threadpool(ingest_queue.enqueue, [{
+                "sensor_id": sensor_id, "tag_id": tag_id, "event_timestamp": event_timestamp,
+                "event_details": event_details}]))[0]
+        except QueueFullException as e:
+            return JSONResponse({"error": str(e), "depth": e.depth}, status_code=503, headers={"Retry-After": "1"})
+        return JSONResponse({"Event queued successfully": message_id}, status_code=202)
+
+    await async_mongo_helper.sync_lookup_cache(redis_client, 'sensor', 'item', 'zone')
+    sensor = await async_mongo_helper.get_sensor(sensor_id)
+    if not sensor:
+        return JSONResponse({"error": "sensor not registered"}, status_code=400)
+
+    item = await async_mongo_helper.get_item_by_tag(tag_id)
+    if not item:
+        return JSONResponse({"error": "no item registered for this tag"}, status_code=400)
+
+    alert = await async_mongo_helper.evaluate_location(item, sensor_id, event_timestamp)
+    try:
+        event = await async_mongo_helper.add_event(sensor_id, tag_id, item["item_id"], event_timestamp,
+                                                   event_details, alert)
+    except DuplicatedEventReceived as e:
+        return JSONResponse({"error": str(e), "status": EVENT_DUPLICATE}, status_code=409)
+    return JSONResponse({"Event added successfully": str(event["_id"])}, status_code=200)
+
+
+def requested_fields(request):
+    fields = request.query_params.get('fields')
+    if fields is None:
+        return None
+    fields = [x.strip() for x in fields.split(",") if x.strip()]
+    Event.projection_for(fields)
+    return fields
+
+
+@secure_token()
+async def read_event(request):
+    params = request.query_params
+    cursor = params.get('cursor')
+    try:
+        limit, skip = Event.parse_page(params.get('limit', 50), params.get('skip', 0))
+        fields = requested_fields(request)
+        if cursor is not None and fields is not None and "event_timestamp" not in fields:
+            fields.append("event_timestamp")
+        if cursor:
+            Event.decode_cursor(cursor)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    events = async_mongo_helper.iter_events(params.get('sensor_id'), params.get('item_id'),
+                                            params.get('start_timestamp_range'), params.get('end_timestamp_range'),
+                                            limit, skip, cursor=cursor, fields=fields)
+    if request.headers.get("Accept", "").split(",")[0].strip() == NDJSON_MIMETYPE:
+        async def generate():
+            async for event in events:
+                yield json.dumps(event) + "\n"
+        return StreamingResponse(generate(), media_type=NDJSON_MIMETYPE)
+
+    events = [x async for x in events]
+    if cursor is not None:
+        return JSONResponse({"events": events, "next_cursor": Event(mongo_helper).next_cursor(events, limit)})
+    return JSONResponse(events)
+
+
+async def event(request):
+    if request.method == "POST":
+        return await register_event(request)
+    return await read_event(request)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Background workers normally start on the first Flask request, which may never come here
+    await run_in_threadpool(flask_app.try_trigger_before_first_request_functions)
+    yield
+
+
+app = Starlette(routes=[
+    Route('/api/v1/event', event, methods=['GET', 'POST']),
+    Mount('/', WSGIMiddleware(flask_app)),
+], lifespan=lifespan)
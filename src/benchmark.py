@@ -0,0 +1,375 @@
+"""
+Load and latency benchmark of the hot API endpoints.
+
+Seeds the database configured in options.conf (or an in-memory mongomock one with --mongomock) with items, sensors
+and events, drives the endpoints either in process through the Flask test client or against a running server with
+--url, and reports p50/p95/p99 latency and requests per second per endpoint. Results are saved as JSON so runs of
+different commits can be compared with --compare. --mongomock needs the mongomock and fakeredis packages and skips
+the search scenarios, which mongomock can't run.
+
+    python benchmark.py --items 1000 --sensors 100 --events 1000000 --end 1633046400 --drop --output results.json
+    python benchmark.py --skip-seed --url http://localhost:4000 --compare results.json
+"""
+import argparse
+import datetime as dt
+import itertools
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+from contextlib import ExitStack
+
+SCENARIOS = ["post_event", "get_event", "get_event_cursor", "get_event_count", "get_sensor", "get_item",
+             "search_item", "search_sensor", "search_event"]
+# mongomock has no $text search, these scenarios only answer errors on it
+MONGOMOCK_UNSUPPORTED = {
+    "search_item": "needs $text search",
+    "search_sensor": "needs $text search",
+}
+
+
+def tag_of(i):
+    return "%012X" % i
+
+
+def sensor_of(i):
+    return "bench-sensor-%d" % i
+
+
+def item_of(i):
+    return "bench-item-%d" % i
+
+
+def seed(mongo_helper, items, sensors, events, days=30, batch_size=10000, drop=False, random_seed=0, end=None):
+    from database.classes import Item, Sensor, Event, EventBucket, EventHourly, ItemLocation
+
+    rnd = random.Random(random_seed)
+    db = mongo_helper.db
+    if drop:
+        for cls in (Item, Sensor, Event, EventBucket, EventHourly, ItemLocation):
+            db[cls.collection_name].drop()
+        db["counters"].drop()
+
+    db[Sensor.collection_name].insert_many([{
+        "sensor_id": sensor_of(i),
+        "name": "Sensor %d" % i,
+        "types": "RFID",
+        "tag": "benchmark",
+        "description": "benchmark sensor %d" % i
+    } for i in range(sensors)])
+    for start in range(0, items, batch_size):
+        db[Item.collection_name].insert_many([{
+            "item_id": item_of(i),
+            "name": "Item %d" % i,
+            "tags": [tag_of(i)],
+            "location_blacklist": None,
+            "location_whitelist": None,
+            "default_storage_location": sensor_of(rnd.randrange(sensors)),
+            "description": "benchmark item %d" % i
+        } for i in range(start, min(start + batch_size, items))])
+
+    # Timestamps are spread over the days before end (now by default), in increasing order so they stay unique
+    end = time.time() if end is None else end
+    start_timestamp = end - days * 24 * 60 * 60
+    step = (end - start_timestamp) / max(events, 1)
+    for start in range(0, events, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, events)):
+            item = rnd.randrange(items)
+            batch.append(mongo_helper.build_event(sensor_of(rnd.randrange(sensors)), tag_of(item), item_of(item),
+                                                  start_timestamp + i * step, "tag in motion",
+                                                  1 if rnd.random() < 0.01 else None))
+        mongo_helper.event_storage.insert_many(batch)
+        mongo_helper.update_hourly_rollups(batch)
+
+    for cls in (Item, Sensor):
+        mongo_helper.set_counter(cls.collection_name, cls(mongo_helper).count_documents())
+        mongo_helper.bump_collection_version(cls.collection_name)
+    mongo_helper.set_counter("event", mongo_helper.event_storage.count())
+
+
+class Scenario:
+    def __init__(self, name, method, path, body=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+
+
+def build_scenario(name, rnd, items, sensors, counter):
+    if name == "post_event":
+        item = rnd.randrange(items)
+        # a timestamp in the future that no seeded or previous event has
+        return Scenario(name, "POST", "/api/v1/event", {
+            "sensor_id": sensor_of(rnd.randrange(sensors)),
+            "tag_id": tag_of(item),
+            "event_timestamp": time.time() + 10 ** 6 + next(counter) / 1000.0,
+            "event_details": "benchmark"
+        })
+    if name == "get_event":
+        return Scenario(name, "GET", "/api/v1/event?limit=50&sensor_id=%s" % sensor_of(rnd.randrange(sensors)))
+    if name == "get_event_cursor":
+        return Scenario(name, "GET", "/api/v1/event?limit=50&cursor=")
+    if name == "get_event_count":
+        return Scenario(name, "GET", "/api/v1/event_count")
+    if name == "get_sensor":
+        return Scenario(name, "GET", "/api/v1/sensor/%s" % sensor_of(rnd.randrange(sensors)))
+    if name == "get_item":
+        return Scenario(name, "GET", "/api/v1/item/%s" % item_of(rnd.randrange(items)))
+    if name == "search_item":
+        return Scenario(name, "POST", "/api/v1/search/item",
+                        {"query": "Item %d" % rnd.randrange(items), "search_limit": 10, "history_limit": 5})
+    if name == "search_sensor":
+        return Scenario(name, "POST", "/api/v1/search/sensor",
+                        {"query": "Sensor %d" % rnd.randrange(sensors), "search_limit": 10, "history_limit": 5})
+    if name == "search_event":
+        return Scenario(name, "POST", "/api/v1/search/event",
+                        {"sensor_query": sensor_of(rnd.randrange(sensors)), "limit": 50})
+    raise ValueError("Unknown scenario %s" % name)
+
+
+class FlaskClient:
+    def __init__(self, app, token):
+        self.client = app.test_client()
+        self.headers = {"Authorization": "bearer %s" % token}
+
+    def request(self, scenario):
+        response = self.client.open(scenario.path, method=scenario.method, json=scenario.body, headers=self.headers)
+        response.get_data()
+        return response.status_code
+
+
+class HttpClient:
+    def __init__(self, url, token):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.headers = {"Authorization": "bearer %s" % token}
+
+    def request(self, scenario):
+        response = self.session.request(scenario.method, self.url + scenario.path, json=scenario.body,
+                                        headers=self.headers, timeout=30)
+        return response.status_code
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    # nearest rank on the sorted values
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def run_scenario(name, client_factory, requests_count, concurrency, items, sensors, random_seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    # itertools.count is atomic under the GIL, post_event uses it to keep timestamps unique across workers
+    counter = itertools.count()
+
+    def worker(worker_id, count):
+        rnd = random.Random("%s-%s-%s" % (random_seed, name, worker_id))
+        client = client_factory()
+        local = []
+        local_errors = 0
+        for _ in range(count):
+            scenario = build_scenario(name, rnd, items, sensors, counter)
+            started = time.perf_counter()
+            try:
+                status_code = client.request(scenario)
+            except Exception:
+                status_code = None
+            local.append(time.perf_counter() - started)
+            if status_code is None or status_code >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    per_worker = [requests_count // concurrency + (1 if i < requests_count % concurrency else 0)
+                  for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(i, x)) for i, x in enumerate(per_worker) if x]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": len(latencies) / elapsed if elapsed else None,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+        "p50_ms": 1000 * percentile(latencies, 50) if latencies else None,
+        "p95_ms": 1000 * percentile(latencies, 95) if latencies else None,
+        "p99_ms": 1000 * percentile(latencies, 99) if latencies else None,
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    print("\n%-18s %12s %12s %12s" % ("scenario", "rps", "p95 ms", "p99 ms"))
+    for name, current in results["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before:
+            continue
+
+        def delta(key):
+            if not before.get(key) or current.get(key) is None:
+                return "n/a"
+            return "%+.1f%%" % (100.0 * (current[key] - before[key]) / before[key])
+        print("%-18s %12s %12s %12s" % (name, delta("rps"), delta("p95_ms"), delta("p99_ms")))
+
+
+def summary(paths):
+    # Markdown table of saved runs side by side, one column pair per run labeled by its --label (or file name)
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    labels = [x.get("label") or path.rsplit("/", 1)[-1].rsplit(".", 1)[0] for x, path in zip(runs, paths)]
+    print("| scenario | %s |" % " | ".join("%s rps | %s p95 ms" % (x, x) for x in labels))
+    print("|---|%s" % ("---:|---:|" * len(runs)))
+    names = []
+    for run in runs:
+        names.extend(x for x in run["scenarios"] if x not in names)
+    for name in names:
+        cells = []
+        for run in runs:
+            result = run["scenarios"].get(name) or {}
+            cells.append("%.0f" % result["rps"] if result.get("rps") else "n/a")
+            cells.append("%.1f" % result["p95_ms"] if result.get("p95_ms") is not None else "n/a")
+        print("| %s | %s |" % (name, " | ".join(cells)))
+    first = runs[0]
+    print("\n%s, %s events, %d requests per scenario at concurrency %d, commit %s" % (
+        first.get("target"), first["scale"]["events"], first["requests"], first["concurrency"], first.get("commit")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seeds the database and benchmarks the hot API endpoints")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--sensors", type=int, default=100)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=30, help="seeded events are spread over the days before --end")
+    parser.add_argument("--end", type=float, help="epoch timestamp of the end of the seeded events, defaults to now. "
+                                                  "Pass it too for data identical between runs")
+    parser.add_argument("--drop", action="store_true", help="drop the benchmarked collections before seeding")
+    parser.add_argument("--skip-seed", action="store_true", help="benchmark the data already in the database")
+    parser.add_argument("--seed-only", action="store_true", help="seed the database and exit")
+    parser.add_argument("--mongomock", action="store_true",
+                        help="in-memory mongomock and fakeredis, for micro benchmarks of the Python code paths")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process Flask app")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the data and the requests")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--label", help="name of the run in the saved results, e.g. the gunicorn worker class")
+    parser.add_argument("--summary", nargs="+", metavar="RESULTS",
+                        help="print the saved JSON results as a Markdown table and exit")
+    args = parser.parse_args()
+
+    if args.summary:
+        summary(args.summary)
+        return
+
+    scenarios = [x.strip() for x in args.scenarios.split(",") if x.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s" % name)
+    if args.mongomock and args.url:
+        parser.error("--mongomock only works with the in-process app")
+
+    with ExitStack() as stack:
+        if args.mongomock:
+            import mongomock
+            stack.enter_context(mongomock.patch(servers=(("mongo", 27017), ("localhost", 27017))))
+
+        from config import Parser
+        from database.classes import Token, USER_ACCESS_MASTER
+        from database.collection_versions import CollectionVersions
+        from database.mongo_helper import MongoHelper
+        from database.redis_helper import RedisHelper
+
+        if args.url:
+            mongo_helper = MongoHelper.init_from_config(Parser())
+            redis_helper = RedisHelper.init_from_config(Parser())
+            # seeding bumps the version stamps the running server answers conditional GETs with
+            mongo_helper.collection_versions = CollectionVersions(redis_helper)
+            app = None
+        else:
+            from app import app
+            from routes import api_v1
+            mongo_helper = api_v1.mongo_helper
+            redis_helper = api_v1.redis_helper
+            if args.mongomock:
+                import fakeredis
+                redis_helper._pool = fakeredis.FakeRedis(decode_responses=True).connection_pool
+                # Index creation and the background reconciler aren't part of what is measured here
+                app.before_first_request_funcs.clear()
+
+        if not args.skip_seed:
+            started = time.perf_counter()
+            seed(mongo_helper, args.items, args.sensors, args.events, args.days, drop=args.drop,
+                 random_seed=args.seed, end=args.end)
+            print("Seeded %d items, %d sensors and %d events in %.1fs" % (
+                args.items, args.sensors, args.events, time.perf_counter() - started))
+        if args.seed_only:
+            return
+
+        token = Token.create_token_from_user_data(redis_helper, {"email": "benchmark@localhost",
+                                                                 "access": USER_ACCESS_MASTER})
+        if args.url:
+            client_factory = lambda: HttpClient(args.url, token)
+        else:
+            client_factory = lambda: FlaskClient(app, token)
+
+        results = {
+            "label": args.label,
+            "commit": current_commit(),
+            "date": dt.datetime.now().isoformat(),
+            "target": args.url or ("in-process mongomock" if args.mongomock else "in-process"),
+            "event_storage": mongo_helper.event_storage.collection_name,
+            "scale": {"items": args.items, "sensors": args.sensors, "events": args.events},
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "end": args.end,
+            "scenarios": {},
+            "skipped": {}
+        }
+        print("%-18s %8s %7s %10s %9s %9s %9s" % ("scenario", "requests", "errors", "rps", "p50 ms", "p95 ms",
+                                                  "p99 ms"))
+        for name in scenarios:
+            if args.mongomock and name in MONGOMOCK_UNSUPPORTED:
+                results["skipped"][name] = "not supported by mongomock: %s" % MONGOMOCK_UNSUPPORTED[name]
+                print("%-18s skipped, %s" % (name, results["skipped"][name]))
+                continue
+            result = run_scenario(name, client_factory, args.requests, args.concurrency, args.items, args.sensors,
+                                  args.seed)
+            results["scenarios"][name] = result
+            print("%-18s %8d %7d %10.1f %9.2f %9.2f %9.2f" % (name, result["requests"], result["errors"],
+                                                            result["rps"] or 0, result["p50_ms"] or 0,
+                                                            result["p95_ms"] or 0, result["p99_ms"] or 0))
+        Token(token=token).delete(redis_helper)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import time
+
+from database.classes import Event, EventHourly
+from database.lookup_cache import LookupCache
+from database.mongo_helper import MongoHelper
+
+HOUR = 60 * 60
+
+
+class EventAnalytics:
+    """
+    Dwell time and traffic figures computed from the stored events. Results are cached per query and time window:
+    windows that ended before now are only affected by late events, so they are kept for closed_window_ttl seconds,
+    while open windows (no end or an end in the future) expire after open_window_ttl seconds.
+    """
+
+    @classmethod
+    def init_from_config(cls, config, mongo_helper):
+        return EventAnalytics(
+            mongo_helper,
+            cache_size=int(config.get("analytics", "cache_size", 1000)),
+            open_window_ttl=float(config.get("analytics", "open_window_ttl", 60)),
+            closed_window_ttl=float(config.get("analytics", "closed_window_ttl", 3600)),
+            max_dwell_window=float(config.get("analytics", "max_dwell_window", 7 * 24 * HOUR)),
+        )
+
+    def __init__(self, mongo_helper: MongoHelper, cache_size=1000, open_window_ttl=60, closed_window_ttl=3600,
+                 max_dwell_window=7 * 24 * HOUR):
+        self.mongo_helper = mongo_helper
+        self.max_dwell_window = max_dwell_window
+        self._open_windows = LookupCache(max_size=cache_size, ttl=open_window_ttl)
+        self._closed_windows = LookupCache(max_size=cache_size, ttl=closed_window_ttl)
+
+    def _cached(self, key, end_timestamp, loader):
+        closed = end_timestamp is not None and end_timestamp < time.time()
+        cache = self._closed_windows if closed else self._open_windows
+        return cache.get(key, lambda _: loader())
+
+    def dwell(self, sensor_id=None, item_id=None, start_timestamp=None, end_timestamp=None, max_gap=None):
+        """
+        Time spent by each item at each sensor. Consecutive reads of an item at the same sensor form one visit, that
+        ends when the item is read somewhere else or, if max_gap is given, after max_gap seconds without reads.
+        Returns one entry per (item_id, sensor_id) with the number of visits and reads and the total, average and
+        longest dwell in seconds.
+        Dwell replays every read of the window, so without an item_id the window must be given and span at most
+        max_dwell_window seconds, otherwise a ValueError is raised.
+        """
+        if item_id is None:
+            if start_timestamp is None or end_timestamp is None:
+                raise ValueError("item_id or both start_timestamp_range and end_timestamp_range are required")
+            if end_timestamp - start_timestamp > self.max_dwell_window:
+                raise ValueError("the time range can span at most %d seconds without an item_id"
+                                 % self.max_dwell_window)
+        key = ("dwell", sensor_id, item_id, start_timestamp, end_timestamp, max_gap)
+        return self._cached(key, end_timestamp, lambda: self._dwell(sensor_id, item_id, start_timestamp,
+                                                                    end_timestamp, max_gap))
+
+    def _dwell(self, sensor_id, item_id, start_timestamp, end_timestamp, max_gap):
+        event = Event(self.mongo_helper)
+        # sensor_id is applied after grouping, a visit is only closed by reads of the item at other sensors
+        collection, pipeline = event.source_pipeline(item_id=item_id, start_timestamp_range=start_timestamp,
+                                                     end_timestamp_range=end_timestamp)
+        pipeline += [
+            {"$match": {"item_id": {"$ne": None}}},
+            {"$project": {"_id": 0, "item_id": 1, "sensor_id": 1, "t": {
+                "$convert": {"input": "$event_timestamp", "to": "double", "onError": None, "onNull": None}}}},
+            {"$match": {"t": {"$ne": None}}},
+            {"$sort": {"item_id": 1, "t": 1}}
+        ]
+        resultset = collection.aggregate(pipeline, allowDiskUse=True, batchSize=event.stream_batch_size)
+
+        # Run-length grouping in a single pass over the sorted reads, only the open visit of each item is kept
+        totals = {}
+        visit = None
+
+        def close(visit):
+            if sensor_id is not None and visit["sensor_id"] != sensor_id:
+                return
+            entry = totals.setdefault((visit["item_id"], visit["sensor_id"]), {
+                "item_id": visit["item_id"], "sensor_id": visit["sensor_id"],
+                "visits": 0, "reads": 0, "total_dwell": 0.0, "max_dwell": 0.0
+            })
+            dwell = visit["last"] - visit["first"]
+            entry["visits"] += 1
+            entry["reads"] += visit["reads"]
+            entry["total_dwell"] += dwell
+            entry["max_dwell"] = max(entry["max_dwell"], dwell)
+
+        for read in resultset:
+            if visit is not None and visit["item_id"] == read["item_id"] and visit["sensor_id"] == read["sensor_id"] \
+                    and (not max_gap or read["t"] - visit["last"] <= max_gap):
+                visit["last"] = read["t"]
+                visit["reads"] += 1
+                continue
+            if visit is not None:
+                close(visit)
+            visit = {"item_id": read["item_id"], "sensor_id": read["sensor_id"], "first": read["t"], "last": read["t"],
+                     "reads": 1}
+        if visit is not None:
+            close(visit)
+
+        results = sorted(totals.values(), key=lambda x: (x["item_id"], str(x["sensor_id"])))
+        for entry in results:
+            entry["average_dwell"] = entry["total_dwell"] / entry["visits"]
+        return results
+
+    def traffic(self, sensor_id=None, start_timestamp=None, end_timestamp=None, interval=HOUR):
+        """
+        Number of reads per sensor per interval (a multiple of an hour), from the event_hourly rollups.
+        Returns [{"sensor_id", "period", "count"}] where period is the epoch timestamp of the start of the interval.
+        """
+        if interval < HOUR or interval % HOUR:
+            raise ValueError("interval must be a multiple of %d seconds" % HOUR)
+        key = ("traffic", sensor_id, start_timestamp, end_timestamp, interval)
+        return self._cached(key, end_timestamp, lambda: self._traffic(sensor_id, start_timestamp, end_timestamp,
+                                                                      interval))
+
+    def _traffic(self, sensor_id, start_timestamp, end_timestamp, interval):
+        rollups = EventHourly(self.mongo_helper)
+        pipeline = [
+            {"$match": rollups.rollup_query(sensor_id, None, start_timestamp, end_timestamp)},
+            {"$group": {
+                "_id": {"sensor_id": "$sensor_id", "period": {"$subtract": ["$hour", {"$mod": ["$hour", interval]}]}},
+                "count": {"$sum": "$count"}
+            }},
+            {"$sort": {"_id.period": 1, "_id.sensor_id": 1}}
+        ]
+        resultset = self.mongo_helper.db[rollups.collection_name].aggregate(pipeline)
+        return [{"sensor_id": x["_id"]["sensor_id"], "period": x["_id"]["period"], "count": x["count"]}
+                for x in resultset]
+
+    def stats(self):
+        return {"open_windows": self._open_windows.stats(), "closed_windows": self._closed_windows.stats()}
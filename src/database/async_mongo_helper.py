@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+
+from database.classes import Event, DELETED_FIELD
+from database.collection_versions import CollectionVersions
+from database.event_storage import DocumentEventStorage
+from database.location_rules import LocationRuleEngine
+from database.lookup_cache import LookupCache, MISSING
+from database.mongo_helper import MongoHelper, DuplicatedEventReceived
+
+
+class AsyncMongoHelper:
+    """
+    asyncio counterpart of the MongoHelper event paths, on motor. It takes the connection settings, event builders and
+    Event pipelines of a MongoHelper, so both paths read and write the same documents, and shares its sensor and tag
+    lookup caches. Only the document event storage is supported.
+    """
+
+    def __init__(self, mongo_helper: MongoHelper, cache_ttl=60):
+        if mongo_helper.event_storage.collection_name != DocumentEventStorage.collection_name:
+            raise ValueError("The asyncio event path only supports the document event storage")
+        self.mongo_helper = mongo_helper
+        self.sensor_cache = mongo_helper.sensor_cache
+        self.item_tag_cache = mongo_helper.item_tag_cache
+        self._client = None
+        self._pid = None
+        self._zones = LookupCache(max_size=1, ttl=cache_ttl)
+        self._latest_zones = {}
+        # Rules are compiled from the zones prefetched by refresh_zones, so evaluating never blocks the event loop
+        self.location_rules = LocationRuleEngine(lambda: self._latest_zones, ttl=cache_ttl,
+                                                 time_zone=mongo_helper.location_rules.time_zone)
+
+    @property
+    def db(self):
+        # Created on first use, inside the running event loop and the worker process
+        if self._client is None or self._pid != os.getpid():
+            self._client = AsyncIOMotorClient(**self.mongo_helper.client_settings)
+            self._pid = os.getpid()
+        return self._client[self.mongo_helper.database]
+
+    async def _cached(self, cache, key, loader):
+        generation = cache.generation
+        value = cache.peek(key)
+        if value is MISSING:
+            value = await loader(key)
+            cache.put(key, value, generation)
+        return value
+
+    async def sync_lookup_cache(self, redis_client, *collection_names):
+        """
+        asyncio counterpart of MongoHelper.sync_lookup_cache, reading the version stamps with redis_client. A missing
+        stamp is left for the sync path to create.
+        """
+        if self.mongo_helper.collection_versions is None:
+            return
+        due = [x for x in collection_names if self.mongo_helper.version_check_due(x)]
+        if not due:
+            return
+        versions = await redis_client.mget(["%s_%s" % (CollectionVersions.key_prefix, x) for x in due])
+        for collection_name, version in zip(due, versions):
+            if version is not None and self.mongo_helper.apply_collection_version(collection_name, version) \
+                    and collection_name in ('item', 'zone'):
+                self._zones.clear()
+                self.location_rules.invalidate()
+
+    async def get_sensor(self, sensor_id):
+        return await self._cached(self.sensor_cache, sensor_id,
+                                  lambda x: self.db['sensor'].find_one({"sensor_id": x}))
+
+    async def get_item_by_tag(self, tag_id):
+        return await self._cached(self.item_tag_cache, tag_id, lambda x: self.db['item'].find_one({"tags": x}))
+
+    async def refresh_zones(self):
+        async def load(_):
+            cursor = self.db['zone'].find({DELETED_FIELD: {"$exists": False}}, {"zone_id": 1, "sensors": 1})
+            return {x["zone_id"]: frozenset(x.get("sensors") or []) async for x in cursor}
+        zones = await self._cached(self._zones, "zones", load)
+        if zones is not self._latest_zones:
+            self._latest_zones = zones
+            self.location_rules.invalidate()
+
+    async def evaluate_location(self, item, sensor_id, event_timestamp):
+        await self.refresh_zones()
+        return self.location_rules.evaluate(item, sensor_id, event_timestamp)
+
+    async def add_event(self, sensor_id, tag_id, item_id, event_timestamp, event_details, alert=None):
+        event = MongoHelper.build_event(sensor_id, tag_id, item_id, event_timestamp, event_details, alert)
+        events = self.db[DocumentEventStorage.collection_name]
+        if await events.find_one({"event_timestamp": event_timestamp}, {"_id": 1}):
+            raise DuplicatedEventReceived(event)
+        try:
+            await events.insert_one(event)
+        except DuplicateKeyError:
+            raise DuplicatedEventReceived(event)
+
+        writes = [self.db["counters"].update_one({"_id": "event"}, {"$inc": {"count": 1}})]
+        for collection, operations in (("item_location", MongoHelper.item_location_operations([event])),
+                                       ("event_hourly", MongoHelper.hourly_rollup_operations([event]))):
+            if operations:
+                writes.append(self.db[collection].bulk_write(operations, ordered=False))
+        await asyncio.gather(*writes)
+        return event
+
+    async def iter_events(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        collection, pipeline = Event(self.mongo_helper).events_pipeline(
+            sensor_id, item_id, start_timestamp_range, end_timestamp_range, limit, skip, alert_only, cursor, fields)
+        async for x in self.db[collection.name].aggregate(pipeline, batchSize=Event.stream_batch_size):
+            yield Event.serialize_document(x)
@@ -1,3 +1,6 @@
+import base64
+import binascii
+import json
 import uuid
 from abc import abstractmethod
 from datetime import datetime
@@ -5,7 +8,12 @@ from datetime import datetime
 import bson
 from bson import ObjectId
 
+from pymongo.errors import OperationFailure
+
+from database.event_storage import hour_of, union_pipeline
+from database.location_rules import parse_time_windows
 from database.mongo_helper import MongoHelper, DuplicatedItemException
+from database.redis_helper import RedisHelper, RedisObject
 
 
 class MissingAttributeException(Exception):
@@ -17,6 +25,23 @@ class MissingAttributeException(Exception):
 
 DELETED_FIELD = "__deleted"
 
+SEARCH_MODE_TEXT = "text"
+SEARCH_MODE_REGEX = "regex"
+TEXT_INDEX_NAME = "search_text"
+
+
+class CompiledSchema:
+    """
+    Field list, field set and Mongo projection of a DatabaseClassObj subclass, computed once per class. Used by the
+    read paths to turn documents straight into JSON ready dicts without building an object per document.
+    """
+    __slots__ = ("fields", "field_set", "projection")
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.field_set = frozenset(self.fields)
+        self.projection = {field: 1 for field in self.fields}
+
 
 class DatabaseClassObj:
     @property
@@ -49,10 +74,58 @@ class DatabaseClassObj:
     def id_field(self):
         pass
 
+    # Declarative index spec, provisioned by database.indexes.ensure_indexes. Each entry is a dict with "keys"
+    # (list of (field, direction)) and optional "name", "unique", "partial" (partialFilterExpression), "ttl",
+    # "weights" and "default_language" (text indexes)
+    indexes = []
+
+    # Classes with a text index named TEXT_INDEX_NAME are searched with $text and ranked by textScore, others (or
+    # mode=SEARCH_MODE_REGEX) use a case insensitive regex over search_fields
+    default_search_mode = SEARCH_MODE_REGEX
+    default_search_limit = 100
+
+    # Inserts and soft deletes keep a counter in the counters collection, making count() O(1)
+    counted = True
+
     default_fields = ["_id", DELETED_FIELD]
 
+    # Documents fetched per round trip by the iter_* generators used for streaming responses
+    stream_batch_size = 500
+
+    @classmethod
+    def schema(cls):
+        # Looked up in the class __dict__ so each subclass compiles its own schema
+        schema = cls.__dict__.get("_compiled_schema")
+        if schema is None:
+            schema = CompiledSchema(cls.default_fields + cls.fields)
+            cls._compiled_schema = schema
+        return schema
+
+    @classmethod
+    def serialize_document(cls, doc):
+        # Same output as dict(obj) for an object created with _create_from_mongo_entry(doc)
+        field_set = cls.schema().field_set
+        result = {k: v for k, v in doc.items() if k in field_set}
+        if "_id" in result:
+            result["_id"] = str(result["_id"])
+        return result
+
+    @classmethod
+    def projection_for(cls, fields=None):
+        """
+        Mongo projection restricted to the requested fields (all declared fields when None). Raises ValueError for
+        fields the class doesn't declare, so client supplied lists can be passed straight through.
+        """
+        schema = cls.schema()
+        if fields is None:
+            return schema.projection
+        invalid = [x for x in fields if x not in schema.field_set]
+        if invalid:
+            raise ValueError("Invalid fields for %s: %s" % (cls.collection_name, ", ".join(invalid)))
+        return {field: 1 for field in fields}
+
     def __fields__(self):
-        return self.default_fields + self.fields
+        return self.schema().fields
 
     def __init__(self, mongo_helper: MongoHelper, _id = None):
         self.mongo_helper = mongo_helper
@@ -64,20 +137,21 @@ class DatabaseClassObj:
             except bson.errors.InvalidId:
                 pass
 
-            obj = self.mongo_helper.db[self.collection_name].find_one({"$or": ids_query})
+            obj = self.mongo_helper.slow_queries.find_one("%s.__init__" % self.__class__.__name__,
+                                                          self.collection_name, {"$or": ids_query})
             if not obj:
                 raise ValueError("Object with %s = %s in collection %s not found" % (self.id_field, _id,
                                                                                      self.collection_name))
             self._create_from_mongo_entry(obj)
 
     def __getitem__(self, item):
-        if item in self.__fields__():
+        if item in self.schema().field_set:
             return self.__getattribute__(item)
         else:
             raise AttributeError()
 
     def __setitem__(self, key, value):
-        if key in self.__fields__():
+        if key in self.schema().field_set:
             return self.__setattr__(key, value)
         else:
             raise AttributeError()
@@ -115,6 +189,9 @@ class DatabaseClassObj:
 
         inserted = self.mongo_helper.db[self.collection_name].insert_one(dict(self))
         self["_id"] = inserted.inserted_id
+        self.mongo_helper.increment_counter(self.collection_name)
+        self.mongo_helper.invalidate_lookup_cache(self.collection_name)
+        self.mongo_helper.bump_collection_version(self.collection_name)
         return self
 
     def _create_from_mongo_entry(self, entry):
@@ -124,6 +201,7 @@ class DatabaseClassObj:
 
     def _create_from_script(self, entry):
         self.mongo_helper.db[self.collection_name].insert_one(dict(entry))
+        self.mongo_helper.increment_counter(self.collection_name)
         return self
 
     def update_in_db(self):
@@ -134,17 +212,19 @@ class DatabaseClassObj:
             self.mongo_helper.db[self.collection_name].update_one({"_id": ObjectId(self["_id"])},
                                                                   self.mongo_update_dict())
         else:
-            self.mongo_helper.db[self.collection_name].update_one({self.id_field, self[self.id_field]},
+            self.mongo_helper.db[self.collection_name].update_one({self.id_field: self[self.id_field]},
                                                                   self.mongo_update_dict())
+        self.mongo_helper.bump_collection_version(self.collection_name)
 
     def update_from_request(self, request):
         if "_id" not in self and self.id_field not in self:
             raise MissingAttributeException("_id")
 
         for k, v in request.json.items():
-            if k in self.__fields__():
+            if k in self.schema().field_set:
                 self.__setattr__(k, v)
         self.update_in_db()
+        self.mongo_helper.invalidate_lookup_cache(self.collection_name)
 
 
     def delete(self):
@@ -152,47 +232,132 @@ class DatabaseClassObj:
             raise MissingAttributeException("_id")
 
         if "_id" in self:
-            self.mongo_helper.db[self.collection_name].update_one({"_id": ObjectId(self["_id"])},
-                                                                  {"$set": {DELETED_FIELD: True}})
+            query = {"_id": ObjectId(self["_id"])}
         else:
-            self.mongo_helper.db[self.collection_name].update_one({self.id_field, self[self.id_field]},
-                                                                  {"$set": {DELETED_FIELD: True}})
-
-    def search(self, query_regex, return_objects=False):
-        resultset = self.mongo_helper.db[self.collection_name].find(
-            {'$and': [
-                {DELETED_FIELD: {"$exists": False}},
-                {"$or": [
-                    {field: {'$regex': query_regex, '$options': 'i'}}
-                    for field in self.search_fields
-                ]}
+            query = {self.id_field: self[self.id_field]}
+        query[DELETED_FIELD] = {"$exists": False}
+        updated = self.mongo_helper.db[self.collection_name].update_one(query, {"$set": {DELETED_FIELD: True}})
+        self.mongo_helper.increment_counter(self.collection_name, -updated.modified_count)
+        self.mongo_helper.invalidate_lookup_cache(self.collection_name)
+        self.mongo_helper.bump_collection_version(self.collection_name)
+
+    def _regex_query(self, query_regex):
+        return {'$and': [
+            {DELETED_FIELD: {"$exists": False}},
+            {"$or": [
+                {field: {'$regex': query_regex, '$options': 'i'}}
+                for field in self.search_fields
             ]}
+        ]}
+
+    def _regex_search(self, query_regex, projection=None):
+        return self.mongo_helper.db[self.collection_name].find(
+            self._regex_query(query_regex),
+            projection or self.schema().projection
            )
-        objects = (self.__class__(self.mongo_helper)._create_from_mongo_entry(x) for x in resultset)
+
+    def _text_query(self, query):
+        return {"$text": {"$search": query}, DELETED_FIELD: {"$exists": False}}
+
+    def _text_search(self, query, projection=None):
+        return self.mongo_helper.db[self.collection_name].find(
+            self._text_query(query),
+            dict(projection or self.schema().projection, score={"$meta": "textScore"})
+        ).sort([("score", {"$meta": "textScore"})])
+
+    def _iter_text_search(self, query, limit, projection=None):
+        # $text fails on the first batch when the text index was not created yet, fall back to regex in that case
+        try:
+            for x in self._text_search(query, projection).limit(limit).batch_size(self.stream_batch_size):
+                yield x
+        except OperationFailure as e:
+            if e.code != 27:  # IndexNotFound
+                raise
+            for x in self._regex_search(query, projection).limit(limit).batch_size(self.stream_batch_size):
+                yield x
+
+    def iter_search(self, query_regex, return_objects=False, mode=None, limit=None, fields=None):
+        """
+        limit=None uses default_search_limit and limit=0 returns every match
+        """
+        mode = mode or self.default_search_mode
+        if limit is None:
+            limit = self.default_search_limit
+        projection = self.projection_for(fields)
+
+        if mode == SEARCH_MODE_TEXT:
+            query = self._text_query(query_regex)
+            resultset = self._iter_text_search(query_regex, limit, projection)
+            explain = lambda: self._text_search(query_regex, projection).limit(limit).explain()
+        elif mode == SEARCH_MODE_REGEX:
+            query = self._regex_query(query_regex)
+            resultset = self._regex_search(query_regex, projection).limit(limit).batch_size(self.stream_batch_size)
+            explain = lambda: self._regex_search(query_regex, projection).limit(limit).explain()
+        else:
+            raise ValueError("Invalid search mode %s" % mode)
+        resultset = self.mongo_helper.slow_queries.track("%s.search" % self.__class__.__name__, self.collection_name,
+                                                         query, resultset, explain)
+
         if return_objects:
-            return list(objects)
-        return list(dict(o) for o in objects)
+            return (self.__class__(self.mongo_helper)._create_from_mongo_entry(x) for x in resultset)
+        return (self.serialize_document(x) for x in resultset)
+
+    def search(self, query_regex, return_objects=False, mode=None, limit=None, fields=None):
+        return list(self.iter_search(query_regex, return_objects, mode, limit, fields))
 
-    def get_all(self):
+    def iter_all(self, fields=None):
         resultset = self.mongo_helper.db[self.collection_name].find(
-            {DELETED_FIELD: {"$exists": False}}
-        )
-        objects = (self.__class__(self.mongo_helper)._create_from_mongo_entry(x) for x in resultset)
-        return list(dict(o) for o in objects)
+            {DELETED_FIELD: {"$exists": False}}, self.projection_for(fields)
+        ).batch_size(self.stream_batch_size)
+        return (self.serialize_document(x) for x in resultset)
+
+    def get_all(self, fields=None):
+        return list(self.iter_all(fields))
 
-    def count(self):
-        return self.mongo_helper.db[self.collection_name].find({DELETED_FIELD: {"$exists": False}}).count()
+    def count_documents(self):
+        return self.mongo_helper.db[self.collection_name].count_documents({DELETED_FIELD: {"$exists": False}})
+
+    def count(self, estimated=False):
+        # Live documents, soft deleted ones are left out. estimated is only honoured where it means the same (Event),
+        # the collection metadata counts soft deleted documents too
+        if not self.counted:
+            return self.count_documents()
+        return self.mongo_helper.get_counter(self.collection_name, self.count_documents)
 
 
 class Item(DatabaseClassObj):
     collection_name = "item"
     fields = ["description", "name", "tags",
               "default_storage_location", "location_blacklist",
-              "location_whitelist", "item_id"]
+              "location_whitelist", "item_id", "zone_blacklist",
+              "zone_whitelist", "allowed_time_windows"]
     id_field = "item_id"
     unique_fields = ["item_id", "tags"]
     required_fields = ["name", "item_id", "tags"]
     search_fields = ["name", "item_id", "description", "tags"]
+    indexes = [
+        {"keys": [("item_id", 1), (DELETED_FIELD, 1)]},
+        {"keys": [("tags", 1), (DELETED_FIELD, 1)]},
+        {"keys": [(field, "text") for field in search_fields], "name": TEXT_INDEX_NAME, "default_language": "none",
+         "weights": {"name": 10, "item_id": 10, "tags": 10, "description": 1}},
+    ]
+    default_search_mode = SEARCH_MODE_TEXT
+
+    @staticmethod
+    def validate_request(request):
+        # Malformed time windows would otherwise only fail later, when the location rules of the item are compiled
+        try:
+            parse_time_windows(request.json.get('allowed_time_windows'))
+        except ValueError as e:
+            raise ValueError("attribute allowed_time_windows is present, but invalid: %s" % e)
+
+    def create_from_request(self, request):
+        self.validate_request(request)
+        return super(Item, self).create_from_request(request)
+
+    def update_from_request(self, request):
+        self.validate_request(request)
+        return super(Item, self).update_from_request(request)
 
 
 class Map(DatabaseClassObj):
@@ -202,6 +367,9 @@ class Map(DatabaseClassObj):
     unique_fields = ["image_link", "name"]
     required_fields = ["name", "image_link"]
     search_fields = ["name", "image_link"]
+    indexes = [
+        {"keys": [("name", 1), (DELETED_FIELD, 1)]},
+    ]
 
 
 class Sensor(DatabaseClassObj):
@@ -212,6 +380,25 @@ class Sensor(DatabaseClassObj):
     unique_fields = ["sensor_id"]
     required_fields = ["name", "sensor_id"]
     search_fields = ["name", "sensor_id", "description", "tag"]
+    indexes = [
+        {"keys": [("sensor_id", 1), (DELETED_FIELD, 1)]},
+        {"keys": [(field, "text") for field in search_fields], "name": TEXT_INDEX_NAME, "default_language": "none",
+         "weights": {"name": 10, "sensor_id": 10, "tag": 5, "description": 1}},
+    ]
+    default_search_mode = SEARCH_MODE_TEXT
+
+
+class Zone(DatabaseClassObj):
+    # Named group of sensors, usable on item zone_blacklist/zone_whitelist location rules
+    collection_name = "zone"
+    fields = ["zone_id", "name", "sensors", "description"]
+    id_field = "zone_id"
+    unique_fields = ["zone_id"]
+    required_fields = ["zone_id", "name", "sensors"]
+    search_fields = ["zone_id", "name", "description"]
+    indexes = [
+        {"keys": [("zone_id", 1), (DELETED_FIELD, 1)]},
+    ]
 
 
 USER_ACCESS_LIMITED = 2
@@ -234,6 +421,9 @@ class User(DatabaseClassObj):
     required_fields = ["name", "email", "access"]
     search_fields = ["email", "name", "creation_date",
                      "access"]
+    indexes = [
+        {"keys": [("email", 1), (DELETED_FIELD, 1)]},
+    ]
 
     acceptable_access = [USER_ACCESS_LIMITED, USER_ACCESS_DEFAULT, USER_ACCESS_MASTER]
 
@@ -258,6 +448,8 @@ class User(DatabaseClassObj):
         self._create_from_mongo_entry(entry)
         inserted = self.mongo_helper.db[self.collection_name].insert_one(dict(self))
         self["_id"] = inserted.inserted_id
+        self.mongo_helper.increment_counter(self.collection_name)
+        self.mongo_helper.bump_collection_version(self.collection_name)
         return self
 
 
@@ -270,8 +462,19 @@ class Event(DatabaseClassObj):
     required_fields = ["received_timestamp", "event_timestamp", "event_details",
                        "sensor_id", "tag_id"]
     search_fields = ["event_details", "sensor_id", "item_id", "tag_id"]
-
-    def filter_events(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None):
+    indexes = [
+        {"keys": [("event_timestamp", -1)], "unique": True,
+         "partial": {"event_timestamp": {"$exists": True}}},
+        {"keys": [("event_timestamp", -1), ("_id", -1)]},
+        {"keys": [("item_id", 1), ("event_timestamp", -1), ("_id", -1)]},
+        {"keys": [("sensor_id", 1), ("event_timestamp", -1), ("_id", -1)]},
+        {"keys": [("alert", 1), ("event_timestamp", -1)], "partial": {"alert": {"$exists": True}}},
+    ]
+
+    # Keys per aggregation in last_events_by, each one past the first adds a $unionWith stage
+    last_events_chunk_size = 100
+
+    def filter_query(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, alert_only=None, cursor=None):
         filters = []
         if alert_only:
             filters.append({"alert": {"$exists": True}})
@@ -298,46 +501,381 @@ class Event(DatabaseClassObj):
 
             filters.append({'event_timestamp': filter_event})
 
+        if cursor:
+            filters.append(self.cursor_query(cursor))
+
         q = {}
         if filters:
             q['$and'] = filters
-
-        q = self.mongo_helper.db[self.collection_name].find(q).sort([("event_timestamp", -1)])
+        return q
+
+    @staticmethod
+    def encode_cursor(event):
+        payload = json.dumps({"t": event["event_timestamp"], "id": str(event["_id"])})
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            return payload["t"], ObjectId(payload["id"])
+        except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError, bson.errors.InvalidId):
+            raise ValueError("Invalid cursor %s" % cursor)
+
+    def cursor_query(self, cursor):
+        # Keyset condition for the (event_timestamp, _id) descending order: everything after the cursor position
+        event_timestamp, _id = self.decode_cursor(cursor)
+        return {"$or": [
+            {"event_timestamp": {"$lt": event_timestamp}},
+            {"event_timestamp": event_timestamp, "_id": {"$lt": _id}}
+        ]}
+
+    @staticmethod
+    def parse_page(limit, skip):
+        """
+        limit and skip of a request, from the query string or a JSON body, as non-negative ints.
+        """
+        page = []
+        for name, value in (("limit", limit), ("skip", skip)):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = -1
+            if value < 0:
+                raise ValueError("%s must be a non-negative integer" % name)
+            page.append(value)
+        return tuple(page)
+
+    def next_cursor(self, events, limit):
+        if not limit or len(events) < limit:
+            return None
+        return self.encode_cursor(events[-1])
+
+    def source_pipeline(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, alert_only=None, cursor=None):
+        """
+        Returns (collection, stages) where the stages output the matching events as plain event documents, whatever
+        the configured event storage layout is.
+        """
+        storage = self.mongo_helper.event_storage
+        q = self.filter_query(sensor_id, item_id, start_timestamp_range, end_timestamp_range, alert_only, cursor)
+        if cursor and end_timestamp_range is None:
+            end_timestamp_range = self.decode_cursor(cursor)[0]
+        stages = storage.source_stages(q, sensor_id, item_id, start_timestamp_range, end_timestamp_range)
+        return self.mongo_helper.db[storage.collection_name], stages
+
+    def events_pipeline(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        # The aggregation behind iter_events, also run by the asyncio read path
+        collection, pipeline = self.source_pipeline(sensor_id, item_id, start_timestamp_range, end_timestamp_range,
+                                                    alert_only, cursor)
+        pipeline.append({"$sort": {"event_timestamp": -1, "_id": -1}})
         if skip:
-            q.skip(skip)
+            pipeline.append({"$skip": skip})
         if limit:
-            q.limit(limit)
-
-        objects = (self.__class__(self.mongo_helper)._create_from_mongo_entry(x) for x in q)
-        return list(dict(o) for o in objects)
-
-
-class Token(DatabaseClassObj):
-    collection_name = "token"
-    fields = ["last_modified", "token", "user_data", "access_level"]
-    id_field = "token"
-    unique_fields = ["token"]
-    required_fields = ["token", "user_data", "access_level"]
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$project": dict(self.projection_for(fields))})
+        return collection, pipeline
+
+    def iter_events(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        collection, pipeline = self.events_pipeline(sensor_id, item_id, start_timestamp_range, end_timestamp_range,
+                                                    limit, skip, alert_only, cursor, fields)
+        resultset = collection.aggregate(pipeline, batchSize=self.stream_batch_size)
+        resultset = self.mongo_helper.slow_queries.track(
+            "Event.filter_events", collection.name, pipeline, resultset,
+            lambda: self.mongo_helper.db.command("explain", {"aggregate": collection.name, "pipeline": pipeline,
+                                                             "cursor": {}}, verbosity="executionStats"))
+        return (self.serialize_document(x) for x in resultset)
+
+    def filter_events(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        return list(self.iter_events(sensor_id, item_id, start_timestamp_range, end_timestamp_range, limit, skip,
+                                     alert_only, cursor, fields))
+
+    def filter_events_with_details(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        """
+        Same as filter_events, but each event also carries its "sensor" and "item" documents, joined on the server
+        with $lookup so a page costs a single round trip. Deleted or missing sensors/items are returned as None.
+        When fields is given, "sensor" and "item" must be listed for the respective join to run.
+        """
+        return list(self.iter_events_with_details(sensor_id, item_id, start_timestamp_range, end_timestamp_range,
+                                                  limit, skip, alert_only, cursor, fields))
+
+    def iter_events_with_details(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None, limit=None, skip=0, alert_only=None, cursor=None, fields=None):
+        joins = ((Sensor, "sensor", "sensor_id"), (Item, "item", "item_id"))
+        if fields is not None:
+            joins = tuple(x for x in joins if x[1] in fields)
+            fields = [x for x in fields if x not in ("sensor", "item")]
+        projection = dict(self.projection_for(fields))
+
+        collection, pipeline = self.source_pipeline(sensor_id, item_id, start_timestamp_range, end_timestamp_range,
+                                                    alert_only, cursor)
+        pipeline.append({"$sort": {"event_timestamp": -1, "_id": -1}})
+        if skip:
+            pipeline.append({"$skip": skip})
+        if limit:
+            pipeline.append({"$limit": limit})
+
+        for cls, field, local_field in joins:
+            # every document with the id, including soft deleted ones (DELETED_FIELD is part of the schema), the
+            # first live one is picked below
+            pipeline.append({"$lookup": {"from": cls.collection_name, "localField": local_field,
+                                         "foreignField": cls.id_field, "as": field}})
+            projection.update({"%s.%s" % (field, x): 1 for x in cls.schema().fields})
+        pipeline.append({"$project": projection})
+
+        resultset = collection.aggregate(pipeline, batchSize=self.stream_batch_size)
+        for entry in resultset:
+            joined = {field: next((x for x in entry.pop(field, None) or [] if not x.get(DELETED_FIELD)), None)
+                      for _, field, _ in joins}
+            event = self.serialize_document(entry)
+            for cls, field, _ in joins:
+                event[field] = cls.serialize_document(joined[field]) if joined[field] else None
+            yield event
+
+    def last_events_by(self, key_field, keys, limit=None, skip=0):
+        """
+        Returns {key: [events]} with the most recent events of each key (sensor_id or item_id), honouring limit and
+        skip per key. Every key is read by its own sorted and limited branch, through the key's index, and the
+        branches are chained with $unionWith, so a round trip serves last_events_chunk_size keys and the work per key
+        is bounded by skip + limit events whatever the size of its history.
+        """
+        storage = self.mongo_helper.event_storage
+        count = (skip or 0) + limit if limit else None
+        keys = list(dict.fromkeys(keys))
+        results = {}
+        for start in range(0, len(keys), self.last_events_chunk_size):
+            chunk = keys[start:start + self.last_events_chunk_size]
+            bounds = storage.latest_bounds(key_field, chunk, count)
+            branches = []
+            for key in chunk:
+                branch = storage.latest_stages(self.filter_query(**{key_field: key}), count=count,
+                                               start_timestamp=bounds.get(key), **{key_field: key})
+                if skip:
+                    branch.append({"$skip": skip})
+                if limit:
+                    branch.append({"$limit": limit})
+                branch.append({"$project": self.schema().projection})
+                branches.append(branch)
+            pipeline = union_pipeline(storage.collection_name, branches)
+            for x in self.mongo_helper.db[storage.collection_name].aggregate(pipeline):
+                results.setdefault(x.get(key_field), []).append(self.serialize_document(x))
+        return results
+
+    def hourly_counts(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None):
+        """
+        Number of events per hour (epoch seconds of the start of the hour), read from the event_hourly rollups.
+        """
+        return EventHourly(self.mongo_helper).hourly_counts(sensor_id, item_id, start_timestamp_range,
+                                                            end_timestamp_range)
+
+    def count_documents(self):
+        return self.mongo_helper.event_storage.count()
+
+    def count(self, estimated=False):
+        # Events are never soft deleted, so when each event is its own document the collection metadata is their count
+        if estimated and self.mongo_helper.event_storage.collection_name == self.collection_name:
+            return self.mongo_helper.db[self.collection_name].estimated_document_count()
+        return super(Event, self).count()
+
+
+class EventBucket(DatabaseClassObj):
+    """
+    Events grouped per (sensor, hour) by database.event_storage.BucketEventStorage, only used when
+    [mongodb] event_storage = bucket. Declared here so ensure_indexes creates its indexes.
+    """
+    collection_name = "event_bucket"
+    fields = ["sensor_id", "hour", "count", "item_ids", "events"]
+    id_field = "_id"
+    unique_fields = []
+    required_fields = ["sensor_id", "hour"]
     search_fields = []
+    counted = False
+    indexes = [
+        {"keys": [("sensor_id", 1), ("hour", -1), ("count", 1)]},
+        {"keys": [("item_ids", 1), ("hour", -1)]},
+        {"keys": [("hour", -1)]},
+        {"keys": [("events.event_timestamp", 1)]},
+    ]
+
+
+class EventHourly(DatabaseClassObj):
+    """
+    Number of events per (sensor, item, hour), upserted by MongoHelper.update_hourly_rollups on every ingested event.
+    """
+    collection_name = "event_hourly"
+    fields = ["sensor_id", "item_id", "hour", "count"]
+    id_field = "_id"
+    unique_fields = []
+    required_fields = ["sensor_id", "hour", "count"]
+    search_fields = []
+    counted = False
+    indexes = [
+        {"keys": [("sensor_id", 1), ("item_id", 1), ("hour", -1)], "unique": True},
+        {"keys": [("item_id", 1), ("hour", -1)]},
+        {"keys": [("hour", -1)]},
+    ]
+
+    def rollup_query(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None):
+        # Rollups are per hour, so the range is widened to the hours containing its bounds
+        filters = {}
+        if sensor_id is not None:
+            filters["sensor_id"] = {"$in": sensor_id} if isinstance(sensor_id, list) else sensor_id
+        if item_id is not None:
+            filters["item_id"] = {"$in": item_id} if isinstance(item_id, list) else item_id
+        hours = {}
+        if hour_of(start_timestamp_range) is not None:
+            hours["$gte"] = hour_of(start_timestamp_range)
+        if hour_of(end_timestamp_range) is not None:
+            hours["$lte"] = hour_of(end_timestamp_range)
+        if hours:
+            filters["hour"] = hours
+        return filters
+
+    def hourly_counts(self, sensor_id=None, item_id=None, start_timestamp_range=None, end_timestamp_range=None):
+        resultset = self.mongo_helper.db[self.collection_name].aggregate([
+            {"$match": self.rollup_query(sensor_id, item_id, start_timestamp_range, end_timestamp_range)},
+            {"$group": {"_id": "$hour", "count": {"$sum": "$count"}}},
+            {"$sort": {"_id": 1}}
+        ])
+        return [{"hour": x["_id"], "count": x["count"]} for x in resultset]
+
+
+class ItemLocation(DatabaseClassObj):
+    """
+    Materialized last known position of each item, upserted by MongoHelper.update_item_locations on every ingested
+    event so "where is item X now" doesn't need to sort the event collection. alert is the newest alert of the item
+    (raised by alert_event_id at alert_timestamp) until it is marked read, whatever the events after it.
+    """
+    collection_name = "item_location"
+    fields = ["item_id", "sensor_id", "tag_id", "last_seen", "event_id", "alert", "alert_event_id", "alert_timestamp"]
+    object_id_fields = ("event_id", "alert_event_id")
+    id_field = "item_id"
+    unique_fields = ["item_id"]
+    required_fields = ["item_id", "sensor_id", "last_seen"]
+    search_fields = []
+    counted = False
+    indexes = [
+        {"keys": [("item_id", 1)], "unique": True},
+        {"keys": [("sensor_id", 1), ("last_seen", -1)]},
+        {"keys": [("alert", 1)], "partial": {"alert": {"$type": "number"}}},
+    ]
 
-    def check_token_ttl(self):
-        self.mongo_helper.db[self.collection_name].create_index(
-           "last_modified", expireAfterSeconds=24*60*60, name="last_modified_ttl")
-
-    def create_from_request(self, request):
-        raise NotImplementedError()
-
-    def create_token_from_user_data(self, user_data):
-        self.check_token_ttl()
-        self['last_modified'] = datetime.now()
-        self['user_data'] = user_data
-        self['access_level'] = user_data["access"]
-        self['token'] = str(uuid.uuid4())
+    def __iter__(self):
+        for field, value in super(ItemLocation, self).__iter__():
+            if field in self.object_id_fields and value is not None:
+                value = str(value)
+            yield field, value
+
+    @classmethod
+    def serialize_document(cls, doc):
+        result = super(ItemLocation, cls).serialize_document(doc)
+        for field in cls.object_id_fields:
+            if result.get(field) is not None:
+                result[field] = str(result[field])
+        return result
+
+    def mark_alert_read(self):
+        # alert_timestamp is kept, update_item_locations only opens a newer alert
+        self.mongo_helper.db[self.collection_name].update_one({"item_id": self["item_id"]},
+                                                              {"$set": {"alert": None, "alert_event_id": None}})
+        self["alert"] = None
+        self["alert_event_id"] = None
+
+    def iter_locations(self, sensor_id=None, alert_only=None):
+        filters = {}
+        if sensor_id is not None:
+            filters["sensor_id"] = {"$in": sensor_id} if isinstance(sensor_id, list) else sensor_id
+        if alert_only:
+            filters["alert"] = {"$type": "number"}
+        resultset = self.mongo_helper.db[self.collection_name].find(
+            filters, self.schema().projection).batch_size(self.stream_batch_size)
+        return (self.serialize_document(x) for x in resultset)
+
+    def rebuild(self):
+        """
+        Backfills the collection from the event history, for data ingested before it existed. Alerts already marked
+        read stay read: the stored alert is only replaced by a newer one.
+        """
+        collection, pipeline = Event(self.mongo_helper).source_pipeline()
+        is_newer_alert = {"$lt": [{"$ifNull": ["$alert_timestamp", None]}, "$$new.alert_timestamp"]}
+        collection.aggregate(pipeline + [
+            {"$match": {"item_id": {"$ne": None}}},
+            {"$sort": {"item_id": 1, "event_timestamp": -1}},
+            {"$group": {
+                "_id": "$item_id",
+                "sensor_id": {"$first": "$sensor_id"},
+                "tag_id": {"$first": "$tag_id"},
+                "last_seen": {"$first": "$event_timestamp"},
+                "event_id": {"$first": "$_id"},
+                # documents compare field by field, so this is the alert with the highest event_timestamp
+                "last_alert": {"$max": {"$cond": [{"$gt": ["$alert", None]},
+                                                  {"t": "$event_timestamp", "alert": "$alert", "id": "$_id"}, None]}}
+            }},
+            {"$project": {"_id": 0, "item_id": "$_id", "sensor_id": 1, "tag_id": 1, "last_seen": 1, "event_id": 1,
+                          "alert": {"$ifNull": ["$last_alert.alert", None]}, "alert_event_id": "$last_alert.id",
+                          "alert_timestamp": "$last_alert.t"}},
+            {"$merge": {"into": self.collection_name, "on": "item_id", "whenNotMatched": "insert", "whenMatched": [
+                {"$set": dict({k: "$$new." + k for k in ("sensor_id", "tag_id", "last_seen", "event_id")}, **{
+                    k: {"$cond": [is_newer_alert, "$$new." + k, "$" + k]}
+                    for k in ("alert", "alert_event_id", "alert_timestamp")
+                })}
+            ]}}
+        ], allowDiskUse=True)
+
+
+class Token(RedisObject):
+    key_prefix = "token"
+    # Sliding expiration, renewed on every authenticated request
+    expiration_time = 24*60*60
+
+    def __init__(self, token=None, user_data=None, access_level=None, last_modified=None):
+        self.token = token
+        self.user_data = user_data
+        self.access_level = access_level
+        self.last_modified = last_modified
 
-        inserted = self.mongo_helper.db[self.collection_name].insert_one(dict(self))
-        self["_id"] = inserted.inserted_id
-        return self['token']
+    @property
+    def id(self):
+        return self.token
+
+    def to_dict(self):
+        return {
+            "token": self.token,
+            "user_data": json.dumps(self.user_data, default=str),
+            "access_level": self.access_level,
+            "last_modified": self.last_modified.isoformat()
+        }
+
+    def from_dict(self, d):
+        self.token = d["token"]
+        self.user_data = json.loads(d["user_data"])
+        self.access_level = int(d["access_level"])
+        self.last_modified = datetime.fromisoformat(d["last_modified"])
+        return self
 
-    def update_token(self):
-        self['last_modified'] = datetime.now()
-        self.update_in_db()
\ No newline at end of file
+    @classmethod
+    def load(cls, helper: RedisHelper, object_id):
+        d = helper.get_hash(cls.key_prefix, object_id, new_expiration_time=cls.expiration_time)
+        if not d:
+            raise ValueError("Token %s not found or expired" % object_id)
+        return cls().from_dict(d)
+
+    @classmethod
+    def get_access_level(cls, helper: RedisHelper, object_id):
+        # Only the access level is read on authorization, so the user data doesn't need to be decoded
+        access_level = helper.get_hash_field("access_level", cls.key_prefix, object_id,
+                                             new_expiration_time=cls.expiration_time)
+        if access_level is None:
+            raise ValueError("Token %s not found or expired" % object_id)
+        return int(access_level)
+
+    def save(self, helper: RedisHelper):
+        helper.set_hash(self.to_dict(), self.key_prefix, self.token, expiration_time=self.expiration_time)
+
+    def delete(self, helper: RedisHelper):
+        helper.delete(self.key_prefix, self.token)
+
+    @classmethod
+    def create_token_from_user_data(cls, helper: RedisHelper, user_data):
+        token = cls(token=str(uuid.uuid4()), user_data=user_data, access_level=user_data["access"],
+                    last_modified=datetime.now())
+        token.save(helper)
+        return token.token
@@ -0,0 +1,31 @@
+import uuid
+
+from database.redis_helper import RedisHelper
+
+
+class CollectionVersions:
+    """
+    Version stamp of each collection, kept in Redis so every API process sees the same value. A stamp is a random
+    token replaced on every write (DatabaseClassObj.create_from_request, update_in_db and delete), so it can't repeat
+    an older value even if Redis loses its data. Stamps also expire after ttl seconds, which bounds how long writes
+    that don't go through the API (scripts, the mongo shell) are hidden behind a 304.
+    """
+    key_prefix = "collection_version"
+
+    def __init__(self, redis_helper: RedisHelper, ttl=300):
+        self.redis_helper = redis_helper
+        self.ttl = ttl
+
+    def get(self, collection_name):
+        version = self.redis_helper.get(self.key_prefix, collection_name)
+        if version is None:
+            return self.bump(collection_name)
+        return version
+
+    def get_many(self, collection_names):
+        return [self.get(x) for x in collection_names]
+
+    def bump(self, collection_name):
+        version = uuid.uuid4().hex
+        self.redis_helper.set(version, self.key_prefix, collection_name, expiration_time=self.ttl)
+        return version
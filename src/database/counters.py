@@ -0,0 +1,65 @@
+import os
+import threading
+
+from database.indexes import DATABASE_CLASSES
+from database.mongo_helper import MongoHelper
+from database.redis_helper import RedisHelper
+
+
+def reconcile_counters(mongo_helper: MongoHelper, classes=None):
+    """
+    Recounts every counted collection (live documents, soft deleted ones are left out like delete() does) and
+    corrects its counter, fixing drift from writes made outside the DatabaseClassObj/MongoHelper paths. The correction
+    is an $inc relative to the counter read before the recount, so increments made while counting are kept.
+    Returns {collection: (counter, actual)} for the counters that were off.
+    """
+    drift = {}
+    for cls in classes or DATABASE_CLASSES:
+        if not cls.counted:
+            continue
+        obj = cls(mongo_helper)
+        counter = obj.count()
+        actual = obj.count_documents()
+        if counter != actual:
+            mongo_helper.increment_counter(cls.collection_name, actual - counter)
+            drift[cls.collection_name] = (counter, actual)
+    return drift
+
+
+class CounterReconciler(threading.Thread):
+    """
+    Started by every API worker. Each round takes an expiring Redis lock first, so a single process recounts per
+    interval instead of every worker scanning the collections.
+    """
+    lock_key = "counters_reconcile_lock"
+
+    def __init__(self, mongo_helper: MongoHelper, redis_helper: RedisHelper, interval=3600):
+        super().__init__(daemon=True)
+        self.mongo_helper = mongo_helper
+        self.redis_helper = redis_helper
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def reconcile(self):
+        # None when another process holds the lock of the current interval
+        if not self.redis_helper.set_if_absent(os.getpid(), self.lock_key, expiration_time=self.interval):
+            return None
+        return reconcile_counters(self.mongo_helper)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                drift = self.reconcile()
+                if drift:
+                    print("Counters reconciled: %s" % drift)
+            except Exception as e:
+                print("Counter reconciliation failed: %s" % e)
+
+
+if __name__ == "__main__":
+    from config import Parser
+
+    print(reconcile_counters(MongoHelper.init_from_config(Parser())))
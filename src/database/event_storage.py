@@ -0,0 +1,181 @@
+from collections import OrderedDict
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+EVENT_STORAGE_DOCUMENT = "document"
+EVENT_STORAGE_BUCKET = "bucket"
+
+HOUR = 60 * 60
+
+
+def hour_of(timestamp):
+    # Start of the hour of an epoch timestamp, None for timestamps that aren't numeric
+    try:
+        return int(float(timestamp) // HOUR * HOUR)
+    except (TypeError, ValueError):
+        return None
+
+
+def union_pipeline(collection_name, branches):
+    # Runs the first branch and appends the output of each following one, all on collection_name
+    pipeline = list(branches[0])
+    for branch in branches[1:]:
+        pipeline.append({"$unionWith": {"coll": collection_name, "pipeline": branch}})
+    return pipeline
+
+
+def event_hour(event):
+    hour = hour_of(event["event_timestamp"])
+    return hour if hour is not None else hour_of(event["inserted_timestamp"])
+
+
+class DocumentEventStorage:
+    """
+    One document per RFID read in the event collection.
+    """
+    collection_name = "event"
+
+    def __init__(self, mongo_helper):
+        self.mongo_helper = mongo_helper
+
+    def existing_timestamps(self, event_timestamps):
+        return set(x["event_timestamp"] for x in self.mongo_helper.db[self.collection_name].find(
+            {"event_timestamp": {"$in": list(event_timestamps)}}, {"event_timestamp": 1, "_id": 0}))
+
+    def insert_many(self, events):
+        """
+        Returns the indexes (in the given list) of the events that were rejected as duplicates by the database.
+        """
+        duplicated = set()
+        try:
+            self.mongo_helper.db[self.collection_name].insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") != 11000:
+                    raise
+                duplicated.add(error["index"])
+        return duplicated
+
+    def source_stages(self, event_query, sensor_id=None, item_id=None, start_timestamp=None, end_timestamp=None):
+        # Aggregation stages that output the events matching event_query as plain event documents. The other
+        # arguments let layouts that group events skip whole groups before looking at each event
+        return [{"$match": event_query}]
+
+    def latest_bounds(self, key_field, keys, count):
+        # {key: start_timestamp} narrowing latest_stages, not needed when every event has its own index entry
+        return {}
+
+    def latest_stages(self, event_query, sensor_id=None, item_id=None, count=None, start_timestamp=None):
+        # Stages that output the newest count events matching event_query, newest first, reading only those
+        stages = [{"$match": event_query}, {"$sort": {"event_timestamp": -1, "_id": -1}}]
+        if count:
+            stages.append({"$limit": count})
+        return stages
+
+    def count(self):
+        return self.mongo_helper.db[self.collection_name].count_documents({})
+
+
+class BucketEventStorage:
+    """
+    Events grouped in one document per (sensor, hour), holding up to max_bucket_size reads. Each event keeps its own
+    _id inside the bucket, so ids and cursors behave as in the document layout.
+    """
+    collection_name = "event_bucket"
+
+    def __init__(self, mongo_helper, max_bucket_size=1000):
+        self.mongo_helper = mongo_helper
+        self.max_bucket_size = max_bucket_size
+
+    def existing_timestamps(self, event_timestamps):
+        event_timestamps = list(event_timestamps)
+        resultset = self.mongo_helper.db[self.collection_name].aggregate([
+            {"$match": {"events.event_timestamp": {"$in": event_timestamps}}},
+            {"$unwind": "$events"},
+            {"$match": {"events.event_timestamp": {"$in": event_timestamps}}},
+            {"$project": {"_id": 0, "event_timestamp": "$events.event_timestamp"}}
+        ])
+        return set(x["event_timestamp"] for x in resultset)
+
+    def insert_many(self, events):
+        buckets = OrderedDict()
+        for event in events:
+            event.setdefault("_id", ObjectId())
+            buckets.setdefault((event["sensor_id"], event_hour(event)), []).append(event)
+
+        operations = []
+        for (sensor_id, hour), bucket_events in buckets.items():
+            for i in range(0, len(bucket_events), self.max_bucket_size):
+                chunk = bucket_events[i:i + self.max_bucket_size]
+                # A full bucket doesn't match the filter, so the upsert opens a new one for the same hour
+                operations.append(UpdateOne(
+                    {"sensor_id": sensor_id, "hour": hour, "count": {"$lte": self.max_bucket_size - len(chunk)}},
+                    {
+                        "$push": {"events": {"$each": chunk}},
+                        "$inc": {"count": len(chunk)},
+                        "$addToSet": {"item_ids": {"$each": list(set(x["item_id"] for x in chunk))}},
+                    },
+                    upsert=True))
+        if operations:
+            self.mongo_helper.db[self.collection_name].bulk_write(operations, ordered=False)
+        # Duplicates are filtered by existing_timestamps before inserting, buckets can't enforce a unique index
+        return set()
+
+    def source_stages(self, event_query, sensor_id=None, item_id=None, start_timestamp=None, end_timestamp=None):
+        bucket_query = {}
+        if sensor_id is not None:
+            bucket_query["sensor_id"] = {"$in": sensor_id} if isinstance(sensor_id, list) else sensor_id
+        if item_id is not None:
+            bucket_query["item_ids"] = {"$in": item_id} if isinstance(item_id, list) else item_id
+        hours = {}
+        if hour_of(start_timestamp) is not None:
+            hours["$gte"] = hour_of(start_timestamp)
+        if hour_of(end_timestamp) is not None:
+            hours["$lte"] = hour_of(end_timestamp)
+        if hours:
+            bucket_query["hour"] = hours
+        return [
+            {"$match": bucket_query},
+            {"$unwind": "$events"},
+            {"$replaceRoot": {"newRoot": "$events"}},
+            {"$match": event_query}
+        ]
+
+    def latest_bounds(self, key_field, keys, count):
+        """
+        {key: hour} with the hour of the count-th newest bucket of each key (sensor_id or item_id) that has more
+        buckets than that. Every bucket of a key holds at least one of its events, so its newest count events are in
+        that hour or later ones, including the other buckets of the same hour.
+        """
+        if not count:
+            return {}
+        bucket_field = "item_ids" if key_field == "item_id" else key_field
+        pipeline = union_pipeline(self.collection_name, [[
+            {"$match": {bucket_field: key}},
+            {"$sort": {"hour": -1}},
+            {"$skip": count - 1},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "key": {"$literal": key}, "hour": 1}}
+        ] for key in keys])
+        return {x["key"]: x["hour"] for x in self.mongo_helper.db[self.collection_name].aggregate(pipeline)}
+
+    def latest_stages(self, event_query, sensor_id=None, item_id=None, count=None, start_timestamp=None):
+        stages = self.source_stages(event_query, sensor_id, item_id, start_timestamp)
+        stages.append({"$sort": {"event_timestamp": -1, "_id": -1}})
+        if count:
+            stages.append({"$limit": count})
+        return stages
+
+    def count(self):
+        resultset = list(self.mongo_helper.db[self.collection_name].aggregate([{"$group": {"_id": None, "count": {"$sum": "$count"}}}]))
+        return resultset[0]["count"] if resultset else 0
+
+
+def build_event_storage(mongo_helper, mode, max_bucket_size=1000):
+    if mode == EVENT_STORAGE_BUCKET:
+        return BucketEventStorage(mongo_helper, max_bucket_size)
+    elif mode == EVENT_STORAGE_DOCUMENT:
+        return DocumentEventStorage(mongo_helper)
+    raise ValueError("Invalid event storage %s" % mode)
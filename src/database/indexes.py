@@ -0,0 +1,87 @@
+import argparse
+import json
+
+from pymongo.errors import OperationFailure
+
+from database.classes import Item, Map, Sensor, Zone, User, Event, ItemLocation, EventBucket, EventHourly
+
+# Soft deleted documents keep their values, so uniqueness over non deleted documents can't be enforced by the
+# database (partialFilterExpression does not accept {"$exists": False}). Those collections use compound indexes
+# ending in DELETED_FIELD instead, and unique indexes are only declared where documents are never soft deleted.
+DATABASE_CLASSES = [Item, Map, Sensor, Zone, User, Event, ItemLocation, EventBucket, EventHourly]
+
+
+def index_name(spec):
+    if spec.get("name"):
+        return spec["name"]
+    return "_".join("%s_%s" % (field, direction) for field, direction in spec["keys"])
+
+
+def index_options(spec):
+    options = {"name": index_name(spec)}
+    if spec.get("unique"):
+        options["unique"] = True
+    if spec.get("partial"):
+        options["partialFilterExpression"] = spec["partial"]
+    if spec.get("ttl") is not None:
+        options["expireAfterSeconds"] = spec["ttl"]
+    if spec.get("weights"):
+        options["weights"] = spec["weights"]
+    if spec.get("default_language"):
+        options["default_language"] = spec["default_language"]
+    return options
+
+
+def ensure_indexes(mongo_helper, classes=None):
+    """
+    Creates every declared index that is not present yet. create_index is a no-op for existing indexes with the same
+    options, so this can run on every boot. Returns the list of indexes that could not be created.
+    """
+    failed = []
+    for cls in classes or DATABASE_CLASSES:
+        collection = mongo_helper.db[cls.collection_name]
+        for spec in cls.indexes:
+            try:
+                collection.create_index(spec["keys"], **index_options(spec))
+            except OperationFailure as e:
+                print("Unable to create index %s on %s: %s" % (index_name(spec), cls.collection_name, e))
+                failed.append({"collection": cls.collection_name, "index": index_name(spec), "error": str(e)})
+    return failed
+
+
+def index_report(mongo_helper, classes=None):
+    """
+    For each collection lists the declared indexes that are missing, the indexes present in the database that are not
+    declared, and the indexes with no accesses since the server started (from $indexStats).
+    """
+    report = {}
+    for cls in classes or DATABASE_CLASSES:
+        collection = mongo_helper.db[cls.collection_name]
+        existing = collection.index_information()
+        declared = set(index_name(spec) for spec in cls.indexes)
+
+        try:
+            usage = {x["name"]: x["accesses"]["ops"] for x in collection.aggregate([{"$indexStats": {}}])}
+        except OperationFailure:
+            usage = {}
+
+        report[cls.collection_name] = {
+            "missing": sorted(declared - set(existing)),
+            "undeclared": sorted(x for x in existing if x not in declared and x != "_id_"),
+            "unused": sorted(x for x, ops in usage.items() if ops == 0 and x != "_id_"),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    from config import Parser
+    from database.mongo_helper import MongoHelper
+
+    parser = argparse.ArgumentParser(description="Create the declared indexes or report missing/unused ones")
+    parser.add_argument("--create", action="store_true", help="create missing indexes before reporting")
+    args = parser.parse_args()
+
+    helper = MongoHelper.init_from_config(Parser())
+    if args.create:
+        ensure_indexes(helper)
+    print(json.dumps(index_report(helper), indent=2))
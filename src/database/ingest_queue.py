@@ -0,0 +1,214 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from pymongo.errors import ConnectionFailure
+
+from database.mongo_helper import MongoHelper
+from database.redis_helper import RedisHelper
+from ingest import ingest_events, invalid_event_fields
+
+logger = logging.getLogger(__name__)
+
+INGEST_MODE_SYNC = "sync"
+INGEST_MODE_QUEUE = "queue"
+
+
+class QueueFullException(Exception):
+    def __init__(self, depth, message="Ingest queue is full"):
+        self.depth = depth
+        super().__init__(message)
+
+
+class IngestQueue:
+    """
+    Durable ingest queue on a Redis stream. POST /event enqueues validated raw events and IngestWorker threads drain
+    them in batches through ingest.ingest_events. Messages are acknowledged only after being written, so delivery is
+    at least once: a message redelivered after a crash is caught by the duplicated event_timestamp check.
+    Messages that can't be decoded, or that were delivered max_deliveries times without being stored, are moved to the
+    dead_letter_stream with the reason, so a poison message doesn't come back forever.
+    """
+    group = "ingest_workers"
+
+    @classmethod
+    def init_from_config(cls, config, redis_helper):
+        return IngestQueue(
+            redis_helper,
+            stream=config.get("ingest", "stream", "event_ingest"),
+            max_length=int(config.get("ingest", "max_queue_length", 100000)),
+            max_deliveries=int(config.get("ingest", "max_deliveries", 10)),
+            dead_letter_stream=config.get("ingest", "dead_letter_stream", "event_ingest_dead"),
+        )
+
+    def __init__(self, redis_helper: RedisHelper, stream="event_ingest", max_length=100000, max_deliveries=10,
+                 dead_letter_stream="event_ingest_dead"):
+        self.redis_helper = redis_helper
+        self.stream = stream
+        self.max_length = max_length
+        self.max_deliveries = max_deliveries
+        self.dead_letter_stream = dead_letter_stream
+        self.redis_helper.stream_create_group(self.stream, self.group)
+
+    def depth(self):
+        return self.redis_helper.stream_length(self.stream)
+
+    def enqueue(self, raw_events):
+        # Backpressure: refuse new events instead of growing without limit while Mongo is unavailable
+        depth = self.depth()
+        if depth + len(raw_events) > self.max_length:
+            raise QueueFullException(depth)
+        return self.redis_helper.stream_add_many(self.stream, [{"event": json.dumps(x)} for x in raw_events])
+
+    def read(self, consumer, count, block_ms, claim_idle_ms):
+        """
+        Returns the (message_id, raw_event) pairs to ingest and how many messages were dead-lettered instead.
+        Stale messages of other consumers are claimed first, only those can have been delivered before.
+        """
+        messages = self.redis_helper.stream_claim_stale(self.stream, self.group, consumer, claim_idle_ms, count)
+        deliveries = self.redis_helper.stream_delivery_counts(self.stream, self.group, [x[0] for x in messages])
+        if not messages:
+            messages = self.redis_helper.stream_read_group(self.stream, self.group, consumer, count, block_ms)
+
+        events = []
+        dead = []
+        for message_id, fields in messages:
+            times_delivered = deliveries.get(message_id, 1)
+            if times_delivered > self.max_deliveries:
+                reason = "not stored after %d deliveries" % self.max_deliveries
+            else:
+                reason, raw_event = self.decode(fields)
+            if reason:
+                dead.append((message_id, dict(fields, reason=reason, deliveries=times_delivered)))
+            else:
+                events.append((message_id, raw_event))
+        self.dead_letter(dead)
+        return events, len(dead)
+
+    @staticmethod
+    def decode(fields):
+        # (error, raw_event): messages are validated again, the stream may hold events of an older or foreign producer
+        try:
+            raw_event = json.loads(fields["event"])
+        except (KeyError, TypeError, ValueError):
+            return "malformed message", None
+        return invalid_event_fields(raw_event), raw_event
+
+    def ack(self, message_ids):
+        self.redis_helper.stream_ack(self.stream, self.group, message_ids)
+
+    def dead_letter(self, messages):
+        if messages:
+            logger.warning("Moving %d messages of %s to %s: %s", len(messages), self.stream, self.dead_letter_stream,
+                           ", ".join("%s (%s)" % (x[0], x[1]["reason"]) for x in messages))
+        self.redis_helper.stream_move(self.stream, self.group, self.dead_letter_stream, messages,
+                                      maxlen=self.max_length)
+
+    def metrics(self):
+        return {
+            "depth": self.depth(),
+            "pending": self.redis_helper.stream_pending(self.stream, self.group),
+            "max_length": self.max_length,
+            "dead_letter_depth": self.redis_helper.stream_length(self.dead_letter_stream)
+        }
+
+
+class IngestWorker(threading.Thread):
+    def __init__(self, queue: IngestQueue, mongo_helper: MongoHelper, batch_size=500, block_ms=1000,
+                 claim_idle_ms=60000, retry_interval=1):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.mongo_helper = mongo_helper
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.retry_interval = retry_interval
+        self.consumer = "%s-%s" % (self.__class__.__name__, uuid.uuid4())
+        self.counters = {"batches": 0, "accepted": 0, "duplicate": 0, "rejected": 0, "failed_batches": 0,
+                         "failed_messages": 0, "dead_lettered": 0}
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                messages, dead_lettered = self.queue.read(self.consumer, self.batch_size, self.block_ms,
+                                                          self.claim_idle_ms)
+                self.counters["dead_lettered"] += dead_lettered
+                if not messages:
+                    continue
+                results = self.ingest(messages)
+            except Exception:
+                # Unacknowledged messages stay pending and are claimed again after claim_idle_ms
+                logger.exception("Ingest worker %s failed", self.consumer)
+                self.counters["failed_batches"] += 1
+                time.sleep(self.retry_interval)
+                continue
+
+            self.counters["batches"] += 1
+            for result in results:
+                self.counters[result["status"]] += 1
+
+    def ingest(self, messages):
+        """
+        Stores and acknowledges a batch. When it fails for a reason other than Mongo being unreachable, the messages
+        are stored one by one so a single bad message doesn't hold back the others: it stays pending and is
+        dead-lettered once it was delivered max_deliveries times.
+        """
+        try:
+            results = ingest_events(self.mongo_helper, [x[1] for x in messages])
+        except ConnectionFailure:
+            raise
+        except Exception:
+            if len(messages) == 1:
+                raise
+            logger.exception("Ingest worker %s failed on a batch, storing its %d messages one by one",
+                             self.consumer, len(messages))
+            return self.ingest_one_by_one(messages)
+        self.queue.ack([x[0] for x in messages])
+        return results
+
+    def ingest_one_by_one(self, messages):
+        results = []
+        for message_id, raw_event in messages:
+            try:
+                results.extend(ingest_events(self.mongo_helper, [raw_event]))
+            except ConnectionFailure:
+                raise
+            except Exception:
+                logger.exception("Ingest worker %s failed on message %s", self.consumer, message_id)
+                self.counters["failed_messages"] += 1
+                continue
+            self.queue.ack([message_id])
+        return results
+
+
+class IngestWorkerPool:
+    @classmethod
+    def init_from_config(cls, config, queue, mongo_helper):
+        return IngestWorkerPool(
+            queue, mongo_helper,
+            workers=int(config.get("ingest", "workers", 2)),
+            batch_size=int(config.get("ingest", "batch_size", 500)),
+        )
+
+    def __init__(self, queue: IngestQueue, mongo_helper: MongoHelper, workers=2, batch_size=500):
+        self.queue = queue
+        self.workers = [IngestWorker(queue, mongo_helper, batch_size=batch_size) for _ in range(workers)]
+
+    def start(self):
+        for worker in self.workers:
+            if not worker.is_alive():
+                worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def metrics(self):
+        metrics = self.queue.metrics()
+        metrics["workers"] = {x.consumer: dict(x.counters) for x in self.workers}
+        return metrics
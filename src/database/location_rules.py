@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+from database.lookup_cache import LookupCache
+
+logger = logging.getLogger(__name__)
+
+ALERT_UNREAD = 1
+ALERT_READ = 2
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+def _parse_minute(value):
+    # "HH:MM" into minutes of the day, "24:00" is accepted as the end of a window
+    try:
+        hours, minutes = (int(x) for x in value.split(":"))
+    except (AttributeError, ValueError):
+        raise ValueError("invalid time %r, expected HH:MM" % (value,))
+    if not (0 <= hours <= 24 and 0 <= minutes < 60 and hours * 60 + minutes <= 24 * 60):
+        raise ValueError("invalid time %r, expected HH:MM" % (value,))
+    return hours * 60 + minutes
+
+
+def parse_time_windows(value):
+    """
+    Validates allowed_time_windows ({sensor_id: [["08:00", "18:00"], ...]}) and returns it as
+    {sensor_id: ((start_minute, end_minute), ...)}. Raises ValueError on anything else.
+    """
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError("allowed_time_windows must map sensor ids to lists of [start, end] windows")
+    time_windows = {}
+    for sensor_id, windows in value.items():
+        if not isinstance(windows, list) or not all(isinstance(x, list) and len(x) == 2 for x in windows):
+            raise ValueError("the windows of sensor %s must be a list of [start, end]" % sensor_id)
+        time_windows[sensor_id] = tuple((_parse_minute(start), _parse_minute(end)) for start, end in windows)
+    return time_windows
+
+
+def parse_utc_offset(value):
+    # "+HH:MM" or "-HH:MM" into a fixed timezone, Python 3.8 has no zoneinfo database
+    value = (value or "+00:00").strip()
+    sign = -1 if value.startswith("-") else 1
+    minutes = _parse_minute(value.lstrip("+-"))
+    return timezone(sign * timedelta(minutes=minutes))
+
+
+class LocationRules:
+    """
+    Location rules of one item compiled into frozensets, so evaluating an event is O(1) no matter how many sensors
+    the lists have. Zones referenced by zone_blacklist/zone_whitelist are expanded into their sensors, and
+    allowed_time_windows ({sensor_id: [["08:00", "18:00"], ...]}) restricts when the item may be seen at a sensor.
+    Windows are wall clock times in time_zone (the [location_rules] utc_offset option), not in the server local time.
+    """
+    __slots__ = ("blacklist", "whitelist", "time_windows", "time_zone")
+
+    def __init__(self, blacklist, whitelist, time_windows, time_zone=timezone.utc):
+        self.blacklist = blacklist
+        self.whitelist = whitelist
+        self.time_windows = time_windows
+        self.time_zone = time_zone
+
+    @classmethod
+    def compile(cls, item, zones, time_zone=timezone.utc):
+        blacklist = set(_as_list(item.get("location_blacklist")))
+        for zone_id in _as_list(item.get("zone_blacklist")):
+            blacklist.update(zones.get(zone_id, ()))
+
+        whitelist = set(_as_list(item.get("location_whitelist")))
+        for zone_id in _as_list(item.get("zone_whitelist")):
+            whitelist.update(zones.get(zone_id, ()))
+
+        try:
+            time_windows = parse_time_windows(item.get("allowed_time_windows"))
+        except ValueError as e:
+            # Items are validated on write, this only happens with documents written directly to Mongo
+            logger.warning("Ignoring the allowed_time_windows of item %s: %s", item.get("item_id"), e)
+            time_windows = {}
+
+        # An empty whitelist means there is no whitelist, as in the original item semantics
+        return cls(frozenset(blacklist), frozenset(whitelist) or None, time_windows, time_zone)
+
+    def _in_time_window(self, windows, event_timestamp):
+        try:
+            moment = datetime.fromtimestamp(float(event_timestamp), self.time_zone)
+        except (TypeError, ValueError, OverflowError, OSError):
+            return True
+        minute = moment.hour * 60 + moment.minute
+        for start, end in windows:
+            if start <= end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):  # window crossing midnight
+                return True
+        return False
+
+    def evaluate(self, sensor_id, event_timestamp=None):
+        if sensor_id in self.blacklist:
+            return ALERT_UNREAD
+        if self.whitelist is not None and sensor_id not in self.whitelist:
+            return ALERT_UNREAD
+        windows = self.time_windows.get(sensor_id)
+        if windows and not self._in_time_window(windows, event_timestamp):
+            return ALERT_UNREAD
+        return None
+
+
+class LocationRuleEngine:
+    """
+    Keeps the compiled LocationRules of each item. Rules are invalidated together with the item and zone lookups
+    (MongoHelper.invalidate_lookup_cache) and expire after ttl seconds to pick up changes made by other processes.
+    """
+
+    def __init__(self, zone_loader, max_size=10000, ttl=60, time_zone=timezone.utc):
+        self.zone_loader = zone_loader
+        self.time_zone = time_zone
+        self._rules = LookupCache(max_size=max_size, ttl=ttl)
+        self._zones = LookupCache(max_size=1, ttl=ttl)
+
+    def zones(self):
+        return self._zones.get("zones", lambda _: self.zone_loader())
+
+    def rules_for(self, item):
+        return self._rules.get(str(item["_id"]), lambda _: LocationRules.compile(item, self.zones(), self.time_zone))
+
+    def evaluate(self, item, sensor_id, event_timestamp=None):
+        return self.rules_for(item).evaluate(sensor_id, event_timestamp)
+
+    def evaluate_batch(self, events):
+        """
+        events is a list of (item, sensor_id, event_timestamp). Rules are compiled once per distinct item of the batch.
+        """
+        compiled = {}
+        alerts = []
+        for item, sensor_id, event_timestamp in events:
+            key = str(item["_id"])
+            if key not in compiled:
+                compiled[key] = self.rules_for(item)
+            alerts.append(compiled[key].evaluate(sensor_id, event_timestamp))
+        return alerts
+
+    def invalidate(self):
+        self._rules.clear()
+        self._zones.clear()
+        self._zones.clear()
+
+    def stats(self):
+        return self._rules.stats()
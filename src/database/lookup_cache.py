@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LookupCache:
+    """
+    Bounded LRU cache whose entries expire after ttl seconds.
+    Negative results (None) are cached as well, so unknown keys don't hit the database on every call.
+    clear() starts a new generation: values loaded before it are dropped by put instead of being cached after it.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = loader(key)
+        self.put(key, value, generation)
+        return value
+
+    def peek(self, key):
+        """
+        Returns the cached value or MISSING, for callers that load missing keys themselves (e.g. with asyncio).
+        They should read generation before calling it and pass it to put.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return MISSING
+
+    def get_many(self, keys, loader):
+        """
+        Returns a dict key -> value for every key. Missing keys are loaded at once with loader(missing_keys),
+        that must return a dict with the keys found in the database.
+        """
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    found[key] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(key)
+            generation = self.generation
+
+        if missing:
+            loaded = loader(missing)
+            for key in missing:
+                found[key] = loaded.get(key)
+                self.put(key, found[key], generation)
+        return found
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                # cleared while the value was loaded, it may predate the change that cleared the cache
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl
+            }
@@ -1,9 +1,18 @@
 import json
+import os
+import threading
+import time
 
 import pymongo.database
 import pymongo
+from pymongo import UpdateOne
 from bson import json_util
-from datetime import datetime
+from datetime import datetime, timezone
+
+from database.event_storage import build_event_storage, event_hour, EVENT_STORAGE_DOCUMENT
+from database.location_rules import LocationRuleEngine, parse_utc_offset
+from database.lookup_cache import LookupCache
+from database.slow_queries import SlowQueryRecorder
 
 
 class DuplicatedEventReceived(Exception):
@@ -28,25 +37,187 @@ class MongoHelper:
             password=config.get("mongodb", "password"),
             auth_source=config.get("mongodb", "auth_source"),
             database=config.get("mongodb", "database"),
+            cache_size=int(config.get("cache", "max_size", 10000)),
+            cache_ttl=float(config.get("cache", "ttl", 60)),
+            cache_version_check_interval=float(config.get("cache", "version_check_interval", 1)),
+            event_storage=config.get("mongodb", "event_storage", EVENT_STORAGE_DOCUMENT),
+            max_bucket_size=int(config.get("mongodb", "max_bucket_size", 1000)),
+            slow_query_threshold_ms=float(config.get("slow_queries", "threshold_ms", 100))
+            if config.get("slow_queries", "enabled", False) else None,
+            slow_query_log_size=int(config.get("slow_queries", "max_size", 16 * 1024 * 1024)),
+            slow_query_explain_interval=float(config.get("slow_queries", "explain_interval", 60)),
+            slow_query_queue_size=int(config.get("slow_queries", "queue_size", 1000)),
+            time_zone=parse_utc_offset(config.get("location_rules", "utc_offset", "+00:00")),
+            client_options={option: int(config.get("mongodb", key, default)) for option, key, default in (
+                ("maxPoolSize", "max_pool_size", 100),
+                ("minPoolSize", "min_pool_size", 0),
+                ("maxIdleTimeMS", "max_idle_time_ms", 60000),
+                ("waitQueueTimeoutMS", "wait_queue_timeout_ms", 5000),
+                ("connectTimeoutMS", "connect_timeout_ms", 5000),
+                ("serverSelectionTimeoutMS", "server_selection_timeout_ms", 5000),
+                ("socketTimeoutMS", "socket_timeout_ms", 30000),
+            )},
         )
 
-    def __init__(self, host, port, username, password, auth_source, database):
-        self.db = pymongo.MongoClient(host=host,
-                                      port=port,
-                                      username=username,
-                                      password=password,
-                                      authSource=auth_source)[database]
+    def __init__(self, host, port, username, password, auth_source, database, cache_size=10000, cache_ttl=60,
+                 event_storage=EVENT_STORAGE_DOCUMENT, max_bucket_size=1000, slow_query_threshold_ms=None,
+                 slow_query_log_size=16 * 1024 * 1024, client_options=None, time_zone=timezone.utc,
+                 slow_query_explain_interval=60, slow_query_queue_size=1000, cache_version_check_interval=1):
+        self.client_settings = dict(client_options or {}, host=host, port=port, username=username, password=password,
+                                    authSource=auth_source)
+        self.database = database
+        self._client = None
+        self._db = None
+        self._pid = None
+        self._connect_lock = threading.Lock()
+        self.sensor_cache = LookupCache(max_size=cache_size, ttl=cache_ttl)
+        self.item_tag_cache = LookupCache(max_size=cache_size, ttl=cache_ttl)
+        self.location_rules = LocationRuleEngine(self.get_zones, max_size=cache_size, ttl=cache_ttl,
+                                                 time_zone=time_zone)
+        self.event_storage = build_event_storage(self, event_storage, max_bucket_size)
+        self.slow_queries = SlowQueryRecorder(self, slow_query_threshold_ms, slow_query_log_size,
+                                              slow_query_explain_interval, slow_query_queue_size)
+        # CollectionVersions used for HTTP conditional caching and to see writes of other processes, set by the API
+        self.collection_versions = None
+        self.cache_version_check_interval = cache_version_check_interval
+        # collection_name -> (monotonic time of the last check, version stamp the lookup caches were loaded under)
+        self._cache_versions = {}
+
+    def _connect(self):
+        # MongoClient isn't fork safe: the client is created on first use and again in every forked worker process
+        pid = os.getpid()
+        if self._client is not None and self._pid == pid:
+            return
+        with self._connect_lock:
+            if self._client is None or self._pid != pid:
+                self._client = pymongo.MongoClient(connect=False, **self.client_settings)
+                self._db = self._client[self.database]
+                self._pid = pid
+
+    @property
+    def client(self):
+        self._connect()
+        return self._client
+
+    @property
+    def db(self):
+        self._connect()
+        return self._db
+
+    def invalidate_lookup_cache(self, collection_name):
+        if collection_name == 'sensor':
+            self.sensor_cache.clear()
+        elif collection_name == 'item':
+            self.item_tag_cache.clear()
+            self.location_rules.invalidate()
+        elif collection_name == 'zone':
+            self.location_rules.invalidate()
+
+    def version_check_due(self, collection_name):
+        checked = self._cache_versions.get(collection_name)
+        return checked is None or time.monotonic() - checked[0] >= self.cache_version_check_interval
+
+    def apply_collection_version(self, collection_name, version):
+        """
+        Records the current version stamp of a collection and clears its lookup caches if it changed since the last
+        check, that is, if any process wrote to the collection. Returns whether the caches were cleared.
+        """
+        checked = self._cache_versions.get(collection_name)
+        self._cache_versions[collection_name] = (time.monotonic(), version)
+        if checked is not None and checked[1] == version:
+            return False
+        self.invalidate_lookup_cache(collection_name)
+        return True
+
+    def sync_lookup_cache(self, *collection_names):
+        """
+        invalidate_lookup_cache only reaches the current process: other API workers see a write through the version
+        stamp bumped with it, read at most once every cache_version_check_interval seconds per collection.
+        """
+        if self.collection_versions is None:
+            return
+        for collection_name in collection_names:
+            if self.version_check_due(collection_name):
+                self.apply_collection_version(collection_name, self.collection_versions.get(collection_name))
+
+    def bump_collection_version(self, collection_name):
+        if self.collection_versions is not None:
+            self.collection_versions.bump(collection_name)
+
+    def lookup_cache_stats(self):
+        return {
+            "sensor": self.sensor_cache.stats(),
+            "item_by_tag": self.item_tag_cache.stats(),
+            "location_rules": self.location_rules.stats()
+        }
+
+    def get_zones(self):
+        return {x["zone_id"]: frozenset(x.get("sensors") or []) for x in self.db['zone'].find(
+            {"__deleted": {"$exists": False}}, {"zone_id": 1, "sensors": 1})}
 
     def get_event_count(self):
-        return self.db["event"].find({}).count()
+        return self.get_counter("event", self.event_storage.count)
+
+    def get_counter(self, name, loader):
+        """
+        Returns the maintained count of a collection. The counter document is created from loader() the first time,
+        increments before that are no-ops, so a counter never starts from a partial value.
+        """
+        counter = self.db["counters"].find_one({"_id": name})
+        if counter is None:
+            self.db["counters"].update_one({"_id": name}, {"$setOnInsert": {"count": loader()}}, upsert=True)
+            counter = self.db["counters"].find_one({"_id": name})
+        return counter["count"]
+
+    def increment_counter(self, name, amount=1):
+        if amount:
+            self.db["counters"].update_one({"_id": name}, {"$inc": {"count": amount}})
+
+    def set_counter(self, name, value):
+        self.db["counters"].update_one({"_id": name}, {"$set": {"count": value}}, upsert=True)
 
     def get_sensor(self, sensor_id):
-        return self.db['sensor'].find_one({"sensor_id": sensor_id})
+        self.sync_lookup_cache('sensor')
+        return self.sensor_cache.get(sensor_id, self._load_sensor)
 
     def get_item_by_tag(self, tag_id):
+        # the location rules evaluated with the item are compiled from the item and the zones
+        self.sync_lookup_cache('item', 'zone')
+        return self.item_tag_cache.get(tag_id, self._load_item_by_tag)
+
+    def get_sensors(self, sensor_ids):
+        self.sync_lookup_cache('sensor')
+        sensors = self.sensor_cache.get_many(sensor_ids, self._load_sensors)
+        return {k: v for k, v in sensors.items() if v}
+
+    def get_items_by_tags(self, tag_ids):
+        self.sync_lookup_cache('item', 'zone')
+        items = self.item_tag_cache.get_many(tag_ids, self._load_items_by_tags)
+        return {k: v for k, v in items.items() if v}
+
+    def _load_sensor(self, sensor_id):
+        return self.db['sensor'].find_one({"sensor_id": sensor_id})
+
+    def _load_item_by_tag(self, tag_id):
         return self.db['item'].find_one({"tags": tag_id})
 
-    def add_event(self, sensor_id, tag_id, item_id, event_timestamp, event_details, alert=None):
+    def _load_sensors(self, sensor_ids):
+        return {x["sensor_id"]: x for x in self.db['sensor'].find({"sensor_id": {"$in": list(sensor_ids)}})}
+
+    def _load_items_by_tags(self, tag_ids):
+        tag_ids = set(tag_ids)
+        items = {}
+        for item in self.db['item'].find({"tags": {"$in": list(tag_ids)}}):
+            tags = item.get("tags") or []
+            if not isinstance(tags, list):
+                tags = [tags]
+            for tag in tags:
+                if tag in tag_ids and tag not in items:
+                    items[tag] = item
+        return items
+
+    @staticmethod
+    def build_event(sensor_id, tag_id, item_id, event_timestamp, event_details, alert=None):
         event = {
             'inserted_timestamp': datetime.now().timestamp(),
             'event_timestamp': event_timestamp,
@@ -57,10 +228,84 @@ class MongoHelper:
         }
         if alert:
             event["alert"] = alert
-        if not self.db["event"].find_one({"event_timestamp": event_timestamp}):
-            return self.db["event"].insert_one(event)
-        else:
+        return event
+
+    def add_event(self, sensor_id, tag_id, item_id, event_timestamp, event_details, alert=None):
+        event = self.build_event(sensor_id, tag_id, item_id, event_timestamp, event_details, alert)
+        if self.get_existing_event_timestamps([event_timestamp]) or self.add_events([event]):
             raise DuplicatedEventReceived(event)
+        return event
+
+    def get_existing_event_timestamps(self, event_timestamps):
+        return self.event_storage.existing_timestamps(event_timestamps)
+
+    def add_events(self, events):
+        """
+        Inserts a list of events built with build_event with a single unordered write on the configured event storage.
+        Returns the indexes (in the given list) of the events that were rejected as duplicates by the database.
+        """
+        if not events:
+            return set()
+        duplicated = self.event_storage.insert_many(events)
+        inserted = [x for i, x in enumerate(events) if i not in duplicated]
+        self.increment_counter("event", len(inserted))
+        self.update_item_locations(inserted)
+        self.update_hourly_rollups(inserted)
+        return duplicated
+
+    @staticmethod
+    def hourly_rollup_operations(events):
+        # Pre-aggregated reads per (sensor, item, hour), kept for every event storage layout
+        counts = {}
+        for event in events:
+            key = (event["sensor_id"], event.get("item_id"), event_hour(event))
+            counts[key] = counts.get(key, 0) + 1
+        return [UpdateOne({"sensor_id": sensor_id, "item_id": item_id, "hour": hour}, {"$inc": {"count": count}},
+                          upsert=True) for (sensor_id, item_id, hour), count in counts.items()]
+
+    def update_hourly_rollups(self, events):
+        operations = self.hourly_rollup_operations(events)
+        if operations:
+            self.db["event_hourly"].bulk_write(operations, ordered=False)
+
+    def update_item_locations(self, events):
+        """
+        Upserts the item_location document of every event item. The document only moves forward: an event older than
+        the stored last_seen (e.g. a late gateway retry) leaves it untouched. The open alert is only replaced by a
+        newer alert, events without one keep it until ItemLocation.mark_alert_read.
+        """
+        operations = self.item_location_operations(events)
+        if operations:
+            self.db["item_location"].bulk_write(operations, ordered=False)
+
+    @staticmethod
+    def item_location_operations(events):
+        operations = []
+        for event in events:
+            if not event.get("item_id"):
+                continue
+            event_timestamp = {"$literal": event["event_timestamp"]}
+            is_newer = {"$lt": [{"$ifNull": ["$last_seen", None]}, event_timestamp]}
+            location = {
+                "sensor_id": event["sensor_id"],
+                "tag_id": event["tag_id"],
+                "last_seen": event["event_timestamp"],
+                "event_id": event.get("_id")
+            }
+            update = {k: {"$cond": [is_newer, {"$literal": v}, "$" + k]} for k, v in location.items()}
+            if event.get("alert"):
+                # alert_timestamp outlives the read alert, so an older alert arriving late doesn't open it again
+                is_newer_alert = {"$lt": [{"$ifNull": ["$alert_timestamp", None]}, event_timestamp]}
+                alert = {
+                    "alert": event["alert"],
+                    "alert_event_id": event.get("_id"),
+                    "alert_timestamp": event["event_timestamp"]
+                }
+                update.update({k: {"$cond": [is_newer_alert, {"$literal": v}, "$" + k]} for k, v in alert.items()})
+            else:
+                update["alert"] = {"$ifNull": ["$alert", None]}
+            operations.append(UpdateOne({"item_id": event["item_id"]}, [{"$set": update}], upsert=True))
+        return operations
 
     def add_sensor(self, payload):
         response = self.get_item(payload['sensor_id'])
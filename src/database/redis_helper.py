@@ -5,9 +5,22 @@ from abc import abstractmethod
 
 
 class RedisHelper:
-    def __init__(self, host='', port=11158):
-        if not hasattr(self, '_pool'):
-            self._pool = redis.ConnectionPool(host=host, port=port, db=0, password='')
+    @classmethod
+    def init_from_config(cls, config):
+        return RedisHelper(
+            host=config.get("redis", "host", "localhost"),
+            port=int(config.get("redis", "port", 6379)),
+            password=config.get("redis", "password", ""),
+        )
+
+    def __init__(self, host='', port=11158, password='', connection_pool=None):
+        if connection_pool is not None:
+            # Allows using a fakeredis pool, which has to be created with decode_responses=True as well
+            self._pool = connection_pool
+        elif not hasattr(self, '_pool'):
+            # Replies are decoded to str here: decode_responses passed to redis.Redis is ignored when it gets a pool
+            self._pool = redis.ConnectionPool(host=host, port=port, db=0, password=password or None,
+                                              decode_responses=True)
 
     def set(self, val, key, subkey=None, expiration_time=None):
         if val is None:
@@ -22,7 +35,7 @@ class RedisHelper:
             r.set(name=key, value=val)
 
     def get(self, key, subkey=None, new_expiration_time=None):
-        r = redis.Redis(connection_pool=self._pool, decode_responses=True)
+        r = redis.Redis(connection_pool=self._pool)
 
         if subkey:
             key = "%s_%s" % (key, subkey)
@@ -52,6 +65,126 @@ class RedisHelper:
 
         return json.loads(val) if val else None
 
+    def set_hash(self, val, key, subkey=None, expiration_time=None):
+        if not bool(val):
+            return
+        r = redis.Redis(connection_pool=self._pool)
+        if subkey:
+            key = "%s_%s" % (key, subkey)
+        pipe = r.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=val)
+        if expiration_time:
+            pipe.expire(key, expiration_time)
+        pipe.execute()
+
+    def get_hash(self, key, subkey=None, new_expiration_time=None):
+        r = redis.Redis(connection_pool=self._pool)
+        if subkey:
+            key = "%s_%s" % (key, subkey)
+        pipe = r.pipeline()
+        pipe.hgetall(key)
+        if new_expiration_time:
+            pipe.expire(key, new_expiration_time)
+        return pipe.execute()[0] or None
+
+    def get_hash_field(self, field, key, subkey=None, new_expiration_time=None):
+        # Reads a single field and renews the expiration in the same round trip
+        r = redis.Redis(connection_pool=self._pool)
+        if subkey:
+            key = "%s_%s" % (key, subkey)
+        pipe = r.pipeline()
+        pipe.hget(key, field)
+        if new_expiration_time:
+            pipe.expire(key, new_expiration_time)
+        return pipe.execute()[0]
+
+    def set_if_absent(self, val, key, subkey=None, expiration_time=None):
+        # SET NX: returns whether the key was set, i.e. no other process holds it. Used as an expiring lock
+        r = redis.Redis(connection_pool=self._pool)
+        if subkey:
+            key = "%s_%s" % (key, subkey)
+        return bool(r.set(key, val, nx=True, ex=expiration_time))
+
+    def delete(self, key, subkey=None):
+        r = redis.Redis(connection_pool=self._pool)
+        if subkey:
+            key = "%s_%s" % (key, subkey)
+        r.delete(key)
+
+    def stream_add(self, stream, val, maxlen=None):
+        r = redis.Redis(connection_pool=self._pool)
+        return r.xadd(stream, val, maxlen=maxlen, approximate=True)
+
+    def stream_add_many(self, stream, values, maxlen=None):
+        r = redis.Redis(connection_pool=self._pool)
+        pipe = r.pipeline()
+        for val in values:
+            pipe.xadd(stream, val, maxlen=maxlen, approximate=True)
+        return pipe.execute()
+
+    def stream_length(self, stream):
+        r = redis.Redis(connection_pool=self._pool)
+        return r.xlen(stream)
+
+    def stream_create_group(self, stream, group):
+        r = redis.Redis(connection_pool=self._pool)
+        try:
+            r.xgroup_create(stream, group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def stream_read_group(self, stream, group, consumer, count, block=None):
+        r = redis.Redis(connection_pool=self._pool)
+        response = r.xreadgroup(group, consumer, {stream: '>'}, count=count, block=block)
+        return response[0][1] if response else []
+
+    def stream_claim_stale(self, stream, group, consumer, min_idle_time, count):
+        # Takes over messages delivered to a consumer that died before acknowledging them
+        r = redis.Redis(connection_pool=self._pool)
+        response = r.xautoclaim(stream, group, consumer, min_idle_time, start_id='0-0', count=count)
+        return [x for x in response[1] if x[1]]
+
+    def stream_ack(self, stream, group, ids):
+        if not ids:
+            return
+        r = redis.Redis(connection_pool=self._pool)
+        pipe = r.pipeline()
+        pipe.xack(stream, group, *ids)
+        pipe.xdel(stream, *ids)
+        pipe.execute()
+
+    def stream_delivery_counts(self, stream, group, ids):
+        # {id: times_delivered} of pending messages, one XPENDING per id in a single round trip
+        if not ids:
+            return {}
+        r = redis.Redis(connection_pool=self._pool)
+        pipe = r.pipeline()
+        for message_id in ids:
+            pipe.xpending_range(stream, group, min=message_id, max=message_id, count=1)
+        return {x[0]["message_id"]: x[0]["times_delivered"] for x in pipe.execute() if x}
+
+    def stream_move(self, stream, group, target, messages, maxlen=None):
+        # Appends the (id, fields) messages to the target stream and acknowledges them on the source one, atomically
+        if not messages:
+            return
+        r = redis.Redis(connection_pool=self._pool)
+        pipe = r.pipeline(transaction=True)
+        for _, val in messages:
+            pipe.xadd(target, val, maxlen=maxlen, approximate=True)
+        ids = [x[0] for x in messages]
+        pipe.xack(stream, group, *ids)
+        pipe.xdel(stream, *ids)
+        pipe.execute()
+
+    def stream_pending(self, stream, group):
+        r = redis.Redis(connection_pool=self._pool)
+        try:
+            return r.xpending(stream, group)["pending"]
+        except redis.ResponseError:
+            return 0
+
     def flush_all(self):
         r = redis.Redis(connection_pool=self._pool)
         r.flushall()
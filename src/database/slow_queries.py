@@ -0,0 +1,235 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from bson import json_util
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+from database.lookup_cache import LookupCache
+
+logger = logging.getLogger(__name__)
+
+
+def query_shape(value):
+    """
+    The structure of a filter or pipeline with every value replaced by "?", so queries differing only in their
+    values share the same shape.
+    """
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for x in value:
+            shape = query_shape(x)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+
+# Winning plan fields holding the values of the query, the stages, index names and key patterns around them are kept
+PLAN_VALUE_FIELDS = ("filter", "indexBounds", "parsedQuery")
+
+
+def redact_plan(plan):
+    """
+    A winning plan with the query values of its stages replaced by their query_shape, so the log doesn't store the
+    values the filters were run with (ids, e-mails, search terms).
+    """
+    if isinstance(plan, dict):
+        return {k: query_shape(v) if k in PLAN_VALUE_FIELDS else redact_plan(v) for k, v in plan.items()}
+    if isinstance(plan, list):
+        return [redact_plan(x) for x in plan]
+    return plan
+
+
+def plan_summary(plan):
+    # "LIMIT > FETCH > IXSCAN(item_id_1___deleted_1)", following the first input of each stage
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage = "%s(%s)" % (stage, plan["indexName"])
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(stages)
+
+
+class SlowQueryRecorder:
+    """
+    Opt-in log of the queries slower than threshold_ms, kept in a capped collection. The time is measured while the
+    cursor is consumed, excluding the time spent by the caller between documents. Slow queries are handed to a single
+    background thread through a queue of queue_size entries, so the request that ran them isn't delayed further and
+    a burst of slow queries can't start a burst of threads: entries that don't fit are dropped and counted.
+    Explaining runs the query again, so each (source, collection, shape) is explained at most once every
+    explain_interval seconds, the other entries of the shape are recorded with the plan of the last explain.
+    """
+    collection_name = "slow_queries"
+
+    def __init__(self, mongo_helper, threshold_ms=None, max_size=16 * 1024 * 1024, explain_interval=60,
+                 queue_size=1000):
+        self.mongo_helper = mongo_helper
+        self.threshold_ms = threshold_ms
+        self.max_size = max_size
+        self.dropped = 0
+        self._collection_ready = False
+        self._explained = LookupCache(max_size=queue_size, ttl=explain_interval)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold_ms is not None
+
+    def track(self, source, collection_name, query, resultset, explain):
+        """
+        Wraps an iterable resultset (cursor or generator). explain is called without arguments when the query is
+        slow and must return the output of the explain command.
+        """
+        if not self.enabled:
+            return resultset
+        return self._track(source, collection_name, query, resultset, explain)
+
+    def _track(self, source, collection_name, query, resultset, explain):
+        elapsed = 0
+        returned = 0
+        iterator = iter(resultset)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    document = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                returned += 1
+                yield document
+        finally:
+            self.check(source, collection_name, query, elapsed, returned, explain)
+
+    def find_one(self, source, collection_name, query):
+        started = time.perf_counter()
+        document = self.mongo_helper.db[collection_name].find_one(query)
+        if self.enabled:
+            self.check(source, collection_name, query, time.perf_counter() - started, 1 if document else 0,
+                       lambda: self.mongo_helper.db[collection_name].find(query).limit(1).explain())
+        return document
+
+    def check(self, source, collection_name, query, elapsed, returned, explain):
+        duration_ms = elapsed * 1000
+        if duration_ms < self.threshold_ms:
+            return
+        self._start_worker()
+        try:
+            self._queue.put_nowait((source, collection_name, query, duration_ms, returned, explain, datetime.now()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_worker(self):
+        # Threads don't survive a fork, each gunicorn worker process starts its own on the first slow query
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid:
+            return
+        with self._worker_lock:
+            if self._worker is None or self._worker_pid != pid:
+                self._worker = threading.Thread(target=self._run, name="slow-query-recorder", daemon=True)
+                self._worker.start()
+                self._worker_pid = pid
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self.record(*args)
+            except Exception:
+                logger.exception("Unable to record slow query")
+            finally:
+                self._queue.task_done()
+
+    def _ensure_collection(self):
+        if self._collection_ready:
+            return
+        try:
+            self.mongo_helper.db.create_collection(self.collection_name, capped=True, size=self.max_size)
+        except CollectionInvalid:
+            pass
+        self._collection_ready = True
+
+    def record(self, source, collection_name, query, duration_ms, returned, explain, timestamp=None):
+        entry = {
+            "source": source,
+            "collection": collection_name,
+            "shape": json_util.dumps(query_shape(query), sort_keys=True),
+            "duration_ms": duration_ms,
+            "returned": returned,
+            "timestamp": timestamp or datetime.now()
+        }
+        explained = {}
+
+        def load_plan(_):
+            explained.update(self.explain(explain))
+            return explained.get("plan")
+
+        plan = self._explained.get((source, collection_name, entry["shape"]), load_plan)
+        if explained:
+            entry.update(explained)
+        elif plan is not None:
+            entry["plan"] = plan
+        try:
+            self._ensure_collection()
+            self.mongo_helper.db[self.collection_name].insert_one(entry)
+        except PyMongoError as e:
+            logger.warning("Unable to record slow query: %s", e)
+
+    @staticmethod
+    def explain(explain):
+        try:
+            result = explain()
+        except PyMongoError as e:
+            return {"explain_error": str(e)}
+        # Aggregations explain the initial cursor stage, plain finds explain at the top level
+        if "stages" in result:
+            result = result["stages"][0].get("$cursor", {})
+        stats = result.get("executionStats", {})
+        winning_plan = result.get("queryPlanner", {}).get("winningPlan", {})
+        return {
+            "docs_examined": stats.get("totalDocsExamined"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "plan": plan_summary(winning_plan),
+            # as JSON because plans hold operator keys ($and, $regex...) that can't be stored as field names
+            "winning_plan": json_util.dumps(redact_plan(winning_plan))
+        }
+
+    def summary(self, limit=50):
+        """
+        Slow queries grouped by source, collection and shape, the ones taking the most total time first.
+        """
+        resultset = self.mongo_helper.db[self.collection_name].aggregate([
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": {"source": "$source", "collection": "$collection", "shape": "$shape"},
+                "count": {"$sum": 1},
+                "total_ms": {"$sum": "$duration_ms"},
+                "avg_ms": {"$avg": "$duration_ms"},
+                "max_ms": {"$max": "$duration_ms"},
+                "avg_docs_examined": {"$avg": "$docs_examined"},
+                "avg_keys_examined": {"$avg": "$keys_examined"},
+                "avg_returned": {"$avg": "$returned"},
+                "plan": {"$last": "$plan"},
+                "last_seen": {"$last": "$timestamp"}
+            }},
+            {"$sort": {"total_ms": -1}},
+            {"$limit": limit}
+        ])
+        results = []
+        for group in resultset:
+            entry = dict(group.pop("_id"), **group)
+            entry["last_seen"] = entry["last_seen"].isoformat() if entry.get("last_seen") else None
+            results.append(entry)
+        return results
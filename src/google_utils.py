@@ -1,5 +1,151 @@
+import hashlib
+import threading
+import time
+
+import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import Parser
+from database.lookup_cache import LookupCache
+
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/userinfo/v2/me"
+GOOGLE_JWKS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+
+class GoogleIdentity:
+    """
+    Resolves the Google user of a login. id_tokens are verified locally against Google's JWKS keys, fetched once and
+    kept for as long as Google's Cache-Control allows, so most logins don't make any outbound call. Access tokens are
+    resolved with the userinfo endpoint and the answer is cached by a hash of the token. Requests share a pooled
+    session with timeouts. The URLs can point to a local stub server through the [google] section of options.conf.
+    id_tokens are only accepted when client_id is configured, without it any Google app's token would pass.
+    """
+
+    @classmethod
+    def init_from_config(cls, config):
+        return GoogleIdentity(
+            userinfo_url=config.get("google", "userinfo_url", GOOGLE_USERINFO_URL),
+            jwks_url=config.get("google", "jwks_url", GOOGLE_JWKS_URL),
+            issuers=[x.strip() for x in config.get("google", "issuers", ",".join(GOOGLE_ISSUERS)).split(",")],
+            client_id=config.get("google", "client_id", "") or None,
+            timeout=float(config.get("google", "timeout", 5)),
+            pool_size=int(config.get("google", "pool_size", 10)),
+            cache_size=int(config.get("google", "cache_size", 10000)),
+            cache_ttl=float(config.get("google", "cache_ttl", 300)),
+            jwks_ttl=float(config.get("google", "jwks_ttl", 3600)),
+            jwks_min_refresh_interval=float(config.get("google", "jwks_min_refresh_interval", 60)),
+        )
+
+    def __init__(self, userinfo_url=GOOGLE_USERINFO_URL, jwks_url=GOOGLE_JWKS_URL, issuers=None, client_id=None,
+                 timeout=5, pool_size=10, cache_size=10000, cache_ttl=300, jwks_ttl=3600, jwks_min_refresh_interval=60):
+        self.userinfo_url = userinfo_url
+        self.jwks_url = jwks_url
+        self.issuers = issuers or GOOGLE_ISSUERS
+        self.client_id = client_id
+        self.timeout = timeout
+        self.jwks_ttl = jwks_ttl
+        self.jwks_min_refresh_interval = jwks_min_refresh_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._user_data = LookupCache(max_size=cache_size, ttl=cache_ttl)
+        self._keys = {}
+        self._keys_expire_at = 0
+        self._keys_fetched_at = None
+        self._keys_lock = threading.Lock()
+
+    def get_user_data(self, access_token):
+        # Only successful answers are cached, a failed lookup raises before reaching the cache
+        key = hashlib.sha256(access_token.encode()).hexdigest()
+        return self._user_data.get(key, lambda _: self._fetch_user_data(access_token))
+
+    def _fetch_user_data(self, access_token):
+        response = self.session.get(self.userinfo_url, headers={"Authorization": "Bearer %s" % access_token},
+                                    timeout=self.timeout)
+        if response.status_code != 200:
+            raise ValueError("Google rejected the access token (%d)" % response.status_code)
+        return response.json()
+
+    def _max_age(self, response):
+        for directive in response.headers.get("Cache-Control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "max-age" and value.isdigit():
+                return int(value)
+        return self.jwks_ttl
+
+    def signing_keys(self, refresh=False):
+        # A forced refresh is skipped when the keys were fetched less than jwks_min_refresh_interval seconds ago, so
+        # tokens with made up kids can't make every login call Google
+        with self._keys_lock:
+            now = time.monotonic()
+            refresh = refresh and (self._keys_fetched_at is None
+                                   or now - self._keys_fetched_at >= self.jwks_min_refresh_interval)
+            if refresh or not self._keys or self._keys_expire_at <= now:
+                response = self.session.get(self.jwks_url, timeout=self.timeout)
+                response.raise_for_status()
+                self._keys = self._load_keys(response.json().get("keys", []))
+                self._keys_fetched_at = time.monotonic()
+                self._keys_expire_at = self._keys_fetched_at + self._max_age(response)
+            return self._keys
+
+    @staticmethod
+    def _load_keys(jwks):
+        # A key PyJWT can't load (unsupported kty or alg, malformed fields) is skipped instead of failing every login
+        keys = {}
+        for jwk in jwks:
+            if "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+            except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+                continue
+        return keys
+
+    def verify_id_token(self, id_token):
+        """
+        Validates the signature, expiration, issuer and audience (client_id) of an id_token.
+        Returns its claims, raises ValueError if the token isn't valid or no client_id is configured.
+        """
+        if not self.client_id:
+            raise ValueError("id_token logins require the [google] client_id option")
+        try:
+            kid = jwt.get_unverified_header(id_token).get("kid")
+            key = self.signing_keys().get(kid)
+            if key is None:
+                # Google rotates its keys, a token signed with a new one means the cached set is stale
+                key = self.signing_keys(refresh=True).get(kid)
+            if key is None:
+                raise ValueError("Unknown signing key %s" % kid)
+            claims = jwt.decode(id_token, key, algorithms=["RS256"], audience=self.client_id)
+        except (jwt.InvalidTokenError, jwt.PyJWKError) as e:
+            raise ValueError("Invalid id_token: %s" % e)
+        if claims.get("iss") not in self.issuers:
+            raise ValueError("Invalid id_token issuer %s" % claims.get("iss"))
+        if not claims.get("email_verified", False):
+            raise ValueError("Google e-mail not verified")
+        return claims
+
+    def get_login_data(self, id_token=None, access_token=None):
+        """
+        User data of a login: the claims of the id_token when one is supplied and client_id is configured, otherwise
+        the userinfo answer of the access_token. Both carry the "email" of the user.
+        """
+        if id_token and (self.client_id or not access_token):
+            return self.verify_id_token(id_token)
+        if access_token:
+            return self.get_user_data(access_token)
+        raise ValueError("No id_token or access_token supplied")
+
+
+google_identity = GoogleIdentity.init_from_config(Parser())
 
 
 def get_google_user_data(access_token):
-    return requests.get('https://www.googleapis.com/userinfo/v2/me?access_token=%s' % access_token).json()
+    return google_identity.get_user_data(access_token)
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import shutil
+
+from config import Parser
+
+config = Parser()
+
+bind = "0.0.0.0:%s" % config.get("api", "port", 4000)
+
+# gevent serves many concurrent requests per process while they wait on Mongo/Redis, sync needs one process (and
+# one Mongo connection) per concurrent request
+worker_class = config.get("server", "worker_class", "gevent")
+workers = int(config.get("server", "workers", 0)) or multiprocessing.cpu_count() * (1 if worker_class == "gevent" else 2) + 1
+worker_connections = int(config.get("server", "worker_connections", 200))
+threads = int(config.get("server", "threads", 1))
+timeout = int(config.get("server", "timeout", 30))
+graceful_timeout = int(config.get("server", "graceful_timeout", 30))
+keepalive = int(config.get("server", "keepalive", 5))
+# Recycling workers bounds the growth of the per-process caches
+max_requests = int(config.get("server", "max_requests", 10000))
+max_requests_jitter = int(config.get("server", "max_requests_jitter", 1000))
+# The app is imported by each worker after forking, so every process creates its own MongoClient and Redis pool
+preload_app = False
+accesslog = config.get("server", "access_log", None) or None
+errorlog = "-"
+
+# Every worker writes its Prometheus metrics to this directory and /metrics merges them
+prometheus_dir = config.get("server", "prometheus_multiproc_dir", "/tmp/inventio_metrics")
+if prometheus_dir:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", prometheus_dir)
+
+
+def on_starting(server):
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+    if str(config.get("mongodb", "create_indexes", True)).lower() == "true":
+        _create_indexes(server)
+
+
+def _create_indexes(server):
+    # Once per deploy, in the master process before the workers are forked, instead of on the first request of each
+    from pymongo.errors import PyMongoError
+    from database.indexes import ensure_indexes
+    from database.mongo_helper import MongoHelper
+
+    helper = MongoHelper.init_from_config(config)
+    try:
+        failed = ensure_indexes(helper)
+    except PyMongoError as e:
+        server.log.error("Unable to create the indexes, run python -m database.indexes --create: %s", e)
+    else:
+        if failed:
+            server.log.error("Unable to create the indexes %s", failed)
+    finally:
+        helper.client.close()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
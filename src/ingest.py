@@ -0,0 +1,92 @@
+from database.mongo_helper import MongoHelper
+
+EVENT_ACCEPTED = "accepted"
+EVENT_DUPLICATE = "duplicate"
+EVENT_REJECTED = "rejected"
+
+REQUIRED_EVENT_FIELDS = ('sensor_id', 'tag_id', 'event_timestamp')
+
+
+def invalid_event_fields(raw_event):
+    """
+    Returns why a raw event can't be registered, or None when sensor_id, tag_id and event_timestamp are all present
+    and are strings or numbers. Lists and dicts are refused here, they would break the set and $in lookups.
+    """
+    if not isinstance(raw_event, dict) or not all(raw_event.get(x) for x in REQUIRED_EVENT_FIELDS):
+        return "missing fields for registration"
+    for field in REQUIRED_EVENT_FIELDS:
+        value = raw_event[field]
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            return "%s must be a string or a number" % field
+    return None
+
+
+def ingest_events(mongo_helper: MongoHelper, payload):
+    """
+    Validates and stores a list of raw events (dicts with sensor_id, tag_id, event_timestamp and event_details).
+    Sensors, tags and duplicated timestamps are resolved with one query each and the events are written with a single
+    unordered insert_many. Returns one result per event with its status (accepted, duplicate or rejected).
+    """
+    results = [{"status": EVENT_REJECTED} for _ in payload]
+    valid = []
+    for i, raw_event in enumerate(payload):
+        error = invalid_event_fields(raw_event)
+        if error:
+            results[i]["error"] = error
+            continue
+        valid.append(i)
+
+    # one query for every sensor and one for every tag in the batch
+    sensors = mongo_helper.get_sensors(set(payload[i]['sensor_id'] for i in valid))
+    items = mongo_helper.get_items_by_tags(set(payload[i]['tag_id'] for i in valid))
+    existing_timestamps = mongo_helper.get_existing_event_timestamps(set(payload[i]['event_timestamp'] for i in valid))
+
+    candidates = []
+    for i in valid:
+        raw_event = payload[i]
+        sensor_id = raw_event['sensor_id']
+        tag_id = raw_event['tag_id']
+        event_timestamp = raw_event['event_timestamp']
+
+        if sensor_id not in sensors:
+            results[i]["error"] = "sensor not registered"
+            continue
+
+        item = items.get(tag_id)
+        if not item:
+            results[i]["error"] = "no item registered for this tag"
+            continue
+
+        if event_timestamp in existing_timestamps:
+            results[i]["status"] = EVENT_DUPLICATE
+            continue
+        existing_timestamps.add(event_timestamp)
+        candidates.append((i, item))
+
+    alerts = mongo_helper.location_rules.evaluate_batch(
+        [(item, payload[i]['sensor_id'], payload[i]['event_timestamp']) for i, item in candidates])
+    to_insert = []
+    to_insert_index = []
+    for (i, item), alert in zip(candidates, alerts):
+        raw_event = payload[i]
+        to_insert.append(mongo_helper.build_event(raw_event['sensor_id'], raw_event['tag_id'], item["item_id"],
+                                                  raw_event['event_timestamp'], raw_event.get('event_details'), alert))
+        to_insert_index.append(i)
+
+    duplicated = mongo_helper.add_events(to_insert)
+    for position, (i, event) in enumerate(zip(to_insert_index, to_insert)):
+        if position in duplicated:
+            results[i]["status"] = EVENT_DUPLICATE
+        else:
+            results[i]["status"] = EVENT_ACCEPTED
+            results[i]["_id"] = str(event["_id"])
+    return results
+
+
+def summarize_results(results):
+    return {
+        "accepted": sum(1 for x in results if x["status"] == EVENT_ACCEPTED),
+        "duplicate": sum(1 for x in results if x["status"] == EVENT_DUPLICATE),
+        "rejected": sum(1 for x in results if x["status"] == EVENT_REJECTED),
+        "results": results
+    }
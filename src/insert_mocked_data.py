@@ -1,51 +1,216 @@
+import argparse
 import json
-from random import randint
+import os
 import random
-import json
-import datetime as dt
+import time
+from multiprocessing import Pool
+
 from config import Parser
+from database.collection_versions import CollectionVersions
+from database.location_rules import LocationRules
 from database.mongo_helper import MongoHelper
-from database.classes import Item, Sensor, Event
-
-mongo_helper = MongoHelper.init_from_config(Parser())
-
-vet = [
-    "6A003E74F2D2",
-    "6A003E3D721B",
-    "6A003E7E416B",
-    "6A003E818B5E",
-    "6A003E3D721B",
-    "6A003E74F2D2"
-]
+from database.redis_helper import RedisHelper
+from database.classes import Item, Sensor
+
 lorem = "Lorem Ipsum is simply dummy text of the printing and typesetting industry. Lorem Ipsum has been the industry's standard dummy text ever since the 1500s, when an unknown printer took a galley of type and scrambled it to make a type specimen book."
 
+# Each worker process opens its own connection, set by init_worker
+mongo_helper = None
+
+
+def sensor_id_of(i):
+    return "%x" % (0xffff01 + i)
 
-for i in range(0xffff01, 0xffff05):
-    Sensor(mongo_helper)._create_from_script({
-        "sensor_id": hex(i)[2:],
-        "name": f'sensor_{randint(0,20)}',
+
+def tag_id_of(i):
+    return "%012X" % (0x6A0000000000 + i)
+
+
+def generate_sensors(count):
+    return [{
+        "sensor_id": sensor_id_of(i),
+        "name": "sensor_%d" % i,
         "types": "RFID",
         "tag": "test",
         "description": lorem
-    })
+    } for i in range(count)]
+
 
-for i, tag_id in enumerate(vet):
-    Item(mongo_helper)._create_from_script({
+def generate_item(i, sensors, seed, restricted_ratio):
+    # Items live around a home sensor. Sensors are laid out on a line, the neighbours of a sensor are the closest ones
+    rnd = random.Random("%s-item-%d" % (seed, i))
+    home = rnd.randrange(sensors)
+    area = [sensor_id_of(x) for x in range(max(0, home - 2), min(sensors, home + 3))]
+    return {
         "item_id": str(i),
-        "name": "Notebook Dell FFAABBCC0%d" % i,
-        "tags": [tag_id],
+        "name": "Notebook Dell FFAABBCC%06d" % i,
+        "tags": [tag_id_of(i)],
         "location_blacklist": None,
-        "location_whitelist": None,
-        "default_storage_location": "CC02",
+        "location_whitelist": area if rnd.random() < restricted_ratio else None,
+        "default_storage_location": sensor_id_of(home),
         "description": lorem
-    })
-
-for i in range(0xffff01, 0xffff05):
-    Event(mongo_helper)._create_from_script({
-        "received_timestamp": dt.datetime.now().timestamp(),
-        "event_timestamp": dt.datetime.now().timestamp(),
-        "event_details": "tag in motion",
-        "sensor_id": hex(i)[2:],
-        "item_id": str(randint(0,5)),
-        "tag_id": random.choice(vet)
-    })
\ No newline at end of file
+    }
+
+
+def generate_item_events(i, item, items, sensors, events, seed, start, step, move_ratio, wander_ratio):
+    """
+    Reads of item i as a walk over the sensors: most reads repeat the current sensor (the item stays there), some
+    move it to a neighbour and a few send it anywhere, which raises an alert when that is outside its whitelist.
+    Event k of item i is placed in slot k * items + i, so timestamps are unique across items without coordination.
+    """
+    rnd = random.Random("%s-events-%d" % (seed, i))
+    rules = LocationRules.compile(item, {})
+    position = int(item["default_storage_location"], 16) - 0xffff01
+    for k in range(events):
+        draw = rnd.random()
+        if draw < wander_ratio:
+            position = rnd.randrange(sensors)
+        elif draw < wander_ratio + move_ratio:
+            position = min(sensors - 1, max(0, position + rnd.choice((-2, -1, 1, 2))))
+        elif item["location_whitelist"] and sensor_id_of(position) not in item["location_whitelist"]:
+            # back home after wandering away
+            position = int(item["default_storage_location"], 16) - 0xffff01
+        sensor_id = sensor_id_of(position)
+        event_timestamp = start + (k * items + i + rnd.random() * 0.5) * step
+        yield {
+            "sensor_id": sensor_id,
+            "tag_id": item["tags"][0],
+            "item_id": item["item_id"],
+            "event_timestamp": event_timestamp,
+            "event_details": "tag in motion",
+            "alert": rules.evaluate(sensor_id, event_timestamp)
+        }
+
+
+def events_per_item(i, items, events):
+    return events // items + (1 if i < events % items else 0)
+
+
+def init_worker():
+    global mongo_helper
+    mongo_helper = MongoHelper.init_from_config(Parser())
+
+
+def generate_shard(args):
+    """
+    Generates and writes the events of the items in [first_item, last_item). Returns the number of events written.
+    """
+    shard, first_item, last_item, options = args
+    ndjson = None
+    if options["ndjson"]:
+        ndjson = open(os.path.join(options["ndjson"], "events-%04d.ndjson" % shard), "w")
+
+    written = 0
+    chunk = []
+
+    def flush():
+        if mongo_helper is not None and chunk:
+            mongo_helper.add_events([mongo_helper.build_event(x["sensor_id"], x["tag_id"], x["item_id"],
+                                                              x["event_timestamp"], x["event_details"], x["alert"])
+                                     for x in chunk])
+        chunk.clear()
+
+    try:
+        for i in range(first_item, last_item):
+            item = generate_item(i, options["sensors"], options["seed"], options["restricted_ratio"])
+            for event in generate_item_events(i, item, options["items"], options["sensors"],
+                                              events_per_item(i, options["items"], options["events"]),
+                                              options["seed"], options["start"], options["step"],
+                                              options["move_ratio"], options["wander_ratio"]):
+                if ndjson is not None:
+                    # the raw form accepted by POST /event/batch, for replaying against the API
+                    ndjson.write(json.dumps({k: event[k] for k in ("sensor_id", "tag_id", "event_timestamp",
+                                                                   "event_details")}) + "\n")
+                chunk.append(event)
+                written += 1
+                if len(chunk) >= options["chunk_size"]:
+                    flush()
+        flush()
+    finally:
+        if ndjson is not None:
+            ndjson.close()
+    return written
+
+
+def write_ndjson(path, documents):
+    with open(path, "w") as f:
+        for document in documents:
+            f.write(json.dumps(document) + "\n")
+
+
+def insert_chunked(helper, cls, documents, chunk_size):
+    for start in range(0, len(documents), chunk_size):
+        helper.db[cls.collection_name].insert_many(documents[start:start + chunk_size], ordered=False)
+    helper.increment_counter(cls.collection_name, len(documents))
+    # a running API would otherwise keep answering 304 for this collection
+    helper.bump_collection_version(cls.collection_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic sensors, items and RFID events")
+    parser.add_argument("--items", type=int, default=6)
+    parser.add_argument("--sensors", type=int, default=4)
+    parser.add_argument("--events", type=int, default=4)
+    parser.add_argument("--days", type=float, default=1, help="events are spread over the days before --end")
+    parser.add_argument("--end", type=float, help="epoch timestamp of the end of the events, defaults to now. "
+                                                  "Pass it too for output identical between runs")
+    parser.add_argument("--seed", type=int, default=0, help="the same seed always generates the same data")
+    parser.add_argument("--restricted-ratio", type=float, default=0.3,
+                        help="fraction of the items with a location whitelist")
+    parser.add_argument("--alert-ratio", type=float, default=0.01, help="approximate fraction of alert events")
+    parser.add_argument("--move-ratio", type=float, default=0.1,
+                        help="probability of an item moving to a neighbouring sensor between reads")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=5000, help="documents per insert_many")
+    parser.add_argument("--ndjson", help="also write sensors, items and events as NDJSON files in this directory")
+    parser.add_argument("--no-insert", action="store_true", help="only write the NDJSON files")
+    args = parser.parse_args()
+
+    if args.items < 1 or args.sensors < 1:
+        parser.error("at least one item and one sensor are needed")
+    if args.no_insert and not args.ndjson:
+        parser.error("--no-insert needs --ndjson")
+    if args.ndjson:
+        os.makedirs(args.ndjson, exist_ok=True)
+
+    end = args.end if args.end is not None else time.time()
+    options = {
+        "items": args.items,
+        "sensors": args.sensors,
+        "events": args.events,
+        "seed": args.seed,
+        "restricted_ratio": args.restricted_ratio,
+        # wandering only raises alerts for restricted items, so it is scaled to reach the requested alert ratio
+        "wander_ratio": min(1.0, args.alert_ratio / args.restricted_ratio) if args.restricted_ratio else 0,
+        "move_ratio": args.move_ratio,
+        "start": end - args.days * 24 * 60 * 60,
+        "step": args.days * 24 * 60 * 60 / max(args.events + args.items, 1),
+        "chunk_size": args.chunk_size,
+        "ndjson": args.ndjson,
+    }
+
+    started = time.perf_counter()
+    sensors = generate_sensors(args.sensors)
+    items = [generate_item(i, args.sensors, args.seed, args.restricted_ratio) for i in range(args.items)]
+    if args.ndjson:
+        write_ndjson(os.path.join(args.ndjson, "sensors.ndjson"), sensors)
+        write_ndjson(os.path.join(args.ndjson, "items.ndjson"), items)
+    if not args.no_insert:
+        helper = MongoHelper.init_from_config(Parser())
+        helper.collection_versions = CollectionVersions(RedisHelper.init_from_config(Parser()))
+        insert_chunked(helper, Sensor, sensors, args.chunk_size)
+        insert_chunked(helper, Item, items, args.chunk_size)
+
+    # Shards are ranges of items, each process writes the events of its items
+    shards = max(1, min(args.items, args.processes * 4))
+    bounds = [args.items * x // shards for x in range(shards + 1)]
+    tasks = [(x, bounds[x], bounds[x + 1], options) for x in range(shards) if bounds[x] < bounds[x + 1]]
+    with Pool(args.processes, initializer=None if args.no_insert else init_worker) as pool:
+        written = sum(pool.imap_unordered(generate_shard, tasks))
+
+    print("Generated %d sensors, %d items and %d events in %.1fs" % (
+        len(sensors), len(items), written, time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
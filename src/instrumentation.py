@@ -0,0 +1,100 @@
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from pymongo import monitoring
+
+NO_ENDPOINT = "none"
+BACKGROUND = "background"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency per endpoint", ["endpoint", "method", "status"])
+REQUEST_EXCEPTIONS = Counter(
+    "http_request_exceptions_total", "Unhandled exceptions per endpoint", ["endpoint", "exception"])
+MONGO_COMMANDS = Counter(
+    "mongo_commands_total", "Mongo commands per endpoint, collection and command",
+    ["endpoint", "collection", "command", "status"])
+MONGO_COMMAND_SECONDS = Counter(
+    "mongo_command_seconds_total", "Time spent in Mongo commands per endpoint, collection and command",
+    ["endpoint", "collection", "command"])
+MONGO_COMMANDS_PER_REQUEST = Histogram(
+    "mongo_commands_per_request", "Mongo commands issued by each request, high values point to N+1 queries",
+    ["endpoint"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or NO_ENDPOINT
+    return BACKGROUND
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Attributes every Mongo command to the Flask endpoint whose request issued it. Commands run outside a request
+    (ingest workers, the counter reconciler) are reported under the "background" endpoint.
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    @staticmethod
+    def _collection(event):
+        command = event.command
+        if event.command_name == "getMore":
+            return command.get("collection", "")
+        value = command.get(event.command_name)
+        return value if isinstance(value, str) else ""
+
+    def started(self, event):
+        self._started[(event.connection_id, event.request_id)] = (self._collection(event), current_endpoint())
+        if has_request_context() and "mongo_commands" in g:
+            g.mongo_commands += 1
+
+    def _finished(self, event, status):
+        collection, endpoint = self._started.pop((event.connection_id, event.request_id),
+                                                 ("", current_endpoint()))
+        MONGO_COMMANDS.labels(endpoint, collection, event.command_name, status).inc()
+        MONGO_COMMAND_SECONDS.labels(endpoint, collection, event.command_name).inc(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finished(event, "succeeded")
+
+    def failed(self, event):
+        self._finished(event, "failed")
+
+
+def register_mongo_listener():
+    # Listeners registered globally only apply to the MongoClients created afterwards
+    monitoring.register(MongoCommandListener())
+
+
+def metrics_response():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # One registry per worker process, merged from the files each process writes
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, metrics_path="/metrics"):
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.mongo_commands = 0
+
+    @app.after_request
+    def record_request(response):
+        if "request_started" in g:
+            endpoint = current_endpoint()
+            REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+                time.perf_counter() - g.request_started)
+            MONGO_COMMANDS_PER_REQUEST.labels(endpoint).observe(g.mongo_commands)
+        return response
+
+    app.add_url_rule(metrics_path, "metrics", metrics_response)
+
+
+def record_exception(error):
+    REQUEST_EXCEPTIONS.labels(current_endpoint(), error.__class__.__name__).inc()
@@ -1,17 +1,38 @@
 import datetime as dt
 
+import requests
 from flask import Blueprint
 from flask_api import status
 from flask import request, jsonify
 from functools import wraps
 
 from config import Parser
-from database.mongo_helper import MongoHelper
-from database.classes import Item, Event, Sensor, User, Token, Map, USER_ACCESS_MASTER, USER_ACCESS_DEFAULT, \
-    USER_ACCESS_LIMITED
-from google_utils import get_google_user_data
+from database.mongo_helper import MongoHelper, DuplicatedEventReceived
+from database.redis_helper import RedisHelper
+from database.analytics import EventAnalytics
+from database.classes import Item, Event, Sensor, Zone, User, Token, Map, ItemLocation, USER_ACCESS_MASTER, USER_ACCESS_DEFAULT, \
+    USER_ACCESS_LIMITED, SEARCH_MODE_TEXT, SEARCH_MODE_REGEX
+from database.ingest_queue import IngestQueue, IngestWorkerPool, QueueFullException, INGEST_MODE_SYNC, \
+    INGEST_MODE_QUEUE
+from google_utils import google_identity
+from ingest import ingest_events, invalid_event_fields, summarize_results, EVENT_DUPLICATE
+from routes.conditional import ResponseCache
+from routes.streaming import wants_ndjson, ndjson_response, chunked
 
 mongo_helper = MongoHelper.init_from_config(Parser())
+redis_helper = RedisHelper.init_from_config(Parser())
+analytics = EventAnalytics.init_from_config(Parser(), mongo_helper)
+response_cache = ResponseCache.init_from_config(Parser(), redis_helper)
+mongo_helper.collection_versions = response_cache.versions
+
+ingest_mode = Parser().get("ingest", "mode", INGEST_MODE_SYNC)
+# default of /event_count?estimated=
+estimated_count = str(Parser().get("counters", "estimated_count", False)).lower()
+ingest_queue = None
+ingest_workers = None
+if ingest_mode == INGEST_MODE_QUEUE:
+    ingest_queue = IngestQueue.init_from_config(Parser(), redis_helper)
+    ingest_workers = IngestWorkerPool.init_from_config(Parser(), ingest_queue, mongo_helper)
 
 bp = Blueprint(__name__, 'api_v1')
 
@@ -28,18 +49,17 @@ def secure_token(restrict_access=USER_ACCESS_LIMITED):
                 return jsonify({"Error": "No authorization token supplied"}), status.HTTP_401_UNAUTHORIZED
 
             if "bearer" in request.headers.get("Authorization"):
+                # only the token lookup: a ValueError raised by the view is not an expired token
                 try:
-                    token = Token(mongo_helper, _id=request.headers.get("Authorization")[7:])
-                    token.update_token()
-
-                    if token['access_level'] <= restrict_access:
-                        return f(*args, **kwargs)
-                    else:
-                        return jsonify(
-                            {"Error": "User does not have access to this resource"}), status.HTTP_403_FORBIDDEN
-
-                except ValueError:
+                    access_level = Token.get_access_level(redis_helper, request.headers.get("Authorization")[7:])
+                except ValueError as e:
                     return jsonify({"Error": "Token expired", "Reason": str(e), "Authorization": request.headers.get("Authorization")}), 498
+
+                if access_level <= restrict_access:
+                    return f(*args, **kwargs)
+                else:
+                    return jsonify(
+                        {"Error": "User does not have access to this resource"}), status.HTTP_403_FORBIDDEN
             else:
                 return jsonify({"Error": "Token in the wrong format supplied"}), status.HTTP_401_UNAUTHORIZED
 
@@ -47,18 +67,60 @@ def secure_token(restrict_access=USER_ACCESS_LIMITED):
 
     return decorator
 
-ALERT_UNREAD = 1
-ALERT_READ = 2
+
+def requested_fields(cls, extra_fields=()):
+    # fields=a,b on the query string or "fields": [...] on the JSON body, validated against the class fields
+    fields = request.args.get('fields')
+    if fields is None:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            fields = body.get('fields')
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = [x.strip() for x in fields.split(",") if x.strip()]
+    if not isinstance(fields, list) or not all(isinstance(x, str) for x in fields):
+        raise ValueError("fields must be a list or a comma separated string")
+    cls.projection_for([x for x in fields if x not in extra_fields])
+    return list(fields)
+
+
+def numeric_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError("%s must be a number" % name)
+
+
+def queue_full_response(e):
+    response = jsonify({"error": str(e), "depth": e.depth})
+    response.headers["Retry-After"] = "1"
+    return response, status.HTTP_503_SERVICE_UNAVAILABLE
+
+
 @bp.route('/event', methods=('POST',))
 def register_event():
     if request.method == "POST":
+        error = invalid_event_fields(request.json)
+        if error:
+            return jsonify({"error": error}), status.HTTP_400_BAD_REQUEST
+
         sensor_id = request.json.get('sensor_id')
         tag_id = request.json.get('tag_id')
         event_timestamp = request.json.get('event_timestamp')
         event_details = request.json.get('event_details')
 
-        if not sensor_id or not tag_id or not event_timestamp:
-            return jsonify({"error": "missing fields for registration"}), status.HTTP_400_BAD_REQUEST
+        if ingest_mode == INGEST_MODE_QUEUE:
+            try:
+                message_id = ingest_queue.enqueue([{"sensor_id": sensor_id, "tag_id": tag_id,
+                                                    "event_timestamp": event_timestamp,
+                                                    "event_details": event_details}])[0]
+            except QueueFullException as e:
+                return queue_full_response(e)
+            return jsonify({"Event queued successfully": message_id}), status.HTTP_202_ACCEPTED
 
         sensor = mongo_helper.get_sensor(sensor_id)
         if not sensor:
@@ -68,27 +130,33 @@ def register_event():
         if not item:
             return jsonify({"error": "no item registered for this tag"}), status.HTTP_400_BAD_REQUEST
 
-        alert = None
-        if item.get("location_blacklist"):
-            loc_blacklist = item["location_blacklist"]
-            if isinstance(loc_blacklist, list):
-                if sensor_id in loc_blacklist:
-                    alert = ALERT_UNREAD
-            else:
-                if sensor_id == loc_blacklist:
-                    alert = ALERT_UNREAD
-
-        if item.get("location_whitelist"):
-            loc_whitelist = item["location_whitelist"]
-            if isinstance(loc_whitelist, list):
-                if sensor_id not in loc_whitelist:
-                    alert = ALERT_UNREAD
-            else:
-                if sensor_id != loc_whitelist:
-                    alert = ALERT_UNREAD
+        alert = mongo_helper.location_rules.evaluate(item, sensor_id, event_timestamp)
+
+        try:
+            event = mongo_helper.add_event(sensor_id, tag_id, item["item_id"], event_timestamp, event_details, alert)
+        except DuplicatedEventReceived as e:
+            # an expected outcome of gateways resending reads, reported like /event/batch does
+            return jsonify({"error": str(e), "status": EVENT_DUPLICATE}), status.HTTP_409_CONFLICT
+        return jsonify({"Event added successfully": str(event["_id"])}), status.HTTP_200_OK
+
+
+@bp.route('/event/batch', methods=('POST',))
+def register_event_batch():
+    payload = request.json
+    if isinstance(payload, dict):
+        payload = payload.get('events')
+    if not isinstance(payload, list):
+        return jsonify({"error": "expected a list of events"}), status.HTTP_400_BAD_REQUEST
+
+    if ingest_mode == INGEST_MODE_QUEUE:
+        valid = [x for x in payload if not invalid_event_fields(x)]
+        try:
+            ingest_queue.enqueue(valid)
+        except QueueFullException as e:
+            return queue_full_response(e)
+        return jsonify({"queued": len(valid), "rejected": len(payload) - len(valid)}), status.HTTP_202_ACCEPTED
 
-        r = mongo_helper.add_event(sensor_id, tag_id, item["item_id"], event_timestamp, event_details, alert)
-        return jsonify({"Event added successfully": str(r.inserted_id)}), status.HTTP_200_OK
+    return jsonify(summarize_results(ingest_events(mongo_helper, payload))), status.HTTP_200_OK
 
 
 @bp.route('/event', methods=('GET',))
@@ -99,17 +167,97 @@ def read_event():
         item_id = request.args.get('item_id')
         start_timestamp_range = request.args.get('start_timestamp_range')
         end_timestamp_range = request.args.get('end_timestamp_range')
-        limit = int(request.args.get('limit', 50))
-        skip = int(request.args.get('skip', 0))
+        # Keyset pagination: send an empty cursor for the first page and then the returned next_cursor
+        cursor = request.args.get('cursor')
 
-        events = Event(mongo_helper).filter_events(sensor_id, item_id, start_timestamp_range, end_timestamp_range, limit, skip)
+        event = Event(mongo_helper)
+        try:
+            limit, skip = Event.parse_page(request.args.get('limit', 50), request.args.get('skip', 0))
+            fields = requested_fields(Event)
+            if cursor is not None and fields is not None and "event_timestamp" not in fields:
+                fields.append("event_timestamp")
+            events = event.iter_events(sensor_id, item_id, start_timestamp_range, end_timestamp_range, limit,
+                                       skip, cursor=cursor, fields=fields)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+
+        if wants_ndjson():
+            return ndjson_response(events)
+        events = list(events)
+        if cursor is not None:
+            return jsonify({"events": events, "next_cursor": event.next_cursor(events, limit)}), status.HTTP_200_OK
         return jsonify([dict(x) for x in events]), status.HTTP_200_OK
 
 
+@bp.route('/event/hourly', methods=('GET',))
+@secure_token()
+def get_event_hourly_counts():
+    sensor_id = request.args.get('sensor_id')
+    item_id = request.args.get('item_id')
+    start_timestamp_range = request.args.get('start_timestamp_range')
+    end_timestamp_range = request.args.get('end_timestamp_range')
+    return jsonify(Event(mongo_helper).hourly_counts(sensor_id, item_id, start_timestamp_range, end_timestamp_range)), \
+        status.HTTP_200_OK
+
+
 @bp.route('/event_count', methods=('GET',))
 @secure_token()
 def get_event_count():
-    return jsonify({"event_count": Event(mongo_helper).count()}), status.HTTP_200_OK
+    estimated = request.args.get('estimated', estimated_count) == "true"
+    return jsonify({"event_count": Event(mongo_helper).count(estimated=estimated)}), status.HTTP_200_OK
+
+
+@bp.route('/ingest/metrics', methods=('GET',))
+@secure_token()
+def get_ingest_metrics():
+    if ingest_workers is None:
+        return jsonify({"mode": ingest_mode}), status.HTTP_200_OK
+    metrics = ingest_workers.metrics()
+    metrics["mode"] = ingest_mode
+    return jsonify(metrics), status.HTTP_200_OK
+
+
+@bp.route('/cache_stats', methods=('GET',))
+@secure_token(restrict_access=USER_ACCESS_MASTER)
+def get_cache_stats():
+    stats = mongo_helper.lookup_cache_stats()
+    stats["analytics"] = analytics.stats()
+    return jsonify(stats), status.HTTP_200_OK
+
+
+@bp.route('/admin/slow_queries', methods=('GET',))
+@secure_token(restrict_access=USER_ACCESS_MASTER)
+def get_slow_queries():
+    if not mongo_helper.slow_queries.enabled:
+        return jsonify({"error": "slow query log is disabled"}), status.HTTP_404_NOT_FOUND
+    try:
+        limit, _ = Event.parse_page(request.args.get('limit', 50), 0)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+    return jsonify(mongo_helper.slow_queries.summary(limit)), status.HTTP_200_OK
+
+
+@bp.route('/analytics/dwell', methods=('GET',))
+@secure_token()
+def get_dwell_analytics():
+    try:
+        results = analytics.dwell(request.args.get('sensor_id'), request.args.get('item_id'),
+                                  numeric_arg('start_timestamp_range'), numeric_arg('end_timestamp_range'),
+                                  numeric_arg('max_gap'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+    return jsonify(results), status.HTTP_200_OK
+
+
+@bp.route('/analytics/traffic', methods=('GET',))
+@secure_token()
+def get_traffic_analytics():
+    try:
+        results = analytics.traffic(request.args.get('sensor_id'), numeric_arg('start_timestamp_range'),
+                                    numeric_arg('end_timestamp_range'), int(numeric_arg('interval', 3600)))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+    return jsonify(results), status.HTTP_200_OK
 
 
 @bp.route('/sensor', methods=('POST',))
@@ -125,13 +273,21 @@ def create_sensor():
 
 @bp.route('/sensor', methods=('GET',))
 @secure_token()
+@response_cache.conditional(Sensor)
 def read_sensor():
     if request.method == 'GET':
-        return jsonify(Sensor(mongo_helper).get_all()), status.HTTP_200_OK
+        try:
+            sensors = Sensor(mongo_helper).iter_all(requested_fields(Sensor))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+        if wants_ndjson():
+            return ndjson_response(sensors)
+        return jsonify(list(sensors)), status.HTTP_200_OK
 
 
 @bp.route('/sensor/<sensor_id>', methods=('GET',))
 @secure_token()
+@response_cache.conditional(Sensor)
 def find_sensor(sensor_id):
     if request.method == 'GET':
         try:
@@ -160,6 +316,44 @@ def update_sensor(sensor_id):
             return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
 
 
+@bp.route('/zone', methods=('POST', 'GET'))
+@secure_token(restrict_access=USER_ACCESS_DEFAULT)
+def create_zone():
+    if request.method == 'GET':
+        return jsonify(Zone(mongo_helper).get_all()), status.HTTP_200_OK
+    elif request.method == 'POST':
+        try:
+            zone = Zone(mongo_helper).create_from_request(request)
+            return jsonify({"Message": "Inserted Successfully!", "zone": dict(zone)}), status.HTTP_200_OK
+        except Exception as e:
+            return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+
+
+@bp.route('/zone/<zone_id>', methods=('DELETE', 'GET', 'PUT'))
+@secure_token(restrict_access=USER_ACCESS_DEFAULT)
+def manage_zone(zone_id):
+    if request.method == 'GET':
+        try:
+            zone = Zone(mongo_helper, zone_id)
+            return jsonify(dict(zone)), status.HTTP_200_OK
+        except Exception as e:
+            return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+    elif request.method == 'PUT':
+        try:
+            zone = Zone(mongo_helper, zone_id)
+            zone.update_from_request(request)
+            return jsonify(dict(zone)), status.HTTP_200_OK
+        except Exception as e:
+            return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+    elif request.method == 'DELETE':
+        try:
+            zone = Zone(mongo_helper, zone_id)
+            zone.delete()
+            return jsonify({'Message': "Zone removed successfully"}), status.HTTP_200_OK
+        except Exception as e:
+            return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+
+
 @bp.route('/item', methods=('POST',))
 @secure_token(restrict_access=USER_ACCESS_DEFAULT)
 def create_item():
@@ -172,6 +366,7 @@ def create_item():
 
 @bp.route('/item/<item_id>', methods=('GET',))
 @secure_token()
+@response_cache.conditional(Item)
 def find_item(item_id):
     if request.method == 'GET':
         try:
@@ -181,6 +376,45 @@ def find_item(item_id):
             return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
 
 
+@bp.route('/item/<item_id>/location', methods=('GET',))
+@secure_token()
+def find_item_location(item_id):
+    try:
+        location = ItemLocation(mongo_helper, item_id)
+        return jsonify(dict(location)), status.HTTP_200_OK
+    except Exception as e:
+        return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+
+
+@bp.route('/item/<item_id>/location/alert/read', methods=('POST',))
+@secure_token(restrict_access=USER_ACCESS_DEFAULT)
+def read_item_alert(item_id):
+    try:
+        location = ItemLocation(mongo_helper, item_id)
+        location.mark_alert_read()
+        return jsonify(dict(location)), status.HTTP_200_OK
+    except Exception as e:
+        return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
+
+
+@bp.route('/locations', methods=('GET',))
+@secure_token()
+def read_locations():
+    sensor_id = request.args.getlist('sensor_id') or None
+    alert_only = request.args.get('alert_only') == "true"
+    locations = ItemLocation(mongo_helper).iter_locations(sensor_id, alert_only)
+    if wants_ndjson():
+        return ndjson_response(locations)
+    return jsonify(list(locations)), status.HTTP_200_OK
+
+
+@bp.route('/locations/rebuild', methods=('POST',))
+@secure_token(restrict_access=USER_ACCESS_MASTER)
+def rebuild_locations():
+    ItemLocation(mongo_helper).rebuild()
+    return jsonify({'Message': "Item locations rebuilt successfully"}), status.HTTP_200_OK
+
+
 @bp.route('/item/<item_id>', methods=('PUT', 'DELETE'))
 @secure_token(restrict_access=USER_ACCESS_DEFAULT)
 def update_item(item_id):
@@ -200,30 +434,50 @@ def update_item(item_id):
             return jsonify({'Message': str(e)}), status.HTTP_400_BAD_REQUEST
 
 
-@bp.route('/search/item', methods=('POST',))
-@secure_token()
-def search_item():
+def join_last_activity(records, key_field, history_limit, history_skip):
+    # joining events, one aggregation per chunk of records
+    for chunk in chunked(records, Event.stream_batch_size):
+        last_activity = Event(mongo_helper).last_events_by(key_field, [x[key_field] for x in chunk if key_field in x],
+                                                           limit=history_limit, skip=history_skip)
+        for record in chunk:
+            record["last_activity"] = last_activity.get(record.get(key_field)) or None
+            yield record
+
+
+def search_with_last_activity(cls, key_field):
     query = request.json.get('query')
     history_limit = request.json.get('history_limit', 10)
     history_skip = request.json.get('history_skip', 0)
-    result_set = Item(mongo_helper).search(query)
-    # joining events
-    for item in result_set:
-        item["last_activity"] = Event(mongo_helper).filter_events(item_id=item["item_id"], limit=history_limit, skip=history_skip) or None
-    return jsonify(result_set), status.HTTP_200_OK
+    search_mode = request.json.get('search_mode')
+    search_limit = request.json.get('search_limit')
+    try:
+        fields = requested_fields(cls, extra_fields=("last_activity",))
+        # last_activity is only joined when it is requested (or no fields filter was sent)
+        join = fields is None or "last_activity" in fields
+        if fields is not None:
+            fields = [x for x in fields if x != "last_activity"]
+            if join and key_field not in fields:
+                fields.append(key_field)
+        result_set = cls(mongo_helper).iter_search(query, mode=search_mode, limit=search_limit, fields=fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+    if join:
+        result_set = join_last_activity(result_set, key_field, history_limit, history_skip)
+    if wants_ndjson():
+        return ndjson_response(result_set)
+    return jsonify(list(result_set)), status.HTTP_200_OK
+
+
+@bp.route('/search/item', methods=('POST',))
+@secure_token()
+def search_item():
+    return search_with_last_activity(Item, "item_id")
 
 
 @bp.route('/search/sensor', methods=('POST',))
 @secure_token()
 def search_sensor():
-    query = request.json.get('query')
-    history_limit = request.json.get('history_limit', 10)
-    history_skip = request.json.get('history_skip', 0)
-    result_set = Sensor(mongo_helper).search(query)
-    # joining events
-    for sensor in result_set:
-        sensor["last_activity"] = Event(mongo_helper).filter_events(sensor_id=sensor["sensor_id"], limit=history_limit, skip=history_skip) or None
-    return jsonify(result_set), status.HTTP_200_OK
+    return search_with_last_activity(Sensor, "sensor_id")
 
 
 @bp.route('/search/event', methods=('POST',))
@@ -231,34 +485,52 @@ def search_sensor():
 def search_event():
     start_timestamp_range = request.json.get('start_timestamp_range')
     end_timestamp_range = request.json.get('end_timestamp_range')
-    limit = int(request.json.get('limit', 0))
-    skip = int(request.json.get('skip', 0))
+    try:
+        limit, skip = Event.parse_page(request.json.get('limit', 0), request.json.get('skip', 0))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
 
     alert_only = request.json.get('alert_only')
 
+    # sensor_query/item_query usually are (parts of) ids, which $text would split on hyphens and OR, so unlike the
+    # ranked /search/item and /search/sensor listings the filter matches them as a regex unless asked otherwise
+    search_mode = request.json.get('search_mode') or SEARCH_MODE_REGEX
+    if search_mode not in (SEARCH_MODE_TEXT, SEARCH_MODE_REGEX):
+        return jsonify({"error": "Invalid search mode %s" % search_mode}), status.HTTP_400_BAD_REQUEST
+
+    # only the ids of the matched sensors/items are needed to filter the events
     sensor_queries = request.json.get('sensor_query')
     result_sensors = None
     if sensor_queries:
-        result_sensors = Sensor(mongo_helper).search(sensor_queries, return_objects=True)
+        result_sensors = Sensor(mongo_helper).search(sensor_queries, mode=search_mode, limit=0, fields=["sensor_id"])
 
     item_queries = request.json.get('item_query')
     result_items = None
     if item_queries:
-        result_items = Item(mongo_helper).search(item_queries, return_objects=True)
-
-    events = Event(mongo_helper).filter_events(
-        ([x["sensor_id"] for x in result_sensors] if result_sensors is not None else result_sensors),
-        ([x["item_id"] for x in result_items] if result_items is not None else result_items),
-        start_timestamp_range, end_timestamp_range, limit, skip, alert_only)
+        result_items = Item(mongo_helper).search(item_queries, mode=search_mode, limit=0, fields=["item_id"])
 
+    cursor = request.json.get('cursor')
 
-    results = []
-    for event in events:
-        e = dict(event)
-        e["sensor"] = dict(Sensor(mongo_helper, e["sensor_id"]))
-        e["item"] = dict(Item(mongo_helper, e["item_id"]))
-        results.append(e)
-
+    event = Event(mongo_helper)
+    try:
+        fields = requested_fields(Event, extra_fields=("sensor", "item"))
+        if cursor is not None and fields is not None and "event_timestamp" not in fields:
+            fields.append("event_timestamp")
+        if cursor:
+            event.decode_cursor(cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), status.HTTP_400_BAD_REQUEST
+
+    results = event.iter_events_with_details(
+        ([x["sensor_id"] for x in result_sensors if "sensor_id" in x] if result_sensors is not None else result_sensors),
+        ([x["item_id"] for x in result_items if "item_id" in x] if result_items is not None else result_items),
+        start_timestamp_range, end_timestamp_range, limit, skip, alert_only, cursor, fields)
+    if wants_ndjson():
+        return ndjson_response(results)
+    results = list(results)
+
+    if cursor is not None:
+        return jsonify({"events": results, "next_cursor": event.next_cursor(results, limit)}), status.HTTP_200_OK
     return jsonify(results), status.HTTP_200_OK
 
 
@@ -266,6 +538,8 @@ def search_event():
 @secure_token(restrict_access=USER_ACCESS_MASTER)
 def create_user():
     if request.method == 'GET':
+        if wants_ndjson():
+            return ndjson_response(User(mongo_helper).iter_all())
         return jsonify(User(mongo_helper).get_all()), status.HTTP_200_OK
     elif request.method == 'POST':
         try:
@@ -307,8 +581,11 @@ def login():
     email = request.json.get('email')
 
     # Check if e-mail supplied matches google token supplied
-    g_user_data = get_google_user_data(access_token)
-    if g_user_data["email"].lower() != email.lower():
+    try:
+        g_user_data = google_identity.get_login_data(id_token, access_token)
+    except (ValueError, requests.RequestException):
+        g_user_data = {}
+    if not email or not g_user_data.get("email") or g_user_data["email"].lower() != email.lower():
         return jsonify({
             "success": False
         }), status.HTTP_401_UNAUTHORIZED
@@ -324,7 +601,7 @@ def login():
         user_data["id_token"] = id_token
         user_data["access_token"] = access_token
         user_data["google_data"] = g_user_data
-        access_token = Token(mongo_helper).create_token_from_user_data(user_data)
+        access_token = Token.create_token_from_user_data(redis_helper, user_data)
 
         return jsonify({
            "success": True,
@@ -348,6 +625,7 @@ def create_map():
 
 @bp.route('/map/<name>', methods=('DELETE', 'GET', 'PUT'))
 #@secure_token(restrict_access=USER_ACCESS_MASTER)
+@response_cache.conditional(Map)
 def manage_map(name):
     if request.method == 'GET':
         try:
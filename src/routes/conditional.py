@@ -0,0 +1,80 @@
+import hashlib
+from functools import wraps
+
+from flask import Response, request, make_response
+
+from database.collection_versions import CollectionVersions
+from database.redis_helper import RedisHelper
+
+
+class ResponseCache:
+    """
+    Conditional GET for read endpoints. The strong ETag of a response is derived from the version stamps of the
+    collections it is built from plus the request path, query string and Accept header, so If-None-Match is answered
+    with 304 without touching Mongo. Bodies of 200 responses are shared between processes through Redis for ttl
+    seconds, keyed by the same ETag.
+    """
+    key_prefix = "response"
+
+    @classmethod
+    def init_from_config(cls, config, redis_helper):
+        return ResponseCache(
+            redis_helper,
+            enabled=str(config.get("http_cache", "enabled", True)).lower() == "true",
+            ttl=int(config.get("http_cache", "response_ttl", 5)),
+            version_ttl=int(config.get("http_cache", "version_ttl", 300)),
+        )
+
+    def __init__(self, redis_helper: RedisHelper, enabled=True, ttl=5, version_ttl=300):
+        self.redis_helper = redis_helper
+        self.versions = CollectionVersions(redis_helper, version_ttl)
+        self.enabled = enabled
+        self.ttl = ttl
+
+    def etag(self, collection_names):
+        versions = self.versions.get_many(collection_names)
+        key = "|".join(versions + [request.full_path, request.headers.get("Accept", "")])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, etag):
+        return self.redis_helper.get_dict(self.key_prefix, etag)
+
+    def put(self, etag, response):
+        self.redis_helper.set_dict({"body": response.get_data(as_text=True), "mimetype": response.mimetype},
+                                   self.key_prefix, etag, expiration_time=self.ttl)
+
+    def conditional(self, *classes):
+        """
+        Decorator for views returning the documents of the given DatabaseClassObj classes. Only GET is handled,
+        other methods of the same view go straight through.
+        """
+        collection_names = [x.collection_name for x in classes]
+
+        def decorator(f):
+            @wraps(f)
+            def check_version(*args, **kwargs):
+                if not self.enabled or request.method != 'GET':
+                    return f(*args, **kwargs)
+
+                etag = self.etag(collection_names)
+                if request.if_none_match.contains(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+
+                cached = self.get(etag)
+                if cached is not None:
+                    response = Response(cached["body"], mimetype=cached["mimetype"])
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        self.put(etag, response)
+                response.set_etag(etag)
+                response.vary.add("Accept")
+                return response
+
+            return check_version
+
+        return decorator
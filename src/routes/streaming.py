@@ -0,0 +1,26 @@
+from itertools import islice
+
+from flask import Response, request, stream_with_context, json
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def ndjson_response(records):
+    # Serialises one record per line while the database cursor is consumed, so memory doesn't grow with the result
+    def generate():
+        for record in records:
+            yield json.dumps(record) + "\n"
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
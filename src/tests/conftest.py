@@ -0,0 +1,58 @@
+import os
+import sys
+from functools import partial
+
+import fakeredis
+import mongomock
+import pytest
+import redis
+
+# The application reads options.conf and imports its modules relative to src/, as when it is started from there
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+os.chdir(SRC_DIR)
+
+from database.mongo_helper import MongoHelper  # noqa: E402
+from database.redis_helper import RedisHelper  # noqa: E402
+
+
+@pytest.fixture
+def mongo_helper():
+    with mongomock.patch(servers=(("localhost", 27017),)):
+        yield MongoHelper("localhost", 27017, None, None, "admin", "inventio_test")
+
+
+@pytest.fixture
+def redis_helper(monkeypatch):
+    # RedisHelper builds its own pool, only the connections are replaced by fakeredis ones
+    monkeypatch.setattr(redis, "ConnectionPool", partial(redis.ConnectionPool, server=fakeredis.FakeServer(),
+                                                         connection_class=fakeredis.FakeConnection))
+    return RedisHelper("localhost", 6379)
+
+
+@pytest.fixture
+def api(monkeypatch, redis_helper):
+    """
+    Flask test client of the app with the Mongo host of options.conf served by mongomock and Redis by fakeredis,
+    both empty for every test.
+    Index creation and the background threads started on the first request are skipped.
+    """
+    with mongomock.patch(servers=(("mongo", 27017),)):
+        from app import app
+        from routes import api_v1
+        # the client is created again on first use, inside this test's mongomock server
+        monkeypatch.setattr(api_v1.mongo_helper, "_client", None)
+        monkeypatch.setattr(api_v1.redis_helper, "_pool", redis_helper._pool)
+        for collection_name in ("sensor", "item", "zone"):
+            api_v1.mongo_helper.invalidate_lookup_cache(collection_name)
+        monkeypatch.setattr(app, "before_first_request_funcs", [])
+        yield app.test_client()
+
+
+@pytest.fixture
+def auth(redis_helper):
+    # Authorization header of a master user token, accepted by every secure_token route
+    from database.classes import Token, USER_ACCESS_MASTER
+    token_id = Token.create_token_from_user_data(redis_helper, {"email": "master@example.com",
+                                                               "access": USER_ACCESS_MASTER})
+    return {"Authorization": "bearer %s" % token_id}
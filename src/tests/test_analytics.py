@@ -0,0 +1,23 @@
+import pytest
+
+from database.analytics import EventAnalytics
+
+
+@pytest.mark.parametrize("query, status", [
+    ("", 400),
+    ("?start_timestamp_range=0", 400),
+    ("?start_timestamp_range=0&end_timestamp_range=604801", 400),
+    ("?start_timestamp_range=0&end_timestamp_range=604800", 200),
+    ("?item_id=i1", 200),
+])
+def test_dwell_requires_a_bounded_window(api, auth, query, status):
+    response = api.get("/api/v1/analytics/dwell" + query, headers=auth)
+    assert response.status_code == status
+
+
+def test_dwell_window_limit_is_configurable(mongo_helper):
+    analytics = EventAnalytics(mongo_helper, max_dwell_window=60)
+    with pytest.raises(ValueError):
+        analytics.dwell(start_timestamp=0, end_timestamp=61)
+    with pytest.raises(ValueError):
+        analytics.dwell(sensor_id="s1", end_timestamp=60)
@@ -0,0 +1,135 @@
+"""
+Integration tests of the asyncio routes of asgi.py against the Flask ones: both must answer the same and store the
+same documents. motor can't run on mongomock, so they need a mongod and are skipped unless INVENTIO_TEST_MONGO_URL
+(e.g. mongodb://localhost:27017) is set. The database inventio_asgi_parity_test is dropped before and after each test.
+"""
+import json
+import os
+
+import pytest
+
+MONGO_URL = os.environ.get("INVENTIO_TEST_MONGO_URL")
+DATABASE = "inventio_asgi_parity_test"
+
+HOUR = 60 * 60
+
+pytestmark = pytest.mark.skipif(not MONGO_URL, reason="needs a mongod, set INVENTIO_TEST_MONGO_URL")
+
+
+@pytest.fixture
+def clients(monkeypatch, redis_helper):
+    pytest.importorskip("httpx")
+    import fakeredis
+    from starlette.testclient import TestClient
+
+    import asgi
+    from app import app as flask_app
+    from database.indexes import ensure_indexes
+    from database.ingest_queue import INGEST_MODE_SYNC
+    from routes import api_v1
+
+    mongo_helper = api_v1.mongo_helper
+    monkeypatch.setattr(mongo_helper, "client_settings", {"host": MONGO_URL})
+    monkeypatch.setattr(mongo_helper, "database", DATABASE)
+    monkeypatch.setattr(mongo_helper, "_client", None)
+    monkeypatch.setattr(asgi.async_mongo_helper, "_client", None)
+    monkeypatch.setattr(api_v1.redis_helper, "_pool", redis_helper._pool)
+    # the asyncio token lookups see the tokens written by the sync helper
+    monkeypatch.setattr(asgi, "redis_client", fakeredis.aioredis.FakeRedis(
+        server=redis_helper._pool.connection_kwargs["server"], decode_responses=True))
+    for module in (api_v1, asgi):
+        monkeypatch.setattr(module, "ingest_mode", INGEST_MODE_SYNC)
+    monkeypatch.setattr(flask_app, "before_first_request_funcs", [])
+    for collection_name in ("sensor", "item", "zone"):
+        mongo_helper.invalidate_lookup_cache(collection_name)
+
+    mongo_helper.client.drop_database(DATABASE)
+    ensure_indexes(mongo_helper)
+    mongo_helper.db["sensor"].insert_many([{"sensor_id": "s1", "name": "Sensor 1"},
+                                           {"sensor_id": "s2", "name": "Sensor 2"}])
+    mongo_helper.db["item"].insert_many([
+        {"item_id": "flask", "name": "Flask item", "tags": ["t-flask"], "location_whitelist": ["s2"]},
+        {"item_id": "asgi", "name": "ASGI item", "tags": ["t-asgi"], "location_whitelist": ["s2"]},
+    ])
+    try:
+        # one event loop for the whole test, the motor client is bound to the loop that created it
+        with TestClient(asgi.app) as asgi_client:
+            yield mongo_helper, flask_app.test_client(), asgi_client
+    finally:
+        mongo_helper.client.drop_database(DATABASE)
+
+
+def without(document, *fields):
+    return {k: v for k, v in document.items() if k not in fields}
+
+
+def test_post_event_answers_and_stores_the_same(clients):
+    mongo_helper, flask, asgi = clients
+
+    def post(event_timestamp, **fields):
+        # the same event, with its own item and timestamp on each app
+        flask_body = dict({"sensor_id": "s1", "tag_id": "t-flask", "event_timestamp": event_timestamp,
+                           "event_details": {"rssi": -40}}, **fields)
+        asgi_body = dict(flask_body, tag_id="t-asgi" if flask_body["tag_id"] == "t-flask" else flask_body["tag_id"],
+                         event_timestamp=event_timestamp + HOUR)
+        return flask.post("/api/v1/event", json=flask_body), asgi.post("/api/v1/event", json=asgi_body)
+
+    for fields in ({}, {"sensor_id": "s2"}):
+        flask_response, asgi_response = post(10 * HOUR + (30 if fields else 0), **fields)
+        assert flask_response.status_code == asgi_response.status_code == 200
+        assert flask_response.get_json().keys() == asgi_response.json().keys() == {"Event added successfully"}
+
+    # duplicated, malformed and unknown events
+    for event_timestamp, fields, status in ((10 * HOUR, {}, 409), (11 * HOUR, {"tag_id": ["t"]}, 400),
+                                            (12 * HOUR, {"sensor_id": "unknown"}, 400),
+                                            (13 * HOUR, {"tag_id": "unknown"}, 400)):
+        flask_response, asgi_response = post(event_timestamp, **fields)
+        assert flask_response.status_code == asgi_response.status_code == status
+        assert flask_response.get_json() == asgi_response.json()
+    assert post(10 * HOUR)[0].get_json() == {"error": "Received event is already in database",
+                                             "status": "duplicate"}
+
+    def stored(collection_name, item_id, *ignored):
+        return [without(x, "_id", *ignored) for x in mongo_helper.db[collection_name].find(
+            {"item_id": item_id}).sort([("sensor_id", 1)])]
+
+    identifiers = ("item_id", "tag_id", "event_timestamp", "inserted_timestamp", "hour", "last_seen", "event_id",
+                   "alert_event_id", "alert_timestamp")
+    for collection_name in ("event", "event_hourly", "item_location"):
+        flask_documents = stored(collection_name, "flask", *identifiers)
+        assert flask_documents
+        assert flask_documents == stored(collection_name, "asgi", *identifiers)
+    # the read at s1 is outside the whitelist of the items
+    assert [x.get("alert") for x in stored("event", "asgi")] == [1, None]
+
+
+def test_get_event_answers_the_same(clients, auth):
+    mongo_helper, flask, asgi = clients
+    mongo_helper.add_events([mongo_helper.build_event("s%d" % (i % 2 + 1), "t-flask", "flask", i * 600.5,
+                                                      {"read": i}) for i in range(12)])
+
+    assert flask.get("/api/v1/event").status_code == asgi.get("/api/v1/event").status_code == 401
+    queries = ["", "?limit=5", "?limit=5&skip=3", "?sensor_id=s1&limit=3", "?item_id=flask&fields=sensor_id",
+               "?start_timestamp_range=1200&end_timestamp_range=4800", "?fields=nope", "?limit=abc", "?skip=-1"]
+    for query in queries:
+        flask_response = flask.get("/api/v1/event" + query, headers=auth)
+        asgi_response = asgi.get("/api/v1/event" + query, headers=auth)
+        assert flask_response.status_code == asgi_response.status_code, query
+        assert flask_response.get_json() == asgi_response.json(), query
+
+    # keyset pages, followed to the end on both apps
+    cursor = ""
+    pages = 0
+    while cursor is not None:
+        query = "/api/v1/event?limit=5&fields=sensor_id&cursor=%s" % cursor
+        flask_page = flask.get(query, headers=auth).get_json()
+        assert flask_page == asgi.get(query, headers=auth).json()
+        cursor = flask_page["next_cursor"]
+        pages += 1
+    assert pages == 3
+
+    ndjson = dict(auth, Accept="application/x-ndjson")
+    flask_lines = flask.get("/api/v1/event?limit=20", headers=ndjson).get_data(as_text=True).splitlines()
+    asgi_lines = asgi.get("/api/v1/event?limit=20", headers=ndjson).text.splitlines()
+    assert len(flask_lines) == 12
+    assert [json.loads(x) for x in flask_lines] == [json.loads(x) for x in asgi_lines]
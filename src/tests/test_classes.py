@@ -0,0 +1,57 @@
+import pytest
+from bson import ObjectId
+
+from database.classes import Event, Item, ItemLocation, Sensor, DELETED_FIELD
+
+
+@pytest.mark.parametrize("cls, document", [
+    (Sensor, {"_id": ObjectId(), "sensor_id": "s1", "name": "Sensor 1", "undeclared": 1}),
+    (Item, {"_id": ObjectId(), "item_id": "i1", "name": "Item 1", "tags": ["t1"], DELETED_FIELD: True}),
+    (Event, {"_id": ObjectId(), "sensor_id": "s1", "event_timestamp": 1000.0, "event_details": {"rssi": -40}}),
+    (ItemLocation, {"_id": ObjectId(), "item_id": "i1", "event_id": ObjectId(), "alert_event_id": None}),
+])
+def test_serialize_document_matches_the_object(mongo_helper, cls, document):
+    expected = dict(cls(mongo_helper)._create_from_mongo_entry(dict(document)))
+    assert cls.serialize_document(document) == expected
+    assert isinstance(expected["_id"], str)
+    assert "undeclared" not in expected
+
+
+def test_schema_is_compiled_once_per_class():
+    assert Sensor.schema() is Sensor.schema()
+    assert Sensor.schema() is not Item.schema()
+    assert Item.schema().fields[:2] == ("_id", DELETED_FIELD)
+    assert set(Item.schema().fields) == set(Item.default_fields + Item.fields)
+    assert Item.schema().projection == {x: 1 for x in Item.schema().fields}
+
+
+def test_projection_for():
+    assert Item.projection_for() is Item.schema().projection
+    assert Item.projection_for(["item_id", "name"]) == {"item_id": 1, "name": 1}
+    with pytest.raises(ValueError, match="Invalid fields for item: nope, other"):
+        Item.projection_for(["item_id", "nope", "other"])
+
+
+@pytest.mark.parametrize("request_kwargs, status, error", [
+    ({"query_string": {"fields": "event_timestamp, sensor_id"}}, 200, None),
+    ({"query_string": {"fields": "event_timestamp,nope"}}, 400, "Invalid fields for event: nope"),
+    ({"json": {"fields": ["sensor", "event_timestamp"]}}, 200, None),
+    ({"json": {"fields": ["last_activity"]}}, 400, "Invalid fields for event: last_activity"),
+    ({"json": {"fields": "sensor_id"}}, 200, None),
+    ({"json": {"fields": 5}}, 400, "fields must be a list or a comma separated string"),
+])
+def test_requested_fields_are_validated(api, auth, request_kwargs, status, error):
+    from routes import api_v1
+    api_v1.mongo_helper.add_events([api_v1.mongo_helper.build_event("s1", "t1", "i1", 1000.0, {"read": 1})])
+
+    if "json" in request_kwargs:
+        response = api.post("/api/v1/search/event", headers=auth, **request_kwargs)
+    else:
+        response = api.get("/api/v1/event", headers=auth, **request_kwargs)
+    assert response.status_code == status
+    if error:
+        assert response.get_json() == {"error": error}
+    else:
+        requested = request_kwargs.get("query_string", request_kwargs.get("json"))["fields"]
+        requested = requested if isinstance(requested, list) else [x.strip() for x in requested.split(",")]
+        assert set(response.get_json()[0]) == {"_id"} | set(requested)
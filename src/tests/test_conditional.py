@@ -0,0 +1,29 @@
+import redis
+
+from database.collection_versions import CollectionVersions
+
+
+def test_version_stamps_expire(redis_helper):
+    versions = CollectionVersions(redis_helper, ttl=30)
+    version = versions.get("sensor")
+    assert isinstance(version, str) and versions.get("sensor") == version
+    assert 0 < redis.Redis(connection_pool=redis_helper._pool).ttl("collection_version_sensor") <= 30
+    assert versions.bump("sensor") != version
+
+
+def test_conditional_get(api, auth):
+    from routes import api_v1
+    api_v1.mongo_helper.db["sensor"].insert_one({"sensor_id": "s1", "name": "Sensor 1"})
+
+    response = api.get("/api/v1/sensor/s1", headers=auth)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = api.get("/api/v1/sensor/s1", headers=dict(auth, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+
+    assert api.put("/api/v1/sensor/s1", json={"name": "Sensor one"}, headers=auth).status_code == 200
+    response = api.get("/api/v1/sensor/s1", headers=dict(auth, **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "Sensor one"
+    assert response.headers["ETag"] != etag
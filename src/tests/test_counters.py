@@ -0,0 +1,66 @@
+import pytest
+
+from database.classes import Event, Sensor, DELETED_FIELD
+from database.counters import CounterReconciler, reconcile_counters
+
+
+def add_sensors(mongo_helper, count):
+    for i in range(count):
+        Sensor(mongo_helper)._create_from_script({"sensor_id": "s%d" % i, "name": "Sensor %d" % i})
+
+
+def test_counters_follow_inserts_and_deletes(mongo_helper):
+    add_sensors(mongo_helper, 3)
+    assert Sensor(mongo_helper).count() == 3
+
+    sensor = Sensor(mongo_helper, "s1")
+    sensor.delete()
+    sensor.delete()
+    # soft deleted documents are left out of the counter and of the recount alike
+    assert Sensor(mongo_helper).count() == Sensor(mongo_helper).count_documents() == 2
+    assert reconcile_counters(mongo_helper, [Sensor]) == {}
+
+
+def test_reconcile_keeps_concurrent_increments(mongo_helper, monkeypatch):
+    add_sensors(mongo_helper, 3)
+    Sensor(mongo_helper).count()
+    mongo_helper.db["sensor"].insert_many([{"sensor_id": "outside%d" % i, "name": "Written by a script"}
+                                           for i in range(2)])
+    mongo_helper.db["sensor"].update_one({"sensor_id": "s0"}, {"$set": {DELETED_FIELD: True}})
+
+    count_documents = Sensor.count_documents
+
+    def count_during_an_insert(self):
+        actual = count_documents(self)
+        # an insert through the API lands after the recount read the collection
+        Sensor(mongo_helper)._create_from_script({"sensor_id": "late", "name": "Late"})
+        return actual
+
+    monkeypatch.setattr(Sensor, "count_documents", count_during_an_insert)
+    assert reconcile_counters(mongo_helper, [Sensor]) == {"sensor": (3, 4)}
+    monkeypatch.undo()
+    assert Sensor(mongo_helper).count() == Sensor(mongo_helper).count_documents() == 5
+
+
+def test_one_reconciler_per_interval(mongo_helper, redis_helper):
+    add_sensors(mongo_helper, 2)
+    mongo_helper.set_counter("sensor", 10)
+    workers = [CounterReconciler(mongo_helper, redis_helper, interval=60) for _ in range(2)]
+
+    assert workers[0].reconcile()["sensor"] == (10, 2)
+    assert workers[1].reconcile() is None
+    assert workers[0].reconcile() is None
+
+
+@pytest.mark.parametrize("query, expected", [("", 4), ("?estimated=true", 5), ("?estimated=false", 4)])
+def test_event_count(api, auth, query, expected):
+    from routes import api_v1
+    mongo_helper = api_v1.mongo_helper
+    mongo_helper.add_events([mongo_helper.build_event("s1", "t1", "i1", 1000.0 + i, None) for i in range(4)])
+    Event(mongo_helper).count()
+    # written outside the API: only the collection metadata sees it until the next reconciliation
+    mongo_helper.db["event"].insert_one(mongo_helper.build_event("s1", "t1", "i1", 2000.0, None))
+
+    response = api.get("/api/v1/event_count" + query, headers=auth)
+    assert response.get_json() == {"event_count": expected}
+    assert Event(mongo_helper).count() == 4
@@ -0,0 +1,149 @@
+import base64
+
+import pytest
+from bson import ObjectId
+
+from database.classes import Event
+from database.event_storage import build_event_storage, EVENT_STORAGE_BUCKET, EVENT_STORAGE_DOCUMENT
+
+
+@pytest.fixture(params=[EVENT_STORAGE_DOCUMENT, EVENT_STORAGE_BUCKET])
+def events(request, mongo_helper, monkeypatch):
+    # small buckets, so the hours of the bucket layout are split in several buckets
+    mongo_helper.event_storage = build_event_storage(mongo_helper, request.param, max_bucket_size=2)
+    # mongomock has no $unionWith, every key goes in its own aggregation
+    monkeypatch.setattr(Event, "last_events_chunk_size", 1)
+    events = [mongo_helper.build_event("s%d" % (i % 2), "t%d" % (i % 3), "i%d" % (i % 3), 1000.0 + i * 300, "read")
+              for i in range(60)]
+    mongo_helper.add_events(events)
+    return events
+
+
+@pytest.mark.parametrize("key_field, limit, skip", [
+    ("sensor_id", 10, 0), ("sensor_id", 3, 4), ("item_id", 5, 2), ("item_id", None, 0), ("item_id", None, 25),
+])
+def test_last_events_by(mongo_helper, events, key_field, limit, skip):
+    results = Event(mongo_helper).last_events_by(key_field, ["s0", "s1", "i0", "i1", "i2", "unknown"], limit, skip)
+
+    keys = sorted(set(x[key_field] for x in events))
+    expected = {}
+    for key in keys:
+        newest = sorted((x for x in events if x[key_field] == key), key=lambda x: -x["event_timestamp"])
+        newest = newest[skip:skip + limit] if limit else newest[skip:]
+        if newest:
+            expected[key] = [x["event_timestamp"] for x in newest]
+    assert {k: [x["event_timestamp"] for x in v] for k, v in results.items()} == expected
+
+
+@pytest.mark.parametrize("query, error", [
+    ("limit=abc", "limit must be a non-negative integer"), ("limit=-1", "limit must be a non-negative integer"),
+    ("skip=1.5", "skip must be a non-negative integer"),
+])
+def test_read_event_rejects_invalid_pages(api, auth, query, error):
+    # a ValueError of the view is a bad request, not an expired token (498)
+    response = api.get("/api/v1/event?" + query, headers=auth)
+    assert response.status_code == 400
+    assert response.get_json() == {"error": error}
+
+    response = api.post("/api/v1/search/event", json={"limit": "abc"}, headers=auth)
+    assert response.status_code == 400
+
+
+def test_expired_token(api):
+    response = api.get("/api/v1/event", headers={"Authorization": "bearer unknown"})
+    assert response.status_code == 498
+
+
+def add_detailed_events(mongo_helper):
+    mongo_helper.db["sensor"].insert_many([{"sensor_id": "s1", "name": "Sensor 1", "__deleted": True},
+                                           {"sensor_id": "s1", "name": "Sensor 1 again"},
+                                           {"sensor_id": "s2", "name": "Sensor 2", "__deleted": True}])
+    mongo_helper.db["item"].insert_one({"item_id": "i1", "name": "Item 1", "tags": ["t1"], "internal": "x"})
+    mongo_helper.add_events([mongo_helper.build_event("s%d" % (i % 2 + 1), "t1", "i1", 1000.0 + i, {"read": i})
+                             for i in range(6)])
+
+
+def test_events_with_details(mongo_helper):
+    add_detailed_events(mongo_helper)
+    results = Event(mongo_helper).filter_events_with_details()
+    assert [x["event_timestamp"] for x in results] == [1005.0, 1004.0, 1003.0, 1002.0, 1001.0, 1000.0]
+    # the live sensor of a re-created id, None for a deleted one, and only the schema fields of the item
+    assert {x["sensor_id"]: x["sensor"] and x["sensor"]["name"] for x in results} == {"s1": "Sensor 1 again",
+                                                                                     "s2": None}
+    assert all(x["item"]["name"] == "Item 1" and "internal" not in x["item"] for x in results)
+
+    results = Event(mongo_helper).filter_events_with_details(sensor_id=["s1"], fields=["event_timestamp", "sensor"])
+    assert [set(x) for x in results] == [{"_id", "event_timestamp", "sensor"}] * 3
+
+
+def test_events_with_details_pages(api, auth):
+    from routes import api_v1
+    add_detailed_events(api_v1.mongo_helper)
+    pages = []
+    cursor = ""
+    while cursor is not None:
+        response = api.post("/api/v1/search/event", json={"limit": 4, "cursor": cursor, "fields": ["item"]},
+                            headers=auth)
+        assert response.status_code == 200
+        pages.append(response.get_json()["events"])
+        cursor = response.get_json()["next_cursor"]
+    assert [[x["event_timestamp"] for x in page] for page in pages] == [[1005.0, 1004.0, 1003.0, 1002.0],
+                                                                        [1001.0, 1000.0]]
+    assert all(x["item"]["item_id"] == "i1" and "sensor" not in x for page in pages for x in page)
+
+
+def test_cursor_round_trip():
+    event = {"event_timestamp": 1000.5, "_id": ObjectId()}
+    assert Event.decode_cursor(Event.encode_cursor(event)) == (1000.5, event["_id"])
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor", base64.urlsafe_b64encode(b"[1, 2]").decode(), base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    base64.urlsafe_b64encode(b'{"t": 1}').decode(), base64.urlsafe_b64encode(b'{"t": 1, "id": "nope"}').decode(),
+])
+def test_invalid_cursors(api, auth, cursor):
+    with pytest.raises(ValueError):
+        Event.decode_cursor(cursor)
+    response = api.get("/api/v1/event", query_string={"cursor": cursor}, headers=auth)
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor %s" % cursor}
+
+
+def test_cursor_pages_split_equal_timestamps(mongo_helper):
+    # the _id breaks the ties, no event is repeated or skipped between pages
+    mongo_helper.db["event"].insert_many([mongo_helper.build_event("s1", "t1", "i1", 1000.0 + i // 3, None)
+                                          for i in range(7)])
+    event = Event(mongo_helper)
+    pages = []
+    cursor = ""
+    while cursor is not None:
+        page = event.filter_events(limit=2, cursor=cursor)
+        pages.append(page)
+        cursor = event.next_cursor(page, 2)
+    assert [len(x) for x in pages] == [2, 2, 2, 1]
+    ids = [x["_id"] for page in pages for x in page]
+    assert sorted(ids) == sorted(str(x["_id"]) for x in mongo_helper.db["event"].find())
+    assert [x["event_timestamp"] for page in pages for x in page] == [1002.0, 1001.0, 1001.0, 1001.0, 1000.0,
+                                                                      1000.0, 1000.0]
+
+
+def test_search_event_matches_hyphenated_ids(api, auth, monkeypatch):
+    from database.classes import Item, Sensor
+    from routes import api_v1
+    mongo_helper = api_v1.mongo_helper
+    mongo_helper.db["sensor"].insert_many([{"sensor_id": "dock-1", "name": "Dock"},
+                                           {"sensor_id": "dock-2", "name": "Dock"}])
+    mongo_helper.db["item"].insert_many([{"item_id": "pallet-a", "name": "Pallet", "tags": ["t1"]},
+                                         {"item_id": "pallet-b", "name": "Pallet", "tags": ["t2"]}])
+    mongo_helper.add_events([mongo_helper.build_event("dock-%d" % (i % 2 + 1), "t%d" % (i // 2 % 2 + 1),
+                                                      "pallet-%s" % "ab"[i // 2 % 2], 1000.0 + i, None)
+                             for i in range(8)])
+    # $text would match every id sharing the "dock" or "pallet" token
+    for cls in (Sensor, Item):
+        monkeypatch.setattr(cls, "_text_search", lambda *args: pytest.fail("the id filter used $text"))
+
+    response = api.post("/api/v1/search/event", json={"sensor_query": "dock-1", "item_query": "pallet-b",
+                                                      "fields": ["sensor_id", "item_id"]}, headers=auth)
+    assert response.status_code == 200
+    assert {(x["sensor_id"], x["item_id"]) for x in response.get_json()} == {("dock-1", "pallet-b")}
+    assert len(response.get_json()) == 2
@@ -0,0 +1,104 @@
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from google_utils import GoogleIdentity
+
+CLIENT_ID = "client.apps.googleusercontent.com"
+
+
+class StubResponse:
+    status_code = 200
+    headers = {"Cache-Control": "public, max-age=3600"}
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def jwks_calls(monkeypatch, private_key):
+    calls = []
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid="k1", alg="RS256", use="sig")
+
+    def get(url, **kwargs):
+        calls.append(url)
+        if url == "jwks":
+            return StubResponse({"keys": [jwk]})
+        return StubResponse({"email": "user@example.com"})
+    monkeypatch.setattr("requests.Session.get", lambda session, url, **kwargs: get(url, **kwargs))
+    return calls
+
+
+def id_token(private_key, kid="k1", aud=CLIENT_ID):
+    claims = {"iss": "https://accounts.google.com", "aud": aud, "email": "user@example.com", "email_verified": True,
+              "exp": int(time.time()) + 60}
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_id_token_audience_is_checked(jwks_calls, private_key):
+    identity = GoogleIdentity(jwks_url="jwks", client_id=CLIENT_ID)
+    assert identity.get_login_data(id_token(private_key))["email"] == "user@example.com"
+    with pytest.raises(ValueError):
+        identity.get_login_data(id_token(private_key, aud="other.apps.googleusercontent.com"))
+
+
+def test_id_token_is_refused_without_client_id(jwks_calls, private_key):
+    identity = GoogleIdentity(jwks_url="jwks", userinfo_url="userinfo")
+    with pytest.raises(ValueError):
+        identity.get_login_data(id_token(private_key, aud="any.apps.googleusercontent.com"))
+    # the access_token supplied with it is resolved by Google instead
+    data = identity.get_login_data(id_token(private_key), "access-token")
+    assert data == {"email": "user@example.com"} and jwks_calls == ["userinfo"]
+
+
+def test_unknown_kid_refetches_keys_at_most_once_per_interval(jwks_calls, private_key):
+    identity = GoogleIdentity(jwks_url="jwks", client_id=CLIENT_ID, jwks_min_refresh_interval=60)
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            identity.verify_id_token(id_token(private_key, kid="unknown"))
+    assert jwks_calls == ["jwks"]
+    identity.verify_id_token(id_token(private_key))
+    assert jwks_calls == ["jwks"]
+
+
+
+@pytest.fixture
+def jwks_with_bad_keys(monkeypatch, private_key):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid="k1", alg="RS256", use="sig")
+    keys = [{"kid": "oct", "kty": "oct"}, {"kid": "bad-n", "kty": "RSA", "n": "!!", "e": "AQAB"},
+            {"kid": "new", "kty": "OKP-future"}, jwk]
+    monkeypatch.setattr("requests.Session.get", lambda session, url, **kwargs: StubResponse({"keys": keys}))
+
+
+def test_unusable_signing_keys_are_skipped(jwks_with_bad_keys, private_key):
+    identity = GoogleIdentity(jwks_url="jwks", client_id=CLIENT_ID)
+
+    assert set(identity.signing_keys()) == {"k1"}
+    assert identity.verify_id_token(id_token(private_key))["email"] == "user@example.com"
+    with pytest.raises(ValueError, match="Unknown signing key bad-n"):
+        identity.verify_id_token(id_token(private_key, kid="bad-n"))
+
+
+@pytest.mark.parametrize("aud, status", [(CLIENT_ID, 200), ("other.apps.googleusercontent.com", 401)])
+def test_login_with_bad_keys_in_the_jwks(api, jwks_with_bad_keys, private_key, monkeypatch, aud, status):
+    from routes import api_v1
+    monkeypatch.setattr(api_v1, "google_identity", GoogleIdentity(jwks_url="jwks", client_id=CLIENT_ID))
+    response = api.post("/api/v1/login", json={"id_token": id_token(private_key, aud=aud),
+                                               "email": "user@example.com"})
+    assert response.status_code == status
@@ -0,0 +1,75 @@
+import pytest
+
+from ingest import ingest_events, invalid_event_fields, summarize_results, EVENT_ACCEPTED, EVENT_REJECTED
+
+
+@pytest.fixture
+def registered(mongo_helper):
+    mongo_helper.db["sensor"].insert_one({"sensor_id": "s1", "name": "Sensor 1"})
+    mongo_helper.db["item"].insert_one({"item_id": "i1", "name": "Item 1", "tags": ["t1"]})
+    return mongo_helper
+
+
+@pytest.mark.parametrize("raw_event, error", [
+    ({"sensor_id": "s1", "tag_id": "t1", "event_timestamp": 1.5}, None),
+    ({"sensor_id": 10, "tag_id": "t1", "event_timestamp": "2020-01-01T00:00:00"}, None),
+    ({"sensor_id": "s1", "tag_id": "t1"}, "missing fields for registration"),
+    ("not an event", "missing fields for registration"),
+    ({"sensor_id": ["s1"], "tag_id": "t1", "event_timestamp": 1}, "sensor_id must be a string or a number"),
+    ({"sensor_id": "s1", "tag_id": {"$ne": None}, "event_timestamp": 1}, "tag_id must be a string or a number"),
+    ({"sensor_id": "s1", "tag_id": "t1", "event_timestamp": True}, "event_timestamp must be a string or a number"),
+])
+def test_invalid_event_fields(raw_event, error):
+    assert invalid_event_fields(raw_event) == error
+
+
+def test_malformed_events_are_rejected_one_by_one(registered):
+    results = ingest_events(registered, [
+        {"sensor_id": "s1", "tag_id": "t1", "event_timestamp": 1, "event_details": "ok"},
+        {"sensor_id": ["s1"], "tag_id": "t1", "event_timestamp": 2},
+        {"sensor_id": "s1", "tag_id": "t1", "event_timestamp": {"$gt": 0}},
+    ])
+    assert [x["status"] for x in results] == [EVENT_ACCEPTED, EVENT_REJECTED, EVENT_REJECTED]
+    assert results[1]["error"] == "sensor_id must be a string or a number"
+    assert summarize_results(results)["accepted"] == 1
+    assert registered.db["event"].count_documents({}) == 1
+
+
+def test_post_event_refuses_malformed_fields(api):
+    from routes import api_v1
+    api_v1.mongo_helper.db["sensor"].insert_one({"sensor_id": "s1", "name": "Sensor 1"})
+    api_v1.mongo_helper.db["item"].insert_one({"item_id": "i1", "name": "Item 1", "tags": ["t1"]})
+
+    response = api.post("/api/v1/event", json={"sensor_id": "s1", "tag_id": ["t1"], "event_timestamp": 1})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "tag_id must be a string or a number"}
+
+    response = api.post("/api/v1/event", json={"sensor_id": "s1", "tag_id": "t1", "event_timestamp": 1})
+    assert response.status_code == 200
+
+
+def test_batch_rejects_malformed_events_without_failing_the_batch(api):
+    from routes import api_v1
+    api_v1.mongo_helper.db["sensor"].insert_one({"sensor_id": "s1", "name": "Sensor 1"})
+    api_v1.mongo_helper.db["item"].insert_one({"item_id": "i1", "name": "Item 1", "tags": ["t1"]})
+
+    response = api.post("/api/v1/event/batch", json=[
+        {"sensor_id": "s1", "tag_id": "t1", "event_timestamp": 1},
+        {"sensor_id": {"a": 1}, "tag_id": "t1", "event_timestamp": 2},
+    ])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body["accepted"], body["rejected"]) == (1, 1)
+
+
+def test_post_event_answers_409_for_a_duplicate(api, caplog):
+    from routes import api_v1
+    api_v1.mongo_helper.db["sensor"].insert_one({"sensor_id": "s1"})
+    api_v1.mongo_helper.db["item"].insert_one({"item_id": "i1", "tags": ["t1"]})
+    event = {"sensor_id": "s1", "tag_id": "t1", "event_timestamp": 1000.0, "event_details": None}
+
+    assert api.post("/api/v1/event", json=event).status_code == 200
+    response = api.post("/api/v1/event", json=event)
+    assert response.status_code == 409
+    assert response.get_json() == {"error": "Received event is already in database", "status": "duplicate"}
+    assert "Unhandled error" not in caplog.text
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+import redis
+
+import database.ingest_queue
+from database.ingest_queue import IngestQueue, IngestWorker, INGEST_MODE_QUEUE
+
+
+@pytest.fixture
+def queue(redis_helper):
+    return IngestQueue(redis_helper, max_length=100, max_deliveries=3)
+
+
+def dead_letters(queue):
+    r = redis.Redis(connection_pool=queue.redis_helper._pool)
+    return [fields for _, fields in r.xrange(queue.dead_letter_stream)]
+
+
+def event(tag_id, event_timestamp):
+    return {"sensor_id": "s1", "tag_id": tag_id, "event_timestamp": event_timestamp, "event_details": None}
+
+
+def test_enqueue_read_and_ack(queue):
+    ids = queue.enqueue([event("t1", 1), event("t1", 2)])
+    assert all(isinstance(x, str) for x in ids)
+
+    messages, dead_lettered = queue.read("c1", 10, None, 60000)
+    assert [x[0] for x in messages] == ids
+    assert [x[1]["event_timestamp"] for x in messages] == [1, 2]
+    assert dead_lettered == 0
+
+    queue.ack(ids)
+    assert queue.metrics() == {"depth": 0, "pending": 0, "max_length": 100, "dead_letter_depth": 0}
+
+
+def test_malformed_messages_are_dead_lettered(queue, redis_helper):
+    redis_helper.stream_add(queue.stream, {"event": "{not json"})
+    redis_helper.stream_add(queue.stream, {"event": json.dumps(event(["t1"], 1))})
+    redis_helper.stream_add(queue.stream, {"other": "field"})
+    queue.enqueue([event("t1", 1)])
+
+    messages, dead_lettered = queue.read("c1", 10, None, 60000)
+    assert len(messages) == 1
+    assert dead_lettered == 3
+    assert queue.metrics()["depth"] == 1
+    assert queue.metrics()["dead_letter_depth"] == 3
+    assert [x["reason"] for x in dead_letters(queue)] == [
+        "malformed message", "tag_id must be a string or a number", "malformed message"]
+
+
+def test_poison_message_is_dead_lettered_after_max_deliveries(queue, mongo_helper, monkeypatch):
+    def ingest_events(helper, payload):
+        if any(x["tag_id"] == "poison" for x in payload):
+            raise ValueError("can't store this event")
+        return [{"status": "accepted"} for _ in payload]
+    monkeypatch.setattr(database.ingest_queue, "ingest_events", ingest_events)
+    worker = IngestWorker(queue, mongo_helper)
+    _, poison_id = queue.enqueue([event("t1", 1), event("poison", 2)])
+
+    # the batch fails, the good message is stored on its own and only the poison one stays pending
+    messages, _ = queue.read(worker.consumer, 10, None, 60000)
+    assert worker.ingest(messages) == [{"status": "accepted"}]
+    assert queue.metrics()["pending"] == 1
+    assert worker.counters["failed_messages"] == 1
+
+    for _ in range(queue.max_deliveries - 1):
+        messages, dead_lettered = queue.read(worker.consumer, 10, None, 0)
+        assert [x[0] for x in messages] == [poison_id] and dead_lettered == 0
+        with pytest.raises(ValueError):
+            worker.ingest(messages)
+
+    messages, dead_lettered = queue.read(worker.consumer, 10, None, 0)
+    assert messages == [] and dead_lettered == 1
+    assert queue.metrics()["pending"] == 0
+    assert queue.metrics()["depth"] == 0
+    assert dead_letters(queue) == [{"event": json.dumps(event("poison", 2)), "reason": "not stored after 3 deliveries",
+                                    "deliveries": "4"}]
+
+
+def test_post_event_in_queue_mode(api, monkeypatch, redis_helper):
+    from routes import api_v1
+    queue = IngestQueue(redis_helper)
+    monkeypatch.setattr(api_v1, "ingest_mode", INGEST_MODE_QUEUE)
+    monkeypatch.setattr(api_v1, "ingest_queue", queue)
+
+    response = api.post("/api/v1/event", json=event("t1", 1))
+    assert response.status_code == 202
+    message_id = response.get_json()["Event queued successfully"]
+    messages, _ = queue.read("c1", 10, None, 60000)
+    assert messages == [(message_id, event("t1", 1))]
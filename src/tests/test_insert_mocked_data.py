@@ -0,0 +1,84 @@
+import json
+
+import insert_mocked_data
+from database.classes import Event, Sensor
+from database.collection_versions import CollectionVersions
+from insert_mocked_data import events_per_item, generate_item, generate_item_events, generate_sensors, \
+    generate_shard, insert_chunked, sensor_id_of
+from ingest import invalid_event_fields
+
+ITEMS = 20
+SENSORS = 10
+START = 1600000000.0
+STEP = 30.0
+
+
+def options(**overrides):
+    return dict({"items": ITEMS, "sensors": SENSORS, "events": 205, "seed": 7, "restricted_ratio": 0.5,
+                 "wander_ratio": 0.2, "move_ratio": 0.1, "start": START, "step": STEP, "chunk_size": 50,
+                 "ndjson": None}, **overrides)
+
+
+def all_events(seed=7, restricted_ratio=0.5):
+    events = []
+    for i in range(ITEMS):
+        item = generate_item(i, SENSORS, seed, restricted_ratio)
+        events.extend(generate_item_events(i, item, ITEMS, SENSORS, events_per_item(i, ITEMS, 205), seed, START,
+                                           STEP, 0.1, 0.2))
+    return events
+
+
+def test_the_seed_decides_the_data():
+    assert all_events() == all_events()
+    assert all_events() != all_events(seed=8)
+    assert [generate_item(i, SENSORS, 7, 0.5) for i in range(ITEMS)] == \
+           [generate_item(i, SENSORS, 7, 0.5) for i in range(ITEMS)]
+
+
+def test_events():
+    events = all_events()
+    assert sum(events_per_item(i, ITEMS, 205) for i in range(ITEMS)) == len(events) == 205
+    timestamps = [x["event_timestamp"] for x in events]
+    assert len(set(timestamps)) == len(timestamps)
+    assert all(START <= x < START + (205 + ITEMS) * STEP for x in timestamps)
+
+    sensors = {x["sensor_id"] for x in generate_sensors(SENSORS)}
+    assert {x["sensor_id"] for x in events} <= sensors
+    items = {str(i): generate_item(i, SENSORS, 7, 0.5) for i in range(ITEMS)}
+    for event in events:
+        whitelist = items[event["item_id"]]["location_whitelist"]
+        # only restricted items read outside their area raise alerts
+        assert bool(event["alert"]) == bool(whitelist and event["sensor_id"] not in whitelist)
+    assert any(x["alert"] for x in events)
+    assert not any(x["alert"] for x in all_events(restricted_ratio=0))
+
+
+def test_item_area_is_around_its_home():
+    for i in range(ITEMS):
+        item = generate_item(i, SENSORS, 7, 1)
+        assert item["default_storage_location"] in item["location_whitelist"]
+        assert all(x in {sensor_id_of(y) for y in range(SENSORS)} for x in item["location_whitelist"])
+
+
+def test_shard_writes_ndjson_accepted_by_the_api(tmp_path, monkeypatch):
+    monkeypatch.setattr(insert_mocked_data, "mongo_helper", None)
+    assert generate_shard((3, 0, 5, options(ndjson=str(tmp_path)))) == sum(events_per_item(i, ITEMS, 205)
+                                                                          for i in range(5))
+    lines = [json.loads(x) for x in (tmp_path / "events-0003.ndjson").read_text().splitlines()]
+    assert len(lines) == 55
+    assert all(invalid_event_fields(x) is None and set(x) == {"sensor_id", "tag_id", "event_timestamp",
+                                                              "event_details"} for x in lines)
+
+
+def test_shards_insert_events_and_counters(mongo_helper, redis_helper, monkeypatch):
+    monkeypatch.setattr(insert_mocked_data, "mongo_helper", mongo_helper)
+    mongo_helper.collection_versions = CollectionVersions(redis_helper)
+    version = mongo_helper.collection_versions.get("sensor")
+
+    insert_chunked(mongo_helper, Sensor, generate_sensors(SENSORS), 3)
+    assert Sensor(mongo_helper).count() == SENSORS
+    assert mongo_helper.collection_versions.get("sensor") != version
+
+    written = sum(generate_shard((x, x * 10, x * 10 + 10, options())) for x in range(2))
+    assert written == Event(mongo_helper).count() == mongo_helper.db["event"].count_documents({}) == 205
+    assert mongo_helper.db["event_hourly"].count_documents({}) > 0
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+
+import instrumentation
+from instrumentation import BACKGROUND, MongoCommandListener
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def command_event(command_name, command, request_id, duration_micros=2000):
+    return SimpleNamespace(command_name=command_name, command=command, connection_id=("localhost", 27017),
+                           request_id=request_id, duration_micros=duration_micros)
+
+
+def test_requests_are_counted_per_endpoint_and_status(api, auth):
+    endpoint = "routes.api_v1.read_event"
+    before = {status: sample("http_request_duration_seconds_count", endpoint=endpoint, method="GET", status=status)
+              for status in ("200", "401")}
+    api.get("/api/v1/event")
+    api.get("/api/v1/event", headers=auth)
+    api.get("/api/v1/event", headers=auth)
+
+    for status, requests in (("200", 2), ("401", 1)):
+        assert sample("http_request_duration_seconds_count", endpoint=endpoint, method="GET",
+                      status=status) == before[status] + requests
+    assert sample("mongo_commands_per_request_count", endpoint=endpoint) >= 3
+
+    response = api.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{endpoint="%s",method="GET",status="200"}' % endpoint \
+           in response.get_data(as_text=True)
+
+
+def test_unmatched_paths_use_no_endpoint(api):
+    before = sample("http_request_duration_seconds_count", endpoint=instrumentation.NO_ENDPOINT, method="GET",
+                    status="404")
+    assert api.get("/nope").status_code == 404
+    assert sample("http_request_duration_seconds_count", endpoint=instrumentation.NO_ENDPOINT, method="GET",
+                  status="404") == before + 1
+
+
+@pytest.mark.parametrize("command_name, command, collection", [
+    ("find", {"find": "sensor", "filter": {}}, "sensor"),
+    ("getMore", {"getMore": 12345, "collection": "event"}, "event"),
+    ("aggregate", {"aggregate": 1, "pipeline": []}, ""),
+])
+def test_mongo_commands_outside_requests(command_name, command, collection):
+    listener = MongoCommandListener()
+    labels = dict(endpoint=BACKGROUND, collection=collection, command=command_name)
+    before = (sample("mongo_commands_total", status="succeeded", **labels),
+              sample("mongo_commands_total", status="failed", **labels),
+              sample("mongo_command_seconds_total", **labels))
+
+    listener.started(command_event(command_name, command, 1))
+    listener.succeeded(command_event(command_name, command, 1, duration_micros=1500))
+    listener.started(command_event(command_name, command, 2))
+    listener.failed(command_event(command_name, command, 2, duration_micros=500))
+
+    assert sample("mongo_commands_total", status="succeeded", **labels) == before[0] + 1
+    assert sample("mongo_commands_total", status="failed", **labels) == before[1] + 1
+    assert sample("mongo_command_seconds_total", **labels) == pytest.approx(before[2] + 0.002)
+    assert listener._started == {}
+
+
+def test_mongo_commands_are_attributed_to_the_request(api):
+    from app import app
+    listener = MongoCommandListener()
+    labels = dict(endpoint="routes.api_v1.read_event", collection="event", command="find", status="succeeded")
+    before = sample("mongo_commands_total", **labels)
+
+    with app.test_request_context("/api/v1/event"):
+        instrumentation.g.mongo_commands = 0
+        listener.started(command_event("find", {"find": "event"}, 1))
+        assert instrumentation.g.mongo_commands == 1
+    # the reply may be handled after the request context is gone, the endpoint is the one seen when it started
+    listener.succeeded(command_event("find", {"find": "event"}, 1))
+    assert sample("mongo_commands_total", **labels) == before + 1
+
+
+def test_unhandled_exceptions_are_counted(api, auth, monkeypatch):
+    from routes import api_v1
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(api_v1.Event, "count", fail)
+    labels = dict(endpoint="routes.api_v1.get_event_count", exception="RuntimeError")
+    before = sample("http_request_exceptions_total", **labels)
+
+    assert api.get("/api/v1/event_count", headers=auth).status_code == 500
+    assert sample("http_request_exceptions_total", **labels) == before + 1
@@ -0,0 +1,40 @@
+from database.classes import ItemLocation
+
+
+def add_event(mongo_helper, event_timestamp, sensor_id="s1", alert=None):
+    event = mongo_helper.build_event(sensor_id, "t1", "i1", event_timestamp, "read", alert)
+    mongo_helper.add_events([event])
+    return event
+
+
+def location(mongo_helper):
+    return dict(ItemLocation(mongo_helper, "i1"))
+
+
+def test_alert_stays_open_until_read(mongo_helper):
+    add_event(mongo_helper, 100)
+    assert location(mongo_helper)["alert"] is None
+
+    alert_event = add_event(mongo_helper, 200, sensor_id="s2", alert=1)
+    add_event(mongo_helper, 300, sensor_id="s1")
+    current = location(mongo_helper)
+    assert (current["sensor_id"], current["last_seen"]) == ("s1", 300)
+    assert (current["alert"], current["alert_timestamp"]) == (1, 200)
+    assert current["alert_event_id"] == str(alert_event["_id"])
+
+    ItemLocation(mongo_helper, "i1").mark_alert_read()
+    assert location(mongo_helper)["alert"] is None
+
+
+def test_only_newer_alerts_open_again(mongo_helper):
+    add_event(mongo_helper, 200, alert=1)
+    ItemLocation(mongo_helper, "i1").mark_alert_read()
+
+    # a late retry of an alert older than the one read
+    add_event(mongo_helper, 150, alert=2)
+    assert location(mongo_helper)["alert"] is None
+
+    add_event(mongo_helper, 250, alert=3)
+    assert location(mongo_helper)["alert"] == 3
+    add_event(mongo_helper, 220, alert=4)
+    assert location(mongo_helper)["alert"] == 3
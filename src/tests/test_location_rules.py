@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from database.location_rules import LocationRules, parse_time_windows, parse_utc_offset, ALERT_UNREAD
+
+
+@pytest.mark.parametrize("value", [
+    ["08:00", "18:00"],
+    {"s1": [["8", "18:00"]]},
+    {"s1": [["08:00", "25:00"]]},
+    {"s1": [["08:00"]]},
+    {"s1": "08:00-18:00"},
+    {"s1": [[800, 1800]]},
+])
+def test_invalid_time_windows(value):
+    with pytest.raises(ValueError):
+        parse_time_windows(value)
+
+
+def test_time_windows_are_read_in_the_configured_zone():
+    item = {"item_id": "i1", "allowed_time_windows": {"s1": [["08:00", "18:00"]], "s2": [["22:00", "08:00"]]}}
+    # 10:00 UTC is 07:00 in -03:00
+    timestamp = datetime(2021, 10, 1, 10, 0, tzinfo=timezone.utc).timestamp()
+    assert LocationRules.compile(item, {}).evaluate("s1", timestamp) is None
+    rules = LocationRules.compile(item, {}, parse_utc_offset("-03:00"))
+    assert rules.evaluate("s1", timestamp) == ALERT_UNREAD
+    assert rules.evaluate("s2", timestamp) is None
+
+
+def test_malformed_stored_windows_are_ignored():
+    rules = LocationRules.compile({"item_id": "i1", "allowed_time_windows": {"s1": [["8", "18"]]}}, {})
+    assert rules.evaluate("s1", 0) is None
+
+
+def test_item_with_malformed_windows_is_refused(api, auth):
+    item = {"item_id": "i1", "name": "Item 1", "tags": ["t1"], "allowed_time_windows": {"s1": [["8", "18:00"]]}}
+    response = api.post("/api/v1/item", json=item, headers=auth)
+    assert response.status_code == 400
+    assert "allowed_time_windows" in response.get_json()["Message"]
+
+    item["allowed_time_windows"] = {"s1": [["08:00", "18:00"]]}
+    assert api.post("/api/v1/item", json=item, headers=auth).status_code == 200
+    response = api.put("/api/v1/item/i1", json={"allowed_time_windows": {"s1": ["08:00", "18:00"]}},
+                       headers=auth)
+    assert response.status_code == 400
@@ -0,0 +1,62 @@
+import pytest
+
+from database.collection_versions import CollectionVersions
+from database.lookup_cache import LookupCache
+from database.mongo_helper import MongoHelper
+
+
+def test_values_loaded_before_clear_are_not_cached():
+    cache = LookupCache(ttl=60)
+
+    def loader(key):
+        # a write and its invalidation happen while the old value is being read
+        cache.clear()
+        return "stale"
+
+    assert cache.get("k", loader) == "stale"
+    assert cache.get("k", lambda _: "fresh") == "fresh"
+    assert cache.get("k", lambda _: "not loaded") == "fresh"
+
+    cache.clear()
+    assert cache.get_many(["a", "b"], lambda keys: (cache.clear(), {"a": "stale"})[1]) == {"a": "stale", "b": None}
+    assert cache.stats()["size"] == 0
+
+
+@pytest.fixture
+def workers(mongo_helper, redis_helper):
+    # two API processes on the same database and Redis, each with its own lookup caches
+    other = MongoHelper("localhost", 27017, None, None, "admin", "inventio_test", cache_version_check_interval=0)
+    mongo_helper.cache_version_check_interval = 0
+    for helper in (mongo_helper, other):
+        helper.collection_versions = CollectionVersions(redis_helper)
+    return mongo_helper, other
+
+
+def test_writes_of_another_process_invalidate_the_lookups(workers):
+    writer, reader = workers
+    assert reader.get_sensor("s1") is None
+    assert reader.get_items_by_tags(["t1"]) == {}
+
+    writer.db["sensor"].insert_one({"sensor_id": "s1"})
+    writer.db["item"].insert_one({"item_id": "i1", "tags": ["t1"]})
+    # without the version stamps the cached misses would hide them until the cache ttl
+    assert reader.get_sensor("s1") is None
+    for collection_name in ("sensor", "item"):
+        writer.invalidate_lookup_cache(collection_name)
+        writer.bump_collection_version(collection_name)
+
+    assert reader.get_sensor("s1")["sensor_id"] == "s1"
+    assert reader.get_items_by_tags(["t1"])["t1"]["item_id"] == "i1"
+
+
+def test_version_checks_are_throttled(workers, monkeypatch):
+    writer, reader = workers
+    reader.cache_version_check_interval = 60
+    assert reader.get_sensor("s1") is None
+
+    reads = []
+    monkeypatch.setattr(reader.collection_versions, "get", lambda name: reads.append(name))
+    writer.db["sensor"].insert_one({"sensor_id": "s1"})
+    writer.bump_collection_version("sensor")
+    assert reader.get_sensor("s1") is None
+    assert reads == []
@@ -0,0 +1,107 @@
+"""
+Integration tests of the aggregation pipelines mongomock can't run ($unionWith, $text). Like test_asgi_parity.py they
+need a mongod and are skipped unless INVENTIO_TEST_MONGO_URL is set. The database inventio_pipelines_test is dropped
+before and after each test.
+"""
+import os
+
+import pytest
+
+from database.classes import Event
+from database.event_storage import build_event_storage, EVENT_STORAGE_BUCKET, EVENT_STORAGE_DOCUMENT
+from database.indexes import ensure_indexes
+
+MONGO_URL = os.environ.get("INVENTIO_TEST_MONGO_URL")
+DATABASE = "inventio_pipelines_test"
+
+pytestmark = pytest.mark.skipif(not MONGO_URL, reason="needs a mongod, set INVENTIO_TEST_MONGO_URL")
+
+
+@pytest.fixture
+def mongod_helper(monkeypatch):
+    from routes import api_v1
+
+    mongo_helper = api_v1.mongo_helper
+    monkeypatch.setattr(mongo_helper, "client_settings", {"host": MONGO_URL})
+    monkeypatch.setattr(mongo_helper, "database", DATABASE)
+    monkeypatch.setattr(mongo_helper, "_client", None)
+    # restored after the tests that replace it
+    monkeypatch.setattr(mongo_helper, "event_storage", mongo_helper.event_storage)
+    mongo_helper.client.drop_database(DATABASE)
+    try:
+        yield mongo_helper
+    finally:
+        mongo_helper.client.drop_database(DATABASE)
+
+
+def add_history(mongo_helper):
+    # s0 and i0 have a long history, s1 and i1 a short one, i2 a single event
+    events = [mongo_helper.build_event("s%d" % int(i % 5 == 0), "t", "i%d" % (0 if i % 5 else 1), 1000.0 + i * 300,
+                                       {"read": i}) for i in range(40)]
+    events.append(mongo_helper.build_event("s0", "t", "i2", 500.0, None))
+    mongo_helper.add_events(events)
+    return events
+
+
+def newest(events, key_field, key, limit, skip):
+    timestamps = sorted((x["event_timestamp"] for x in events if x[key_field] == key), reverse=True)
+    return timestamps[skip:skip + limit] if limit else timestamps[skip:]
+
+
+@pytest.mark.parametrize("event_storage", [EVENT_STORAGE_DOCUMENT, EVENT_STORAGE_BUCKET])
+@pytest.mark.parametrize("chunk_size", [100, 2])
+@pytest.mark.parametrize("key_field, keys, limit, skip", [
+    ("sensor_id", ["s0", "s1"], 5, 0), ("sensor_id", ["s0", "s1", "unknown"], 3, 6),
+    ("item_id", ["i0", "i1", "i2"], 4, 1), ("item_id", ["i2", "i1", "i0"], None, 7),
+])
+def test_last_events_by_union(mongod_helper, monkeypatch, event_storage, chunk_size, key_field, keys, limit, skip):
+    mongod_helper.event_storage = build_event_storage(mongod_helper, event_storage, max_bucket_size=4)
+    monkeypatch.setattr(Event, "last_events_chunk_size", chunk_size)
+    ensure_indexes(mongod_helper)
+    events = add_history(mongod_helper)
+
+    results = Event(mongod_helper).last_events_by(key_field, keys, limit, skip)
+    expected = {key: newest(events, key_field, key, limit, skip) for key in keys}
+    assert {k: [x["event_timestamp"] for x in v] for k, v in results.items()} == {k: v for k, v in expected.items()
+                                                                                  if v}
+
+
+def test_search_with_last_activity(mongod_helper, monkeypatch, redis_helper, auth):
+    from app import app
+    from routes import api_v1
+
+    monkeypatch.setattr(api_v1.redis_helper, "_pool", redis_helper._pool)
+    monkeypatch.setattr(app, "before_first_request_funcs", [])
+    ensure_indexes(mongod_helper)
+    mongod_helper.db["item"].insert_many([{"item_id": "i%d" % i, "name": "Pallet %d" % i, "tags": ["t%d" % i]}
+                                          for i in range(4)])
+    events = add_history(mongod_helper)
+
+    response = app.test_client().post("/api/v1/search/item", headers=auth, json={
+        "query": "pallet", "history_limit": 2, "history_skip": 1, "fields": ["item_id", "last_activity"]})
+    assert response.status_code == 200
+    last_activity = {x["item_id"]: x["last_activity"] and [y["event_timestamp"] for y in x["last_activity"]]
+                     for x in response.get_json()}
+    # i2 has a single event, skipped, and i3 none
+    assert last_activity == {"i0": newest(events, "item_id", "i0", 2, 1), "i1": newest(events, "item_id", "i1", 2, 1),
+                             "i2": None, "i3": None}
+
+
+def test_search_event_matches_hyphenated_ids(mongod_helper, monkeypatch, redis_helper, auth):
+    from app import app
+    from routes import api_v1
+
+    monkeypatch.setattr(api_v1.redis_helper, "_pool", redis_helper._pool)
+    monkeypatch.setattr(app, "before_first_request_funcs", [])
+    ensure_indexes(mongod_helper)
+    mongod_helper.db["sensor"].insert_many([{"sensor_id": "dock-%d" % i, "name": "Dock %d" % i} for i in (1, 2)])
+    mongod_helper.add_events([mongod_helper.build_event("dock-%d" % (i % 2 + 1), "t", "i", 1000.0 + i, None)
+                              for i in range(6)])
+
+    client = app.test_client()
+    response = client.post("/api/v1/search/event", headers=auth, json={"sensor_query": "dock-1"})
+    assert response.status_code == 200
+    assert [x["sensor_id"] for x in response.get_json()] == ["dock-1"] * 3
+    # the ranked listing still uses $text, where the hyphen splits the id in tokens
+    response = client.post("/api/v1/search/sensor", headers=auth, json={"query": "dock-1", "fields": ["sensor_id"]})
+    assert sorted(x["sensor_id"] for x in response.get_json()) == ["dock-1", "dock-2"]
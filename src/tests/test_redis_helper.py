@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import pytest
+import redis
+
+from database.classes import Token, USER_ACCESS_DEFAULT
+
+
+def test_pool_decodes_responses(redis_helper):
+    assert redis_helper._pool.connection_kwargs["decode_responses"] is True
+    redis_helper.set("value", "key")
+    redis_helper.set_dict({"a": 1}, "dict")
+    assert redis_helper.get("key") == "value"
+    assert redis_helper.get_dict("dict") == {"a": 1}
+
+
+def test_token_round_trip(redis_helper):
+    user_data = {"email": "user@example.com", "name": "User", "access": USER_ACCESS_DEFAULT}
+    token_id = Token.create_token_from_user_data(redis_helper, user_data)
+
+    token = Token.load(redis_helper, token_id)
+    assert token.token == token_id
+    assert token.user_data == user_data
+    assert token.access_level == USER_ACCESS_DEFAULT
+    assert isinstance(token.last_modified, datetime)
+    assert Token.get_access_level(redis_helper, token_id) == USER_ACCESS_DEFAULT
+
+
+def test_token_sliding_expiration(redis_helper):
+    token_id = Token.create_token_from_user_data(redis_helper, {"email": "user@example.com", "access": 1})
+    r = redis.Redis(connection_pool=redis_helper._pool)
+    key = "%s_%s" % (Token.key_prefix, token_id)
+    r.expire(key, 10)
+    Token.get_access_level(redis_helper, token_id)
+    assert r.ttl(key) > 10
+
+
+def test_deleted_or_unknown_token(redis_helper):
+    token_id = Token.create_token_from_user_data(redis_helper, {"email": "user@example.com", "access": 1})
+    Token(token=token_id).delete(redis_helper)
+    for object_id in (token_id, "unknown"):
+        with pytest.raises(ValueError):
+            Token.load(redis_helper, object_id)
+        with pytest.raises(ValueError):
+            Token.get_access_level(redis_helper, object_id)
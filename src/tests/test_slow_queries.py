@@ -0,0 +1,70 @@
+import json
+
+from database.slow_queries import SlowQueryRecorder, query_shape
+
+
+def recorder_for(mongo_helper, **kwargs):
+    recorder = SlowQueryRecorder(mongo_helper, **kwargs)
+    # mongomock can't create capped collections
+    recorder._collection_ready = True
+    return recorder
+
+
+def explain_stub(calls):
+    def explain():
+        calls.append(1)
+        return {"executionStats": {"totalDocsExamined": 10, "totalKeysExamined": 10},
+                "queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN",
+                                                                                  "indexName": "item_id_1"}}}}
+    return explain
+
+
+def test_query_shape():
+    assert query_shape({"item_id": {"$in": ["a", "b"]}, "t": 1}) == {"item_id": {"$in": ["?"]}, "t": "?"}
+
+
+def test_each_shape_is_explained_once_per_interval(mongo_helper):
+    recorder = recorder_for(mongo_helper, threshold_ms=0, explain_interval=60)
+    calls = []
+    for i in range(3):
+        recorder.record("Item.search", "item", {"item_id": "i%d" % i}, 150, 1, explain_stub(calls))
+    recorder.record("Item.search", "item", {"name": "x"}, 150, 1, explain_stub(calls))
+    assert len(calls) == 2
+
+    entries = list(mongo_helper.db[recorder.collection_name].find({}, {"_id": 0}).sort("timestamp", 1))
+    assert len(entries) == 4
+    assert [x["plan"] for x in entries] == ["FETCH > IXSCAN(item_id_1)"] * 4
+    assert [x.get("docs_examined") for x in entries] == [10, None, None, 10]
+
+
+def test_slow_queries_go_through_one_bounded_worker(mongo_helper):
+    recorder = recorder_for(mongo_helper, threshold_ms=100, queue_size=2)
+    calls = []
+    recorder.check("Item.search", "item", {"item_id": "i1"}, 0.05, 1, explain_stub(calls))
+    assert recorder._worker is None
+
+    # the worker isn't consuming while it waits for the lock of the LookupCache
+    with recorder._explained._lock:
+        for i in range(5):
+            recorder.check("Item.search", "item", {"item_id": "i%d" % i}, 0.2, 1, explain_stub(calls))
+        assert recorder.dropped >= 2
+    recorder._queue.join()
+    assert len(calls) == 1
+    assert mongo_helper.db[recorder.collection_name].count_documents({}) == 5 - recorder.dropped
+
+
+def test_winning_plans_are_stored_without_the_query_values():
+    plan = {"stage": "LIMIT", "limitAmount": 10, "inputStage": {
+        "stage": "FETCH", "filter": {"email": {"$eq": "someone@example.com"}},
+        "inputStage": {"stage": "IXSCAN", "indexName": "tags_1___deleted_1",
+                       "keyPattern": {"tags": 1, "__deleted": 1},
+                       "indexBounds": {"tags": ["[\"6A0000000001\", \"6A0000000001\"]"],
+                                       "__deleted": ["[null, null]"]}}}}
+    explained = SlowQueryRecorder.explain(lambda: {"queryPlanner": {"winningPlan": plan}})
+
+    assert explained["plan"] == "LIMIT > FETCH > IXSCAN(tags_1___deleted_1)"
+    assert "someone@example.com" not in explained["winning_plan"] and "6A0000000001" not in explained["winning_plan"]
+    stored = json.loads(explained["winning_plan"])
+    assert stored["inputStage"]["filter"] == {"email": {"$eq": "?"}}
+    assert stored["inputStage"]["inputStage"] == dict(plan["inputStage"]["inputStage"],
+                                                      indexBounds={"tags": ["?"], "__deleted": ["?"]})
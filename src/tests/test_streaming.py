@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from flask import Flask
+
+from routes.streaming import chunked, ndjson_response, NDJSON_MIMETYPE
+
+
+def test_chunked():
+    assert list(chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked([], 3)) == []
+
+
+def test_ndjson_response_consumes_records_while_streaming():
+    consumed = []
+
+    def records():
+        for i in range(3):
+            consumed.append(i)
+            yield {"n": i}
+
+    with Flask(__name__).test_request_context():
+        response = ndjson_response(records())
+        assert response.mimetype == NDJSON_MIMETYPE
+        assert consumed == []
+        lines = list(response.response)
+    assert lines == ['{"n": 0}\n', '{"n": 1}\n', '{"n": 2}\n']
+
+
+@pytest.fixture
+def stored_events(api):
+    from routes import api_v1
+    api_v1.mongo_helper.add_events([api_v1.mongo_helper.build_event("s1", "t1", "i1", 1000.0 + i, {"read": i})
+                                    for i in range(5)])
+
+
+@pytest.mark.parametrize("accept, ndjson", [
+    (NDJSON_MIMETYPE, True), ("application/x-ndjson, application/json;q=0.5", True), ("application/json", False),
+    (None, False),
+])
+def test_read_event_negotiates_ndjson(api, auth, stored_events, accept, ndjson):
+    headers = dict(auth, Accept=accept) if accept else auth
+    response = api.get("/api/v1/event?limit=3&fields=event_timestamp", headers=headers)
+    assert response.status_code == 200
+    if ndjson:
+        assert response.mimetype == NDJSON_MIMETYPE
+        events = [json.loads(x) for x in response.get_data(as_text=True).splitlines()]
+    else:
+        assert response.mimetype == "application/json"
+        events = response.get_json()
+    assert [x["event_timestamp"] for x in events] == [1004.0, 1003.0, 1002.0]
+
+
+def test_ndjson_cursor_page_has_no_envelope(api, auth, stored_events):
+    response = api.get("/api/v1/event?limit=2&cursor=", headers=dict(auth, Accept=NDJSON_MIMETYPE))
+    assert len(response.get_data(as_text=True).splitlines()) == 2
@@ -0,0 +1,2 @@
+# Production entry point: gunicorn wsgi:app (settings in gunicorn.conf.py)
+from app import app